@@ -0,0 +1,163 @@
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Apply the account-factory config to existing accounts. Runs the FastPathRunner pipeline for many
+# accounts at once, with a cap on concurrent accounts, and writes a summary of every account's outcome.
+#
+# Usage: python3 Backfill.py [--accounts 111111111111 222222222222 | --all] [--workers 10] [--audit-only]
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import argparse
+import json
+import os
+import time
+
+from common import deadline_reached, get_local_client, release_account, RetryAfterDelay
+
+import logging
+logger = logging.getLogger()
+
+# How many accounts to work on at once, and how many times to wait out an account's event['progress']['retry']
+BACKFILL_WORKERS = int(os.environ.get('BACKFILL_WORKERS', 10))
+BACKFILL_MAX_RETRIES = int(os.environ.get('BACKFILL_MAX_RETRIES', 3))
+
+
+def list_org_accounts():
+    '''Return the IDs of every ACTIVE account in the organization'''
+    org = get_local_client('organizations')
+    account_ids = []
+    for page in org.get_paginator('list_accounts').paginate():
+        for account in page['Accounts']:
+            if account['Status'] == 'ACTIVE':
+                account_ids.append(account['Id'])
+    return(account_ids)
+
+
+def configure_account(account_id, global_config, audit_only=False, max_retries=None, ignore_ledger=False, context=None, event=None):
+    '''
+    Run the whole pipeline for one account, waiting out at most max_retries of its progress['retry'].
+    With ignore_ledger, every step runs even where the ledger says it's already applied. With the
+    Lambda context, the pipeline stops short of the invocation's timeout. event resumes a run that
+    was left with a retry pending, which a retry_pending result hands back in its event.
+    Never raises: failures are reported in the result so one account can't stop the backfill.
+    '''
+    # Imported here so the CLI can set the environment the handlers read at import time first
+    import FastPathRunner
+    import LoadConfigurationLambdaFunction
+
+    if max_retries is None:
+        max_retries = BACKFILL_MAX_RETRIES
+    start = time.monotonic()
+    result = {"account_id": account_id}
+    try:
+        if event is None:
+            event = LoadConfigurationLambdaFunction.build_event(account_id, global_config, audit_only=audit_only)
+            event['ignore_ledger'] = ignore_ledger
+        event = FastPathRunner.handler(event, context)
+        for attempt in range(max_retries):
+            if not event['progress']['retry'] or deadline_reached(context):
+                break
+            time.sleep(event['progress']['retry']['wait_seconds'])
+            event = FastPathRunner.handler(event, context)
+        result['outcome'] = "retry_pending" if event['progress']['retry'] else "succeeded"
+        result['results'] = event['progress']['results']
+        if event['progress']['retry']:
+            result['pending'] = event['progress']['retry']
+            result['event'] = event
+    except RetryAfterDelay as e:
+        result['outcome'] = "not_ready"
+        result['error'] = str(e)
+    except Exception as e:
+        logger.error(f"Failed to configure {account_id}: {e}")
+        result['outcome'] = "failed"
+        result['error'] = f"{type(e).__name__}: {e}"
+    # Its clients, credentials and rate limiters aren't needed again, and another account is next
+    release_account(account_id)
+    result['duration_seconds'] = round(time.monotonic() - start, 3)
+    logger.info(f"{account_id}: {result['outcome']} in {result['duration_seconds']}s")
+    return(result)
+
+
+def backfill(account_ids, global_config, workers=None, audit_only=False, max_retries=None, ignore_ledger=False, context=None, events=None):
+    '''
+    Configure every account in account_ids, at most workers at a time. events maps account IDs to
+    the events of runs to resume (see configure_account).
+    Returns a summary dict with a result per account (in account_ids order) and totals.
+    '''
+    if workers is None:
+        workers = BACKFILL_WORKERS
+    started_at = datetime.now(timezone.utc).isoformat()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(lambda a: configure_account(a, global_config, audit_only, max_retries, ignore_ledger, context,
+                                                                (events or {}).get(a)), account_ids))
+
+    durations = sorted(r['duration_seconds'] for r in results)
+    outcomes = {}
+    for r in results:
+        outcomes[r['outcome']] = outcomes.get(r['outcome'], 0) + 1
+    return({
+        "started_at": started_at,
+        "accounts": len(account_ids),
+        "workers": workers,
+        "audit_only": audit_only,
+        "outcomes": outcomes,
+        "wall_seconds": round(time.monotonic() - start, 3),
+        "max_account_seconds": durations[-1] if durations else 0,
+        "median_account_seconds": durations[len(durations) // 2] if durations else 0,
+        "results": results,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply the account-factory config to existing accounts")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--accounts", nargs="+", help="Account IDs to configure")
+    target.add_argument("--all", action="store_true", help="Configure every ACTIVE account in the organization")
+    parser.add_argument("--config", help="Local config file (default: s3://$BUCKET/$CONFIG_FILE)")
+    parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS, help="Accounts to configure at once")
+    parser.add_argument("--audit-only", action="store_true", help="Only report drift, change nothing")
+    parser.add_argument("--ignore-ledger", action="store_true", help="Re-check every step, even those the ledger says are already applied")
+    parser.add_argument("--role-name", default=os.environ.get('ROLE_NAME', 'OrganizationAccountAccessRole'))
+    parser.add_argument("--summary", default="backfill-summary.json", help="Where to write the summary")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(threadName)s %(message)s')
+    os.environ['ROLE_NAME'] = args.role_name
+    os.environ.setdefault('ROLE_SESSION_NAME', 'account-factory-backfill')
+    os.environ.setdefault('LOG_LEVEL', 'INFO')
+
+    import LoadConfigurationLambdaFunction
+    if args.config:
+        with open(args.config) as f:
+            global_config = LoadConfigurationLambdaFunction.resolve_config(LoadConfigurationLambdaFunction.parse_yaml(f))
+    else:
+        global_config = LoadConfigurationLambdaFunction.get_config(os.environ['BUCKET'], os.environ['CONFIG_FILE'])
+    if global_config is None:
+        raise SystemExit("Unable to load the config")
+
+    account_ids = args.accounts if args.accounts else list_org_accounts()
+    summary = backfill(account_ids, global_config, workers=args.workers, audit_only=args.audit_only,
+                       ignore_ledger=args.ignore_ledger)
+    for result in summary['results']:
+        result.pop('event', None)
+    with open(args.summary, "w") as f:
+        json.dump(summary, f, indent=2, default=str)
+    print(json.dumps({k: v for k, v in summary.items() if k != 'results'}, indent=2))
+    print(f"Wrote {args.summary}")
+
+
+if __name__ == '__main__':
+    main()
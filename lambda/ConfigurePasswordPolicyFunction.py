@@ -13,14 +13,9 @@
 # limitations under the License.
 
 from botocore.exceptions import ClientError
-from urllib.parse import unquote
-from yaml import Loader, Dumper
-import boto3
-import json
 import os
-import yaml
 
-from common import *
+from common import audit_only, get_client, log_event, profiled, run_global_step, CHANGED, COMPLIANT, DRIFT
 
 import logging
 logger = logging.getLogger()
@@ -30,28 +25,56 @@ logging.getLogger('boto3').setLevel(logging.WARNING)
 logging.getLogger('urllib3').setLevel(logging.WARNING)
 
 # Lambda main routine
+@profiled
 def handler(event, context):
-    logger.info(f"Received event: {json.dumps(event, sort_keys=True)}")
+    log_event(event)
 
-    if 'account_password_policy' not in event['global_config']:
+    if not event['global_config'].get('account_password_policy'):
         # Nothing to do
         return(event)
 
-    client = get_client('iam', event['cross_account_role_arn'])
     if event['global_config']['account_password_policy']['update_account_password_policy']:
-        logger.info(f"Applying Password Policy in {event['new_aws_account_id']}")
-        event['messages'].append(f"Applying Password Policy in {event['new_aws_account_id']}")
-        policy = event['global_config']['account_password_policy']['password_policy']
-        response = client.update_account_password_policy(
-            MinimumPasswordLength       = policy['MinimumPasswordLength'],
-            RequireSymbols              = policy['RequireSymbols'],
-            RequireNumbers              = policy['RequireNumbers'],
-            RequireUppercaseCharacters  = policy['RequireUppercaseCharacters'],
-            RequireLowercaseCharacters  = policy['RequireLowercaseCharacters'],
-            AllowUsersToChangePassword  = policy['AllowUsersToChangePassword'],
-            MaxPasswordAge              = policy['MaxPasswordAge'],
-            PasswordReusePrevention     = policy['PasswordReusePrevention'],
-            HardExpiry                  = policy['HardExpiry'],
-        )
-
-    return(event)
\ No newline at end of file
+        return(run_global_step('ConfigurePasswordPolicyFunction', event, apply_password_policy))
+
+    return(event)
+
+def apply_password_policy(event):
+    client = get_client('iam', event['cross_account_role_arn'])
+    policy = event['global_config']['account_password_policy']['password_policy']
+    if password_policy_matches(client, policy):
+        logger.info(f"Password Policy already set in {event['new_aws_account_id']}")
+        return(COMPLIANT)
+    if audit_only(event):
+        logger.warning(f"Password Policy differs from the config in {event['new_aws_account_id']}")
+        return(DRIFT)
+
+    logger.info(f"Applying Password Policy in {event['new_aws_account_id']}")
+    response = client.update_account_password_policy(
+        MinimumPasswordLength       = policy['MinimumPasswordLength'],
+        RequireSymbols              = policy['RequireSymbols'],
+        RequireNumbers              = policy['RequireNumbers'],
+        RequireUppercaseCharacters  = policy['RequireUppercaseCharacters'],
+        RequireLowercaseCharacters  = policy['RequireLowercaseCharacters'],
+        AllowUsersToChangePassword  = policy['AllowUsersToChangePassword'],
+        MaxPasswordAge              = policy['MaxPasswordAge'],
+        PasswordReusePrevention     = policy['PasswordReusePrevention'],
+        HardExpiry                  = policy['HardExpiry'],
+    )
+    return(CHANGED)
+
+# GetAccountPasswordPolicy leaves these out when they are unset
+PASSWORD_POLICY_UNSET = {
+    'MaxPasswordAge': 0,
+    'PasswordReusePrevention': 0,
+    'HardExpiry': False,
+}
+
+def password_policy_matches(client, policy):
+    '''True when the account's current password policy already has every setting in policy'''
+    try:
+        current = client.get_account_password_policy()['PasswordPolicy']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchEntity':
+            return(False)
+        raise
+    return(all(current.get(k, PASSWORD_POLICY_UNSET.get(k)) == v for k, v in policy.items()))
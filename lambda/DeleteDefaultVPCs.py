@@ -13,14 +13,11 @@
 # limitations under the License.
 
 from botocore.exceptions import ClientError
-from urllib.parse import unquote
-from yaml import Loader, Dumper
-import boto3
-import json
+from concurrent.futures import ThreadPoolExecutor
 import os
-import yaml
+import time
 
-from common import *
+from common import audit_only, bind_unit, get_client, log_event, profiled, run_regional_step, BLOCKED, CHANGED, COMPLIANT, DRIFT, SKIPPED
 
 import logging
 logger = logging.getLogger()
@@ -30,161 +27,265 @@ logging.getLogger('boto3').setLevel(logging.WARNING)
 logging.getLogger('urllib3').setLevel(logging.WARNING)
 
 # Lambda main routine
+@profiled
 def handler(event, context):
-    logger.info(f"Received event: {json.dumps(event, sort_keys=True)}")
+    log_event(event)
 
-    if 'default_vpc' not in event['global_config']:
+    if not event['global_config'].get('default_vpc'):
         # Nothing to do
         return(event)
 
-    if 'delete_default_vpc' in event['global_config']['default_vpc'] and event['global_config']['default_vpc']['delete_default_vpc']:
+    if event['global_config']['default_vpc'].get('delete_default_vpc'):
+        return(run_regional_step('DeleteDefaultVPCs', event, handle_region, context=context))
 
-        regions = get_regions(event['cross_account_role_arn'])
-        for r in regions:
-            if 'preserve_vpc_regions' in event['global_config']['default_vpc'] and r in event['global_config']['default_vpc']['preserve_vpc_regions']:
-                event['messages'].append(f"Skipping deleting the default VPC in {r} in {event['new_aws_account_id']}")
-                continue
+    return(event)
 
-            logger.info(f"Deleting Default VPC in {r} in {event['new_aws_account_id']}")
-            event['messages'].append(f"Deleting Default VPC in {r} in {event['new_aws_account_id']}")
-            process_region(r, event['cross_account_role_arn'])
+def handle_region(r, event):
+    if r in event['global_config']['default_vpc'].get('preserve_vpc_regions', []):
+        return(SKIPPED)
 
-    return(event)
+    client = get_client('ec2', event['cross_account_role_arn'], region=r)
+    vpc_ids = find_default_vpcs(client)
+    if not vpc_ids:
+        logger.info("No Default VPC to to be deleted in region:{}".format(r))
+        return(COMPLIANT)
+    if audit_only(event):
+        logger.warning(f"Default VPC {vpc_ids} exists in {r} in {event['new_aws_account_id']}")
+        return(DRIFT)
 
-def delete_igw(vpc):
-    for igw in vpc.internet_gateways.all():
-        logger.info("Detaching {}, VPC:{}".format(igw.id,vpc.id))
-        igw.detach_from_vpc(VpcId=vpc.id)
-        logger.info("Deleting {}, VPC:{}".format(igw.id,vpc.id))
-        igw.delete()
-
-def delete_eigw(vpc):
-    client = vpc.meta.client
-    paginator = client.get_paginator('describe_egress_only_internet_gateways')
-    for page in paginator.paginate():
-        for eigw in page['EgressOnlyInternetGateways']:
-            for attachment in eigw['Attachments']:
-                if attachment['VpcId'] == vpc.id and attachment['State'] == 'attached':
-                    logger.info("Deleting {}, VPC:{}".format(eigw['EgressOnlyInternetGatewayId'],vpc.id))
-                    client.delete_egress_only_internet_gateway(EgressOnlyInternetGatewayId=eigw['EgressOnlyInternetGatewayId'])
-                    break
-
-def delete_subnet(vpc):
-    for subnet in vpc.subnets.all():
-        logger.info("Deleting {}, VPC:{}".format(subnet.id,vpc.id))
-        subnet.delete()
-
-def delete_sg(vpc):
-    for sg in filter(lambda x:x.group_name != 'default', vpc.security_groups.all()): #exclude default SG:
-        logger.info("Deleting {}, VPC:{}".format(sg.id,vpc.id))
-        sg.delete()
-
-def delete_rtb(vpc):
-    for rtb in vpc.route_tables.all():
-        rt_is_main = False
-        # skip deleting main route tables
-        for attr in rtb.associations_attribute:
-            if attr['Main']:
-                rt_is_main = True
-        if rt_is_main:
-            continue
-        logger.info("Deleting {}, VPC:{}".format(rtb.id,vpc.id))
-        rtb.delete()
+    logger.info(f"Deleting Default VPC in {r} in {event['new_aws_account_id']}")
+    remaining = process_region(r, event['cross_account_role_arn'], vpc_ids)
+    if remaining:
+        logger.warning(f"Default VPC {remaining} in {r} in {event['new_aws_account_id']} is still in use, and was not deleted")
+        return(BLOCKED)
+    return(CHANGED)
+
+def describe_all(client, operation, key, **kwargs):
+    '''Return every item under key for an EC2 describe call, paginating when the API supports it'''
+    if client.can_paginate(operation):
+        return([item for page in client.get_paginator(operation).paginate(**kwargs) for item in page[key]])
+    return(getattr(client, operation)(**kwargs)[key])
+
+def inventory_region(client, vpc_ids):
+    '''
+    Snapshot everything attached to the given VPCs with one server-side filtered describe call per
+    resource type, rather than one lazy collection per VPC per resource type.
+    Returns a dict of vpc_id -> {resource_type: [resource descriptions]}
+    '''
+    vpc_filter = [{'Name': 'vpc-id', 'Values': vpc_ids}]
+    inventory = {vpc_id: {} for vpc_id in vpc_ids}
+
+    def file_by_vpc(resource_type, items, get_vpc_ids):
+        for vpc_id in inventory:
+            inventory[vpc_id][resource_type] = []
+        for item in items:
+            for vpc_id in get_vpc_ids(item):
+                if vpc_id in inventory:
+                    inventory[vpc_id][resource_type].append(item)
+
+    file_by_vpc('network_interfaces', describe_all(client, 'describe_network_interfaces', 'NetworkInterfaces', Filters=vpc_filter),
+                lambda i: [i['VpcId']])
+    file_by_vpc('internet_gateways', describe_all(client, 'describe_internet_gateways', 'InternetGateways',
+                Filters=[{'Name': 'attachment.vpc-id', 'Values': vpc_ids}]),
+                lambda i: [a['VpcId'] for a in i['Attachments']])
+    # DescribeEgressOnlyInternetGateways has no VPC filter, so this is one unfiltered pass per region
+    file_by_vpc('egress_only_internet_gateways', describe_all(client, 'describe_egress_only_internet_gateways', 'EgressOnlyInternetGateways'),
+                lambda i: [a['VpcId'] for a in i['Attachments'] if a['State'] == 'attached'])
+    file_by_vpc('subnets', describe_all(client, 'describe_subnets', 'Subnets', Filters=vpc_filter),
+                lambda i: [i['VpcId']])
+    file_by_vpc('route_tables', describe_all(client, 'describe_route_tables', 'RouteTables', Filters=vpc_filter),
+                lambda i: [i['VpcId']])
+    file_by_vpc('network_acls', describe_all(client, 'describe_network_acls', 'NetworkAcls',
+                Filters=vpc_filter + [{'Name': 'default', 'Values': ['false']}]),
+                lambda i: [i['VpcId']])
+    live_pcx = [{'Name': 'status-code', 'Values': ['pending-acceptance', 'provisioning', 'active', 'rejected', 'failed', 'expired']}]
+    pcxs = {}
+    for side in ('requester-vpc-info', 'accepter-vpc-info'):
+        for pcx in describe_all(client, 'describe_vpc_peering_connections', 'VpcPeeringConnections',
+                                Filters=[{'Name': f'{side}.vpc-id', 'Values': vpc_ids}] + live_pcx):
+            pcxs[pcx['VpcPeeringConnectionId']] = pcx
+    file_by_vpc('vpc_peering_connections', pcxs.values(),
+                lambda i: {i['RequesterVpcInfo'].get('VpcId'), i['AccepterVpcInfo'].get('VpcId')})
+    file_by_vpc('vpc_endpoints', describe_all(client, 'describe_vpc_endpoints', 'VpcEndpoints',
+                Filters=vpc_filter + [{'Name': 'vpc-endpoint-state', 'Values': ['pendingAcceptance', 'pending', 'available', 'rejected', 'failed']}]),
+                lambda i: [i['VpcId']])
+    file_by_vpc('security_groups', describe_all(client, 'describe_security_groups', 'SecurityGroups', Filters=vpc_filter),
+                lambda i: [i['VpcId']])
+    vgws = describe_all(client, 'describe_vpn_gateways', 'VpnGateways', Filters=[
+                {'Name': 'attachment.vpc-id', 'Values': vpc_ids},
+                {'Name': 'state', 'Values': ['pending', 'available']},
+            ])
+    file_by_vpc('virtual_private_gateways', vgws,
+                lambda i: [a['VpcId'] for a in i['VpcAttachments'] if a['State'] in ['attaching', 'attached']])
+    vpn_connections = []
+    if vgws:
+        vpn_connections = describe_all(client, 'describe_vpn_connections', 'VpnConnections', Filters=[
+                {'Name': 'vpn-gateway-id', 'Values': [v['VpnGatewayId'] for v in vgws]},
+                {'Name': 'state', 'Values': ['pending', 'available']},
+            ])
+    vgw_vpcs = {v['VpnGatewayId']: [a['VpcId'] for a in v['VpcAttachments']] for v in vgws}
+    file_by_vpc('vpn_connections', vpn_connections, lambda i: vgw_vpcs.get(i.get('VpnGatewayId'), []))
+    return(inventory)
+
+# Teardown dependency graph: each EC2 call depends on the calls that must finish before it.
+# From https://aws.amazon.com/premiumsupport/knowledge-center/troubleshoot-dependency-error-delete-vpc/
+# Instances are not deleted, for safety.
+TEARDOWN_DEPENDENCIES = {
+    'detach_internet_gateway': [],
+    'delete_egress_only_internet_gateway': [],
+    'delete_vpc_peering_connection': [],
+    'delete_vpc_endpoints': [],
+    'detach_vpn_gateway': [],
+    'delete_vpn_connection': [],
+    'delete_internet_gateway': ['detach_internet_gateway'],
+    'delete_subnet': ['delete_vpc_endpoints'],
+    'delete_security_group': ['delete_vpc_endpoints'],
+    'delete_vpn_gateway': ['detach_vpn_gateway', 'delete_vpn_connection'],
+    'delete_route_table': ['delete_subnet'],
+    'delete_network_acl': ['delete_subnet'],
+    'delete_vpc': ['delete_internet_gateway', 'delete_egress_only_internet_gateway', 'delete_vpc_peering_connection',
+                   'delete_security_group', 'delete_vpn_gateway', 'delete_route_table', 'delete_network_acl'],
+}
+
+def teardown_tiers():
+    '''Group TEARDOWN_DEPENDENCIES into tiers, where every call in a tier only depends on earlier tiers'''
+    tier_of = {}
+    def tier(method):
+        if method not in tier_of:
+            tier_of[method] = 1 + max([tier(d) for d in TEARDOWN_DEPENDENCIES[method]], default=-1)
+        return(tier_of[method])
+    tiers = [[] for _ in range(1 + max(tier(m) for m in TEARDOWN_DEPENDENCIES))]
+    for method in TEARDOWN_DEPENDENCIES:
+        tiers[tier(method)].append(method)
+    return(tiers)
+
+# Calls that only start an asynchronous change, the custom waiter that confirms it finished, and a
+# function of the calls returning the waiter's arguments. EC2 has no built-in waiters for most of
+# these, and its vpn_connection_deleted waiter fails on any connection still pending, so these waiter
+# definitions use botocore's waiter format.
+TEARDOWN_WAITERS = {
+    'delete_vpc_endpoints': ('VpcEndpointsDeleted', {
+        'operation': 'DescribeVpcEndpoints', 'delay': 5, 'maxAttempts': 60,
+        'acceptors': [
+            {'state': 'success', 'matcher': 'path', 'argument': "length(VpcEndpoints[?State != 'deleted'])", 'expected': 0},
+            {'state': 'success', 'matcher': 'error', 'expected': 'InvalidVpcEndpointId.NotFound'},
+        ]}, lambda calls: {'VpcEndpointIds': [i for c in calls for i in c['VpcEndpointIds']]}),
+    'detach_vpn_gateway': ('VpnGatewaysDetached', {
+        'operation': 'DescribeVpnGateways', 'delay': 5, 'maxAttempts': 60,
+        'acceptors': [
+            {'state': 'success', 'matcher': 'path', 'argument': "length(VpnGateways[].VpcAttachments[?State != 'detached'][])", 'expected': 0},
+        ]}, lambda calls: {'VpnGatewayIds': [c['VpnGatewayId'] for c in calls]}),
+    # A VPN gateway can't be deleted while its connections are still deleting (IncorrectState)
+    'delete_vpn_connection': ('VpnConnectionsDeleted', {
+        'operation': 'DescribeVpnConnections', 'delay': 5, 'maxAttempts': 60,
+        'acceptors': [
+            {'state': 'success', 'matcher': 'path', 'argument': "length(VpnConnections[?State != 'deleted'])", 'expected': 0},
+            {'state': 'success', 'matcher': 'error', 'expected': 'InvalidVpnConnectionID.NotFound'},
+        ]}, lambda calls: {'VpnConnectionIds': [c['VpnConnectionId'] for c in calls]}),
+}
 
-def delete_acl(vpc):
-    for acl in vpc.network_acls.all():
-        if acl.is_default:
-            # skip deleting default acl
+# Batch APIs take many IDs per call
+TEARDOWN_BATCH_SIZE = {'delete_vpc_endpoints': 25}
+
+TEARDOWN_CONCURRENCY = int(os.environ.get('TEARDOWN_CONCURRENCY', 8))
+
+def plan_vpc_deletion(vpc_id, resources):
+    '''
+    Turn one VPC's inventory into a dict of ec2 client method -> list of kwargs for each call.
+    Batch APIs get their IDs merged into as few calls as possible.
+    '''
+    plan = {method: [] for method in TEARDOWN_DEPENDENCIES}
+    for igw in resources['internet_gateways']:
+        plan['detach_internet_gateway'].append({'InternetGatewayId': igw['InternetGatewayId'], 'VpcId': vpc_id})
+        plan['delete_internet_gateway'].append({'InternetGatewayId': igw['InternetGatewayId']})
+    for eigw in resources['egress_only_internet_gateways']:
+        plan['delete_egress_only_internet_gateway'].append({'EgressOnlyInternetGatewayId': eigw['EgressOnlyInternetGatewayId']})
+    for subnet in resources['subnets']:
+        plan['delete_subnet'].append({'SubnetId': subnet['SubnetId']})
+    for rtb in resources['route_tables']:
+        # skip deleting main route tables
+        if any(a.get('Main') for a in rtb.get('Associations', [])):
             continue
-        logger.info("Deleting {}, VPC:{}".format(acl.id,vpc.id))
-        acl.delete()
-
-def delete_pcx(vpc):
-    pcxs = list(vpc.accepted_vpc_peering_connections.all()) + list(vpc.requested_vpc_peering_connections.all())
-    for pcx in pcxs:
-        if pcx.status['Code'] == 'deleted':
-            # vpc peering connections already deleted
+        plan['delete_route_table'].append({'RouteTableId': rtb['RouteTableId']})
+    for acl in resources['network_acls']:
+        plan['delete_network_acl'].append({'NetworkAclId': acl['NetworkAclId']})
+    for pcx in resources['vpc_peering_connections']:
+        plan['delete_vpc_peering_connection'].append({'VpcPeeringConnectionId': pcx['VpcPeeringConnectionId']})
+    endpoint_ids = [e['VpcEndpointId'] for e in resources['vpc_endpoints']]
+    for i in range(0, len(endpoint_ids), TEARDOWN_BATCH_SIZE['delete_vpc_endpoints']):
+        plan['delete_vpc_endpoints'].append({'VpcEndpointIds': endpoint_ids[i:i + TEARDOWN_BATCH_SIZE['delete_vpc_endpoints']]})
+    for sg in resources['security_groups']:
+        # exclude default SG
+        if sg['GroupName'] == 'default':
             continue
-        logger.info("Deleting {}, VPC:{}".format(pcx.status,vpc.id))
-        pcx.delete()
-
-def delete_endpoints(vpc):
-    client = vpc.meta.client
-    paginator = client.get_paginator('describe_vpc_endpoints')
-    for page in paginator.paginate(Filters=[
-                    {'Name': 'vpc-id', 'Values': [vpc.id]},
-                    {'Name': 'vpc-endpoint-state', 'Values': ['pendingAcceptance', 'pending', 'available', 'rejected', 'failed']},
-                ]):
-        for endpoint in page['VpcEndpoints']:
-            logger.info("Deleting {}, VPC:{}".format(endpoint['VpcEndpointId'],vpc.id))
-            client.delete_vpc_endpoints(VpcEndpointIds=[endpoint['VpcEndpointId']])
-
-def delete_vgw(vpc):
-    client = vpc.meta.client
-    response = client.describe_vpn_gateways(Filters=[
-                    {'Name': 'attachment.vpc-id', 'Values': [vpc.id]},
-                    {'Name': 'state', 'Values': ['pending', 'available']},
-                ])
-    for vgw in response['VpnGateways']:
-        for attachment in vgw['VpcAttachments']:
-            if attachment['State'] in ['attaching','attached']:
-                logger.info("Detaching {}, from VPC:{}".format(vgw['VpnGatewayId'],vpc.id))
-                client.detach_vpn_gateway(VpcId=vpc.id, VpnGatewayId=vgw['VpnGatewayId'])
-                break
-        response = client.describe_vpn_connections(Filters=[{'Name': 'vpn-gateway-id', 'Values': [vgw['VpnGatewayId']]}])
-        for vpn_connection in response['VpnConnections']:
-            if vpn_connection['State'] in ['pending','available']:
-                logger.info("Deleting {}, from VPC:{}".format(vpn_connection['VpnConnectionId'],vpc.id))
-                client.delete_vpn_connection(VpnConnectionId=vpn_connection['VpnConnectionId'])
-        logger.info("Deleting {}, VPC:{}".format(vgw['VpnGatewayId'],vpc.id))
-        client.delete_vpn_gateway(VpnGatewayId=vgw['VpnGatewayId'])
-
-def delete_vpc(vpc,region):
-
-    network_interfaces = list(vpc.network_interfaces.all())
-    if network_interfaces:
-        logger.warning("Elastic Network Interfaces exist in the VPC:{}, skipping delete".format(vpc.id))
-    else:
-        logger.info("Deleting default VPC:{}, region:{}".format(vpc.id,region))
-        try:
-            vpc_resources = {
-                # dependency order from https://aws.amazon.com/premiumsupport/knowledge-center/troubleshoot-dependency-error-delete-vpc/
-                'internet_gateways': delete_igw,
-                'egress_only_internet_gateways': delete_eigw,
-                'subnets': delete_subnet,
-                'route_tables': delete_rtb,
-                'network_acls': delete_acl,
-                'vpc_peering_connections': delete_pcx,
-                'vpc_endpoints': delete_endpoints,
-                'security_groups': delete_sg,
-                # instances (we do not delete this for safety)
-                'virtual_private_gateways': delete_vgw,
-            }
-            for resource_type in vpc_resources:
-                vpc_resources[resource_type](vpc)
-
-            vpc.delete()
-
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'DependencyViolation':
-                logger.error("VPC:{} can't be delete due to dependency, {}".format(vpc.id, e))
-            else:
-                raise
-        logger.info("Successfully deleted default VPC:{}, region:{}".format(vpc.id,region))
-
-def process_region(region, cross_account_role_arn):
+        plan['delete_security_group'].append({'GroupId': sg['GroupId']})
+    for vgw in resources['virtual_private_gateways']:
+        plan['detach_vpn_gateway'].append({'VpcId': vpc_id, 'VpnGatewayId': vgw['VpnGatewayId']})
+        plan['delete_vpn_gateway'].append({'VpnGatewayId': vgw['VpnGatewayId']})
+    for vpn_connection in resources['vpn_connections']:
+        plan['delete_vpn_connection'].append({'VpnConnectionId': vpn_connection['VpnConnectionId']})
+    plan['delete_vpc'].append({'VpcId': vpc_id})
+    return(plan)
+
+def wait_for(client, method, calls):
+    '''Block until the asynchronous changes started by calls to method have finished'''
+    # botocore.waiter is a heavy import, and only a VPC teardown needs it
+    from botocore.waiter import WaiterModel, create_waiter_with_client
+    name, config, waiter_args = TEARDOWN_WAITERS[method]
+    waiter = create_waiter_with_client(name, WaiterModel({'version': 2, 'waiters': {name: config}}), client)
+    waiter.wait(**waiter_args(calls))
+
+def delete_vpc(client, vpc_id, resources, region):
+    '''
+    Delete a VPC one dependency tier at a time, with the calls inside a tier running concurrently.
+    Returns True when the VPC was deleted, and False when something still in it stopped the delete.
+    '''
+    tier_seconds = []
+    if resources['network_interfaces']:
+        logger.warning("Elastic Network Interfaces exist in the VPC:{}, skipping delete".format(vpc_id))
+        return(False)
+
+    logger.info("Deleting default VPC:{}, region:{}".format(vpc_id,region))
+    plan = plan_vpc_deletion(vpc_id, resources)
+    try:
+        with ThreadPoolExecutor(max_workers=TEARDOWN_CONCURRENCY) as executor:
+            for tier in teardown_tiers():
+                start = time.monotonic()
+                calls = [(method, kwargs) for method in tier for kwargs in plan[method]]
+                for method, kwargs in calls:
+                    logger.info("{} {}, VPC:{}".format(method, kwargs, vpc_id))
+                # The calls count towards (and are labelled with) this region's unit, under its deadline
+                futures = [executor.submit(bind_unit(getattr(client, method)), **kwargs) for method, kwargs in calls]
+                # Let the whole tier finish before surfacing the first error
+                errors = [f.exception() for f in futures if f.exception() is not None]
+                if errors:
+                    raise errors[0]
+                for method in tier:
+                    if method in TEARDOWN_WAITERS and plan[method]:
+                        wait_for(client, method, plan[method])
+                tier_seconds.append(round(time.monotonic() - start, 3))
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'DependencyViolation':
+            logger.error("VPC:{} can't be delete due to dependency, {}".format(vpc_id, e))
+            return(False)
+        raise
+    logger.info("Successfully deleted default VPC:{}, region:{}, seconds per tier: {}".format(vpc_id,region,tier_seconds))
+    return(True)
+
+def find_default_vpcs(client):
+    return([vpc['VpcId'] for vpc in describe_all(client, 'describe_vpcs', 'Vpcs', Filters=[{'Name': 'isDefault', 'Values': ['true']}])])
+
+def process_region(region, cross_account_role_arn, vpc_ids=None):
+    '''Delete the default VPCs in region. Returns the ones that couldn't be deleted'''
     logger.info(f"Processing region {region}")
-    ec2_resource = get_resource('ec2', cross_account_role_arn, region=region)
-
-    vpcs = []
-    for vpc in ec2_resource.vpcs.filter(Filters=[{'Name': 'isDefault', 'Values': ['true']}]):
-        logger.info(f'Found {vpc}')
-        vpcs.append(vpc)
-    if vpcs:
-        for vpc in vpcs:
-            delete_vpc(vpc,region)
-    else:
-        logger.info("No Default VPC to to be deleted in region:{}".format(region))
+    client = get_client('ec2', cross_account_role_arn, region=region)
 
-    return
+    if vpc_ids is None:
+        vpc_ids = find_default_vpcs(client)
+    if not vpc_ids:
+        logger.info("No Default VPC to to be deleted in region:{}".format(region))
+        return([])
 
+    logger.info(f'Found {vpc_ids}')
+    inventory = inventory_region(client, vpc_ids)
+    return([vpc_id for vpc_id in vpc_ids if not delete_vpc(client, vpc_id, inventory[vpc_id], region)])
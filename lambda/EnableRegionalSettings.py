@@ -0,0 +1,80 @@
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Applies every enabled setting in regional_settings.REGIONAL_SETTINGS (EBS Block Public Access, EBS
+# default encryption, IMDSv2 defaults, ...) in a single pass over the regions, with one client per
+# service in each region. Each setting's results are still recorded under its own step name.
+
+from botocore.exceptions import ClientError
+import os
+import time
+
+from common import audit_only, get_client, log_event, profiled, run_regional_step, unit_stats, CHANGED, COMPLIANT, DRIFT, ENFORCED
+from regional_settings import REGIONAL_SETTINGS, SETTINGS_BY_STEP
+
+import logging
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', default='INFO')))
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+# Lambda main routine
+@profiled
+def handler(event, context):
+    log_event(event)
+
+    # Settings that aren't configured, or are explicitly disabled (false), are left alone
+    enabled = [s['step'] for s in REGIONAL_SETTINGS if event['global_config'].get(s['config_key'])]
+    if not enabled:
+        return(event)
+
+    return(run_regional_step('EnableRegionalSettings', event, process_region, settings=enabled, context=context))
+
+def process_region(r, event, steps):
+    '''Apply the settings named in steps in region r. Returns {step: (status, ms, API calls and retries)}'''
+    clients = {}
+    results = {}
+    for step in steps:
+        setting = SETTINGS_BY_STEP[step]
+        if setting['service'] not in clients:
+            clients[setting['service']] = get_client(setting['service'], event['cross_account_role_arn'], region=r)
+        start = time.monotonic()
+        before = unit_stats()
+        status = apply_setting(setting, clients[setting['service']], r, event)
+        results[step] = (status, int((time.monotonic() - start) * 1000), {k: v - before[k] for k, v in unit_stats().items()})
+    return(results)
+
+def apply_setting(setting, client, r, event):
+    '''Read one setting in region r, and write it when it differs from the config'''
+    desired = setting['desired'](event['global_config'][setting['config_key']])
+    current = setting['current'](getattr(client, setting['read'])())
+    if all(current.get(k) == v for k, v in desired.items()):
+        logger.info(f"{setting['title']} already set in {r} in {event['new_aws_account_id']}")
+        return(COMPLIANT)
+    if audit_only(event):
+        logger.warning(f"{setting['title']} differs from the config in {r} in {event['new_aws_account_id']}: {current}")
+        return(DRIFT)
+
+    logger.info(f"Applying {setting['title']} in {r} in {event['new_aws_account_id']}")
+    try:
+        getattr(client, setting['apply'])(**setting.get('apply_args', lambda desired: desired)(desired))
+    except ClientError as e:
+        if e.response['Error']['Code'] in setting['tolerated_errors']:
+            # Something else (a Declarative Policy) already enforces the setting, so AWS denies
+            # the call. That's expected -- nothing for us to do here.
+            logger.warning(f"Skipping {setting['title']} in {r} for {event['new_aws_account_id']}: blocked by a Declarative Policy ({e.response['Error']['Message']})")
+            return(ENFORCED)
+        raise
+    return(CHANGED)
@@ -13,14 +13,9 @@
 # limitations under the License.
 
 from botocore.exceptions import ClientError
-from urllib.parse import unquote
-from yaml import Loader, Dumper
-import boto3
-import json
 import os
-import yaml
 
-from common import *
+from common import audit_only, get_client, log_event, profiled, run_global_step, CHANGED, COMPLIANT, DRIFT
 
 import logging
 logger = logging.getLogger()
@@ -30,20 +25,39 @@ logging.getLogger('boto3').setLevel(logging.WARNING)
 logging.getLogger('urllib3').setLevel(logging.WARNING)
 
 # Lambda main routine
+@profiled
 def handler(event, context):
-    logger.info(f"Received event: {json.dumps(event, sort_keys=True)}")
+    log_event(event)
 
-    if 'enable_account_s3_block_public_access' not in event['global_config']:
-        # Nothing to do
+    if not event['global_config'].get('enable_account_s3_block_public_access'):
+        # Not configured, or explicitly disabled (false)
         return(event)
 
+    return(run_global_step('EnableS3BlockPublicAccess', event, apply_public_access_block))
+
+def apply_public_access_block(event):
     client = get_client('s3control', event['cross_account_role_arn'])
-    if event['global_config']['enable_account_s3_block_public_access']:
-        logger.info(f"Applying Account Wide Block Public Access for S3 in {event['new_aws_account_id']}")
-        event['messages'].append(f"Applying Account Wide Block Public Access for S3 in {event['new_aws_account_id']}")
-        response = client.put_public_access_block(
-            PublicAccessBlockConfiguration=event['global_config']['enable_account_s3_block_public_access'],
-            AccountId=event['new_aws_account_id']
-        )
-
-    return(event)
\ No newline at end of file
+    desired = event['global_config']['enable_account_s3_block_public_access']
+    if public_access_block_matches(client, event['new_aws_account_id'], desired):
+        logger.info(f"Account Wide Block Public Access for S3 already set in {event['new_aws_account_id']}")
+        return(COMPLIANT)
+    if audit_only(event):
+        logger.warning(f"Account Wide Block Public Access for S3 differs from the config in {event['new_aws_account_id']}")
+        return(DRIFT)
+
+    logger.info(f"Applying Account Wide Block Public Access for S3 in {event['new_aws_account_id']}")
+    response = client.put_public_access_block(
+        PublicAccessBlockConfiguration=desired,
+        AccountId=event['new_aws_account_id']
+    )
+    return(CHANGED)
+
+def public_access_block_matches(client, account_id, desired):
+    '''True when the account-wide S3 Block Public Access already has every setting in desired'''
+    try:
+        current = client.get_public_access_block(AccountId=account_id)['PublicAccessBlockConfiguration']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchPublicAccessBlockConfiguration':
+            return(False)
+        raise
+    return(all(bool(current.get(k, False)) == bool(v) for k, v in desired.items()))
@@ -0,0 +1,74 @@
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Runs the whole NewAccountStateMachine pipeline in a single Lambda invocation. The step handlers
+# are called in-process, so they share one cold start, one set of AssumeRole credentials and the
+# clients cached in common.
+
+import os
+
+from common import API_STATS, CREDENTIAL_CACHE_STATS, continuation, deadline_reached, new_progress, profiled
+import SummarizeResults
+import LoadConfigurationLambdaFunction
+import ConfigurePasswordPolicyFunction
+import EnableS3BlockPublicAccess
+import EnableRegionalSettings
+import DeleteDefaultVPCs
+
+import logging
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', default='INFO')))
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+# Same order as the states in NewAccountStateMachine
+PIPELINE = [
+    ConfigurePasswordPolicyFunction,
+    EnableS3BlockPublicAccess,
+    EnableRegionalSettings,
+    DeleteDefaultVPCs,
+]
+
+# Lambda main routine
+@profiled
+def handler(event, context):
+    # Takes the same CreateAccountResult event as the state machine and returns the same event
+    # the last state would. RetryAfterDelay propagates so the FastPathStateMachine can wait and retry.
+    if 'global_config' not in event:
+        event = LoadConfigurationLambdaFunction.handler(event, context)
+
+    # When a regional step comes back with regions not ready, stop and let FastPathStateMachine
+    # wait out event['progress']['retry']; the next invocation skips the steps already in completed_steps.
+    # The same goes for running short of time: a step close to the timeout hands back a continuation
+    # for the regions it didn't start, and no new step is started.
+    completed = event.setdefault('completed_steps', [])
+    event.setdefault('progress', new_progress())
+    for step in PIPELINE:
+        if step.__name__ in completed:
+            continue
+        if deadline_reached(context):
+            logger.warning(f"Out of time before {step.__name__} for {event['new_aws_account_id']}, continuing in a new invocation")
+            event['progress']['retry'] = continuation(step.__name__, [], event['progress'])
+            return(event)
+        # A continuation is done with once the step it was for runs again
+        if (event['progress']['retry'] or {}).get('reason') == 'deadline':
+            event['progress']['retry'] = None
+        logger.info(f"Running {step.__name__} for {event['new_aws_account_id']}")
+        event = step.handler(event, context)
+        if event['progress']['retry']:
+            return(event)
+        completed.append(step.__name__)
+    logger.info(f"API calls: {API_STATS}, credential cache: {CREDENTIAL_CACHE_STATS}")
+    return(SummarizeResults.handler(event, context))
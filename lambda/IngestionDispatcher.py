@@ -0,0 +1,254 @@
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Queue-backed ingestion (pIngestionMode: Queue). Instead of starting a state machine execution per
+# CreateAccountResult, EventBridge puts the events on an SQS queue and this Lambda configures a batch
+# of new accounts at a time. A batch shares one loaded config, the cached local-account identity and
+# the rate limiters on our own account's STS calls. DISPATCH_WORKERS caps the accounts configured at once per
+# invocation, and the queue's event source mapping caps the concurrent invocations, so a burst of
+# account vending can only put so much pressure on STS, S3 and EC2.
+
+import json
+import os
+import threading
+import uuid
+
+from common import get_local_client, log_event, profiled, RETRY_BASE_SECONDS, RETRY_MAX_SECONDS
+import Backfill
+import LoadConfigurationLambdaFunction
+
+import logging
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', default='INFO')))
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+# Accounts configured at once by one invocation. Each one also runs up to REGION_CONCURRENCY regions at once.
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', 5))
+# How many times an account's progress['retry'] is waited out inside the invocation. By default the
+# account goes straight back on the queue, delayed by the retry's wait_seconds, rather than sleeping.
+DISPATCH_MAX_RETRIES = int(os.environ.get('DISPATCH_MAX_RETRIES', 0))
+# SQS delays a message by at most 15 minutes
+MAX_DELAY_SECONDS = 900
+
+# Lambda main routine
+@profiled
+def handler(event, context):
+    log_event(event)
+    retries = dispatch(event['Records'], context=context, requeue=requeue_message)
+
+    # Messages that couldn't be re-sent are left on the queue, and come back after the queue's
+    # visibility timeout unless the account said how long to wait before its regions would be ready
+    receipts = {r['messageId']: r for r in event['Records']}
+    for message_id, wait_seconds in retries.items():
+        if wait_seconds is not None:
+            delay_message(receipts[message_id], wait_seconds)
+
+    # With ReportBatchItemFailures only these messages stay on the queue; the rest are deleted
+    return({"batchItemFailures": [{"itemIdentifier": message_id} for message_id in retries]})
+
+def parse_records(records):
+    '''
+    Group the queued CreateAccountResult events by account, so an account queued twice in one batch
+    is only configured once. Returns {(account_id, audit_only): {"message_ids": [...], "record": ..., "body": ...}},
+    where record and body are those of the message that got furthest (one with a run in_progress, if any).
+    Messages that aren't for a successfully created account are logged and dropped.
+    '''
+    accounts = {}
+    for record in records:
+        try:
+            body = json.loads(record['body'])
+            status = body['detail']['serviceEventDetails']['createAccountStatus']
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Dropping message {record['messageId']}: not a CreateAccountResult event ({e})")
+            continue
+        if status['state'] != "SUCCEEDED":
+            logger.warning(f"Dropping message {record['messageId']}: account creation is {status['state']}")
+            continue
+        queued = accounts.setdefault((status['accountId'], bool(body.get('audit_only', False))), {"message_ids": []})
+        queued['message_ids'].append(record['messageId'])
+        if 'body' not in queued or 'in_progress' in body:
+            queued.update(record=record, body=body)
+    return(accounts)
+
+def dispatch(records, global_config=None, context=None, requeue=None):
+    '''
+    Configure every account in a batch of queue records, DISPATCH_WORKERS at a time, stopping short of
+    the invocation's timeout when given the Lambda context.
+
+    An account with a retry pending is handed to requeue(record, body, wait_seconds) to queue a new
+    message, whose body carries the run so far (in_progress) or, when the account wasn't ready to
+    start, how many times it has been tried (dispatch_attempt). Its messages are then done with, so
+    an account can wait for its regions as long as the state machine would, and never starts over.
+    Returns {message id: seconds to wait, or None for the queue's default} for the messages to leave
+    on the queue: failures, and retries requeue couldn't send.
+    '''
+    accounts = parse_records(records)
+    if not accounts:
+        return({})
+
+    # Fetched once for the whole batch (and cached for the rest of the warm container)
+    if global_config is None:
+        global_config = LoadConfigurationLambdaFunction.get_config(os.environ['BUCKET'], os.environ['CONFIG_FILE'])
+    if global_config is None:
+        logger.critical(f"Unable to load the config; leaving {len(records)} messages on the queue")
+        return({message_id: None for queued in accounts.values() for message_id in queued['message_ids']})
+
+    retries = {}
+    for audit_only in (False, True):
+        queued = {account_id: accounts[(account_id, audit)] for account_id, audit in accounts if audit == audit_only}
+        if not queued:
+            continue
+        summary = Backfill.backfill(list(queued), global_config, workers=DISPATCH_WORKERS, audit_only=audit_only,
+                                    max_retries=DISPATCH_MAX_RETRIES, context=context,
+                                    events={a: q['body']['in_progress'] for a, q in queued.items() if 'in_progress' in q['body']})
+        logger.info(f"Dispatched {len(queued)} accounts{' (audit only)' if audit_only else ''}: {summary['outcomes']} in {summary['wall_seconds']}s")
+        for result in summary['results']:
+            if result['outcome'] == "succeeded":
+                continue
+            message = queued[result['account_id']]
+            if result['outcome'] == "retry_pending":
+                body = dict(message['body'], in_progress=result['event'])
+                wait_seconds = result['pending']['wait_seconds']
+            elif result['outcome'] == "not_ready":
+                attempt = message['body'].get('dispatch_attempt', 0) + 1
+                body = dict(message['body'], dispatch_attempt=attempt)
+                wait_seconds = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+            else:
+                # Failed; the queue's redrive policy sends it to the dead-letter queue after enough of these
+                body, wait_seconds = None, None
+            if body is not None and requeue is not None:
+                try:
+                    requeue(message['record'], body, wait_seconds)
+                    continue
+                except Exception as e:
+                    logger.warning(f"Unable to requeue {result['account_id']}, leaving its messages on the queue: {e}")
+            for message_id in message['message_ids']:
+                retries[message_id] = wait_seconds
+    return(retries)
+
+def queue_url(record):
+    '''The URL of the SQS queue a record came from'''
+    # arn:aws:sqs:<region>:<account_id>:<queue name>
+    _, _, _, region, account_id, name = record['eventSourceARN'].split(':')
+    return(region, f"https://sqs.{region}.amazonaws.com/{account_id}/{name}")
+
+def requeue_message(record, body, wait_seconds):
+    '''Queue body as a new message on record's queue, delayed by wait_seconds (at most MAX_DELAY_SECONDS)'''
+    region, url = queue_url(record)
+    get_local_client('sqs', region).send_message(QueueUrl=url, MessageBody=json.dumps(body, default=str),
+                                                 DelaySeconds=min(MAX_DELAY_SECONDS, int(wait_seconds)))
+
+def delay_message(record, wait_seconds):
+    '''Hide a message we're leaving on the SQS queue for wait_seconds, instead of the whole visibility timeout'''
+    region, url = queue_url(record)
+    try:
+        get_local_client('sqs', region).change_message_visibility(
+            QueueUrl=url,
+            ReceiptHandle=record['receiptHandle'],
+            VisibilityTimeout=int(wait_seconds))
+    except Exception as e:
+        # The message still comes back, after the queue's visibility timeout
+        logger.warning(f"Unable to shorten the retry of message {record['messageId']} to {wait_seconds}s: {e}")
+
+
+class LocalQueue(object):
+    '''
+    In-memory stand-in for the ingestion queue, to run the dispatcher without SQS (see drain()).
+    Messages that aren't deleted become visible again, and go to dead_letters once they have been
+    received max_receives times, like the queue's redrive policy. Retry delays aren't simulated, and
+    requeued messages are new messages, as in SQS.
+    '''
+
+    def __init__(self, max_receives=5):
+        self.max_receives = max_receives
+        self.lock = threading.Lock()
+        self.visible = []
+        self.in_flight = {}
+        self.dead_letters = []
+
+    def send(self, body):
+        '''Queue body (a dict) as the EventBridge target would, and return its message id'''
+        message = {
+            'messageId': str(uuid.uuid4()),
+            'receiptHandle': str(uuid.uuid4()),
+            'body': json.dumps(body),
+            'attributes': {'ApproximateReceiveCount': '0'},
+            'eventSourceARN': 'arn:aws:sqs:local:000000000000:local-queue',
+        }
+        with self.lock:
+            self.visible.append(message)
+        return(message['messageId'])
+
+    def receive(self, max_messages=10):
+        '''Return up to max_messages records, in the shape of a Lambda SQS event's Records'''
+        with self.lock:
+            batch, self.visible = self.visible[:max_messages], self.visible[max_messages:]
+            for message in batch:
+                message['attributes']['ApproximateReceiveCount'] = str(int(message['attributes']['ApproximateReceiveCount']) + 1)
+                self.in_flight[message['messageId']] = message
+        return(batch)
+
+    def delete(self, message_ids):
+        with self.lock:
+            for message_id in message_ids:
+                self.in_flight.pop(message_id, None)
+
+    def release(self, message_ids):
+        '''Put received messages back on the queue, or on dead_letters once they've used up max_receives'''
+        with self.lock:
+            for message_id in message_ids:
+                message = self.in_flight.pop(message_id)
+                if int(message['attributes']['ApproximateReceiveCount']) >= self.max_receives:
+                    self.dead_letters.append(message)
+                else:
+                    self.visible.append(message)
+
+    def __len__(self):
+        with self.lock:
+            return(len(self.visible) + len(self.in_flight))
+
+
+def drain(queue, batch_size=10, concurrency=2, global_config=None):
+    '''
+    Dispatch batches from queue (e.g. a LocalQueue) until it's empty, with up to concurrency batches
+    in flight, like the SQS event source mapping's BatchSize and MaximumConcurrency.
+    Returns a summary of the batches and messages processed.
+    '''
+    stats = {'batches': 0, 'messages': 0, 'retried': 0, 'requeued': 0}
+    stats_lock = threading.Lock()
+
+    def worker():
+        while True:
+            batch = queue.receive(batch_size)
+            if not batch:
+                return
+            requeued = []
+            retries = dispatch(batch, global_config, requeue=lambda record, body, wait_seconds: requeued.append(queue.send(body)))
+            queue.delete([m['messageId'] for m in batch if m['messageId'] not in retries])
+            queue.release(list(retries))
+            with stats_lock:
+                stats['batches'] += 1
+                stats['messages'] += len(batch)
+                stats['retried'] += len(retries)
+                stats['requeued'] += len(requeued)
+
+    threads = [threading.Thread(target=worker, name=f"dispatcher-{i}") for i in range(max(1, concurrency))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats['dead_letters'] = len(queue.dead_letters)
+    return(stats)
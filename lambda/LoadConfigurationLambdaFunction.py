@@ -12,15 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import boto3
 from botocore.exceptions import ClientError
+from datetime import datetime, timezone
 from urllib.parse import unquote
 import json
 import os
-import yaml
-from yaml import Loader, Dumper
+import hashlib
+import time
+import uuid
 
-from common import targets_local_account
+from common import targets_local_account, get_credentials, discover_regions, new_progress, log_event, RetryAfterDelay
+from common import get_local_client, set_metric_context, record_metrics, flush_metrics, profiled, backoff_seconds, REGION_MAX_ATTEMPTS
 
 import logging
 logger = logging.getLogger()
@@ -30,54 +32,229 @@ logging.getLogger('boto3').setLevel(logging.WARNING)
 logging.getLogger('urllib3').setLevel(logging.WARNING)
 
 # Lambda main routine
+@profiled
 def handler(event, context):
-    logger.info(f"Received event: {json.dumps(event, sort_keys=True)}")
+    log_event(event)
+
+    # The ParallelStateMachine hands back an event whose regions couldn't be discovered yet
+    if 'global_config' in event:
+        set_metric_context(event['new_aws_account_id'], 'LoadConfigurationLambdaFunction')
+        try:
+            return(retry_discovery(event))
+        finally:
+            flush_metrics()
 
     if event['detail']['serviceEventDetails']['createAccountStatus']['state'] != "SUCCEEDED":
         logger.critical(f"AWS Account is not in a SUCCEEDED state: {json.dumps(event['detail']['serviceEventDetails'])}")
         raise
 
-    # Fetch the config file
-    global_config = get_config(os.environ['BUCKET'], os.environ['CONFIG_FILE'])
-
     # Parse the Event
     new_aws_account_id = event['detail']['serviceEventDetails']['createAccountStatus']['accountId']
+    set_metric_context(new_aws_account_id, 'LoadConfigurationLambdaFunction')
+    start = time.monotonic()
+    try:
+        # Fetch the config file
+        global_config = get_config(os.environ['BUCKET'], os.environ['CONFIG_FILE'])
+
+        # Set "audit_only": true in the triggering event to only report drift, without changing anything
+        new_event = build_event(new_aws_account_id, global_config, audit_only=bool(event.get('audit_only', False)))
+        record_metrics('step', {}, StepDuration=((time.monotonic() - start) * 1000, 'Milliseconds'))
+        return(new_event)
+    finally:
+        flush_metrics()
+
+def build_event(new_aws_account_id, global_config, audit_only=False):
+    '''Return the event the configuration steps expect for new_aws_account_id'''
     cross_account_role_arn = f"arn:aws:iam::{new_aws_account_id}:role/{os.environ['ROLE_NAME']}"
 
     # Verify AssumeRole works -- but skip when the target is the account this Lambda runs in
     # (e.g. the org management account), where the configurator acts locally without AssumeRole.
     if not targets_local_account(cross_account_role_arn):
-        client = boto3.client('sts')
         try:
-            client.assume_role(RoleArn=cross_account_role_arn, RoleSessionName=os.environ['ROLE_SESSION_NAME'])
+            # Goes through the shared credential cache, so later steps in this container reuse it
+            get_credentials(cross_account_role_arn)
         except ClientError as e:
             logger.critical(f"Failed to assume role {cross_account_role_arn} in account {new_aws_account_id} : {e.response['Error']['Code']}")
             raise
     else:
         logger.info(f"Target {new_aws_account_id} is the local account; skipping the AssumeRole sanity check")
 
+    # The human-readable messages list is only rendered at the end (SummarizeResults); until then the
+    # steps record compact per-step, per-region results in progress.
     new_event = {
+        # Identify the run, and when it started, in the run history
+        "run_id": uuid.uuid4().hex[:16],
+        "started_at": datetime.now(timezone.utc).isoformat(),
         "global_config": global_config,
+        "config_version": global_config.get('config_version') if global_config else None,
         "new_aws_account_id": new_aws_account_id,
         "cross_account_role_arn": cross_account_role_arn,
-        "messages": []
+        "audit_only": audit_only,
+        # Until the regions are discovered, only the region_filter is carried, for the steps to apply
+        "regions": {"filter": global_config.get('region_filter') if global_config else None},
+        "progress": new_progress()
     }
+
+    # Discover the regions once for the whole execution, leaving out the ones the region_filter (or an
+    # SCP) excludes. If the account isn't fully enabled yet we leave them out, and the regional steps
+    # query (and RetryAfterDelay) themselves, or the ParallelStateMachine waits regions.retry out.
+    try:
+        new_event['regions'] = discover_regions(cross_account_role_arn, new_event['regions']['filter'])
+    except RetryAfterDelay:
+        logger.warning(f"Account {new_aws_account_id} is not fully enabled yet; regions will be discovered later")
+        new_event['regions']['retry'] = {"attempt": 1, "wait_seconds": backoff_seconds(1)}
     return(new_event)
 
+def retry_discovery(event):
+    '''
+    Try again to discover the regions of an event build_event couldn't. Until the account is ready,
+    event['regions']['retry'] says how long to wait before the next try, backing off like a step's
+    pending regions, and the RetryAfterDelay is raised once REGION_MAX_ATTEMPTS tries have failed.
+    '''
+    regions = event['regions']
+    if regions.get('region_names'):
+        return(event)
+    try:
+        event['regions'] = discover_regions(event['cross_account_role_arn'], regions.get('filter'))
+    except RetryAfterDelay:
+        attempt = (regions.get('retry') or {}).get('attempt', 0) + 1
+        if attempt >= REGION_MAX_ATTEMPTS:
+            logger.critical(f"Account {event['new_aws_account_id']} is still not fully enabled after {attempt} tries")
+            raise
+        regions['retry'] = {"attempt": attempt, "wait_seconds": backoff_seconds(attempt)}
+        logger.warning(f"Account {event['new_aws_account_id']} is not fully enabled yet; trying again in {regions['retry']['wait_seconds']}s")
+    return(event)
+
+# Parsed configs by (bucket, key, form), with the ETag they were fetched at. Within CONFIG_CACHE_SECONDS a
+# warm container uses the cached config without asking S3; after that it revalidates with a
+# conditional GET, which only downloads and parses the object again when the ETag has changed.
+CONFIG_CACHE_SECONDS = int(os.environ.get('CONFIG_CACHE_SECONDS', 60))
+_CONFIG_CACHE = {}
+_S3_CLIENT = None
+
+# Settings the configurator knows about, and the password_policy keys that must all be present
+CONFIG_SECTIONS = ['account_password_policy', 'default_vpc', 'enable_ebs_default_encryption',
+                   'enable_ebs_block_public_access', 'enable_account_s3_block_public_access', 'require_imdsv2',
+                   'region_filter']
+PASSWORD_POLICY_KEYS = ['MinimumPasswordLength', 'RequireSymbols', 'RequireNumbers', 'RequireUppercaseCharacters',
+                        'RequireLowercaseCharacters', 'AllowUsersToChangePassword', 'MaxPasswordAge',
+                        'PasswordReusePrevention', 'HardExpiry']
+
 def get_config(bucket, obj_key):
-    '''get the object to index from S3 and return the parsed json'''
-    s3 = boto3.client('s3')
+    '''
+    Return the parsed config. Prefers the pre-compiled JSON (the config key with a .json extension,
+    published by make push-config) and falls back to parsing the YAML. The JSON is only used while it
+    validates and was compiled from the YAML that's in the bucket now, so editing the YAML by hand
+    can't leave the Lambda on a stale config.
+    '''
+    yaml_key = unquote(obj_key)
+    json_key = os.path.splitext(yaml_key)[0] + ".json"
+    if json_key != yaml_key:
+        try:
+            compiled = fetch_config(bucket, json_key, parse_compiled)
+        except ValueError as e:
+            logger.error(f"Ignoring s3://{bucket}/{json_key}: {e}")
+            compiled = None
+        if compiled is not None:
+            source_sha256, config = compiled
+            # Only the YAML's digest is cached, and it's only downloaded again when its ETag changes
+            current_sha256 = fetch_config(bucket, yaml_key, lambda body: hashlib.sha256(body).hexdigest(), form='sha256')
+            if current_sha256 is None or current_sha256 == source_sha256:
+                return(config)
+            logger.warning(f"s3://{bucket}/{json_key} wasn't compiled from the current s3://{bucket}/{yaml_key}, using the YAML. "
+                           "Run make push-config to publish both.")
+    return(fetch_config(bucket, yaml_key, lambda body: resolve_config(parse_yaml(body))))
+
+def compile_config(body, strict=False):
+    '''The resolved config from a YAML config body, with the digest of the body it was compiled from'''
+    config = resolve_config(parse_yaml(body), strict=strict)
+    if config is not None:
+        config['compiled_from'] = {'sha256': hashlib.sha256(body).hexdigest()}
+    return(config)
+
+def parse_compiled(body):
+    '''The source YAML's digest and the validated config from a compiled JSON config'''
+    config = json.loads(body)
+    source = (config or {}).pop('compiled_from', None) or {}
+    return((source.get('sha256'), resolve_config(config)))
+
+def parse_yaml(body):
+    '''PyYAML is only imported when there's no pre-compiled JSON config to read'''
+    import yaml
     try:
-        response = s3.get_object(
-            Bucket=bucket,
-            Key=unquote(obj_key)
-        )
-        return(yaml.load(response['Body'].read(), Loader=Loader))
+        # libyaml's C parser when PyYAML was built with it
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
+    return(yaml.load(body, Loader=SafeLoader))
+
+def fetch_config(bucket, key, parse, form='config'):
+    '''
+    get the object from S3 (or the warm-container cache) and return it parsed with parse(). form
+    names what parse() makes of the object, so one key can be cached in more than one form.
+    '''
+    cached = _CONFIG_CACHE.get((bucket, key, form))
+    if cached is not None and time.monotonic() - cached['fetched'] < CONFIG_CACHE_SECONDS:
+        return(cached['config'])
+
+    global _S3_CLIENT
+    if _S3_CLIENT is None:
+        _S3_CLIENT = get_local_client('s3')
+    kwargs = {'Bucket': bucket, 'Key': key}
+    if cached is not None and cached['etag'] is not None:
+        kwargs['IfNoneMatch'] = cached['etag']
+    try:
+        response = _S3_CLIENT.get_object(**kwargs)
+        config = parse(response['Body'].read())
+        _CONFIG_CACHE[(bucket, key, form)] = {'etag': response['ETag'], 'config': config, 'fetched': time.monotonic()}
+        return(config)
     except ClientError as e:
+        if e.response['Error']['Code'] in ('304', 'NotModified'):
+            cached['fetched'] = time.monotonic()
+            return(cached['config'])
         if e.response['Error']['Code'] == 'NoSuchKey':
-            logger.error("Unable to find config s3://{}/{}".format(bucket, obj_key))
+            logger.info("Unable to find config s3://{}/{}".format(bucket, key))
+            # Remember that it's missing so we don't look for it on every invocation
+            _CONFIG_CACHE[(bucket, key, form)] = {'etag': None, 'config': None, 'fetched': time.monotonic()}
         else:
-            logger.error("Error getting config s3://{}/{}: {}".format(bucket, obj_key, e))
+            logger.error("Error getting config s3://{}/{}: {}".format(bucket, key, e))
+        return(None)
+
+def resolve_config(config, strict=False):
+    '''
+    Validate a parsed config and return it in the resolved form the steps expect, with a
+    config_version hash of its contents. Raises ValueError listing every problem. Sections the
+    configurator doesn't know about are only logged, unless strict (as compile-config.py is).
+    '''
+    if config is None:
         return(None)
+    errors = []
+    for section in config:
+        if section not in CONFIG_SECTIONS and section != 'config_version':
+            if strict:
+                errors.append(f"Unknown config section {section}")
+            else:
+                logger.warning(f"Ignoring unknown config section {section}")
+    if (config.get('account_password_policy') or {}).get('update_account_password_policy'):
+        missing = [k for k in PASSWORD_POLICY_KEYS if k not in (config['account_password_policy'].get('password_policy') or {})]
+        if missing:
+            errors.append(f"account_password_policy.password_policy is missing {missing}")
+    if config.get('default_vpc') is not None:
+        config['default_vpc'].setdefault('preserve_vpc_regions', [])
+        if not isinstance(config['default_vpc']['preserve_vpc_regions'], list):
+            errors.append("default_vpc.preserve_vpc_regions must be a list")
+    if config.get('region_filter') is not None:
+        for key in ('allow_regions', 'deny_regions'):
+            config['region_filter'].setdefault(key, [])
+            if not isinstance(config['region_filter'][key], list):
+                errors.append(f"region_filter.{key} must be a list")
+        config['region_filter'].setdefault('probe_denied_regions', False)
+    if errors:
+        raise ValueError("Invalid config: " + "; ".join(errors))
 
-#EOF
\ No newline at end of file
+    # Every section is present, so the state machines can always hand a step its own section
+    for section in CONFIG_SECTIONS:
+        config.setdefault(section, None)
+    config.pop('config_version', None)
+    config['config_version'] = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+    return(config)
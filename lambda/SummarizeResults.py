@@ -12,15 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from botocore.exceptions import ClientError
-from urllib.parse import unquote
-from yaml import Loader, Dumper
-import boto3
-import json
 import os
-import yaml
 
-from common import *
+from common import log_event, merge_results, new_progress, profiled, record_run_history, render_messages
 
 import logging
 logger = logging.getLogger()
@@ -30,19 +24,17 @@ logging.getLogger('boto3').setLevel(logging.WARNING)
 logging.getLogger('urllib3').setLevel(logging.WARNING)
 
 # Lambda main routine
+@profiled
 def handler(event, context):
-    logger.info(f"Received event: {json.dumps(event, sort_keys=True)}")
-
-    if not event['global_config'].get('enable_ebs_default_encryption'):
-        # Not configured, or explicitly disabled (false)
-        return(event)
-
-    regions = get_regions(event['cross_account_role_arn'])
-
-    for r in regions:
-        client = get_client('ec2', event['cross_account_role_arn'], region=r)
-        logger.info(f"Applying EBS Default Encryption in {r} in {event['new_aws_account_id']}")
-        event['messages'].append(f"Applying EBS Default Encryption in {r} in {event['new_aws_account_id']}")
-        client.enable_ebs_encryption_by_default()
-
-    return(event)
\ No newline at end of file
+    log_event(event)
+
+    # ParallelStateMachine hands us its branch results (and the Map's per-region results) to merge
+    progress = event.setdefault('progress', new_progress())
+    if 'parallel_results' in event:
+        progress['results'] = merge_results(progress['results'], *[r['results'] for r in event.pop('parallel_results')])
+
+    event['messages'] = render_messages(event)
+    for message in event['messages']:
+        logger.info(message)
+    record_run_history(event)
+    return(event)
@@ -12,56 +12,485 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from botocore.exceptions import ClientError
-from urllib.parse import unquote
-from yaml import Loader, Dumper
-import boto3
+# boto3 and botocore.config pull in most of botocore, so they're imported when the first client
+# is built rather than when a handler is loaded. botocore.exceptions is cheap.
+from botocore.exceptions import ClientError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import functools
 import json
 import os
-import yaml
+import sys
+import threading
+import time
 import logging
 
+import ledger
+import regional_settings
+import run_history
+
 logger = logging.getLogger()
 
 # Cache the account this Lambda runs in, so we can detect when a target is "local"
 # (e.g. the org management account) and skip the cross-account AssumeRole.
 _LOCAL_ACCOUNT_ID = None
+# Every region thread asks at once, and only one of them should call GetCallerIdentity
+_LOCAL_ACCOUNT_LOCK = threading.Lock()
 
 
 def targets_local_account(cross_account_role_arn):
     """True when the role ARN points at the account this Lambda is running in."""
     global _LOCAL_ACCOUNT_ID
-    if _LOCAL_ACCOUNT_ID is None:
-        _LOCAL_ACCOUNT_ID = boto3.client('sts').get_caller_identity()['Account']
+    with _LOCAL_ACCOUNT_LOCK:
+        if _LOCAL_ACCOUNT_ID is None:
+            _LOCAL_ACCOUNT_ID = get_sts_client().get_caller_identity()['Account']
     # arn:aws:iam::<account_id>:role/<name>
     return cross_account_role_arn.split(':')[4] == _LOCAL_ACCOUNT_ID
 
 
-def get_client(type, cross_account_role_arn, region=None):
+# The boto3 session isn't thread-safe while it builds clients, so the region executor
+# serializes client creation. The clients themselves are safe to use concurrently.
+_CLIENT_LOCK = threading.Lock()
+
+# Clients handed out by get_client, keyed by (type, region, account, AccessKeyId) so every step in a warm
+# container (or in the FastPathRunner) reuses them, least recently used first. Each one holds a pool of
+# keep-alive connections, so only CLIENT_CACHE_SIZE are kept. A role's clients are closed when its
+# credentials are refreshed, and an account's when release_account() says we're done with it.
+CLIENT_CACHE_SIZE = int(os.environ.get('CLIENT_CACHE_SIZE', 256))
+_CLIENT_CACHE = OrderedDict()
+
+# Every client retries with botocore's adaptive mode: jittered exponential backoff, plus client-side
+# rate reduction once the service starts throttling.
+API_MAX_ATTEMPTS = int(os.environ.get('API_MAX_ATTEMPTS', 10))
+_CLIENT_CONFIG = None
+
+# botocore waits 60s to connect and 60s for each read. Much tighter timeouts make a degraded or
+# unreachable regional endpoint fail (and retry) fast, instead of one call eating the region's budget.
+CONNECT_TIMEOUT_SECONDS = float(os.environ.get('CONNECT_TIMEOUT_SECONDS', 5))
+READ_TIMEOUT_SECONDS = float(os.environ.get('READ_TIMEOUT_SECONDS', 20))
+
+# One boto3 session for the process, built on first use. Its loader caches the parsed service models
+# and endpoint rules, so only the first client of each service pays to load them; every later client,
+# in any region or account, reuses them for the life of the container.
+_SESSION = None
+
+# Error codes AWS uses when it throttles us
+THROTTLE_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException',
+                  'RequestThrottled', 'RequestThrottledException', 'SlowDown')
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket: acquire() blocks until a token is available, and returns how long it waited"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return(waited)
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+# Requests/second per API in each account and region, which is how AWS throttles them. API_RATE_LIMITS
+# is a JSON object of "service" or "service.Operation" -> rate, e.g. {"ec2": 50, "sts.AssumeRole": 10};
+# the most specific entry wins.
+API_RATE_LIMITS = {'ec2': 50, 'sts': 20, 'iam': 10, 's3control': 10, 's3': 50}
+API_RATE_LIMITS.update(json.loads(os.environ.get('API_RATE_LIMITS', '{}')))
+_RATE_LIMITERS = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+API_STATS = {'calls': 0, 'throttles': 0, 'rate_limit_wait_seconds': 0.0, 'throttles_by_operation': {}}
+_API_STATS_LOCK = threading.Lock()
+
+# API calls, and the retries among them, made for the unit (a step in one region) each thread is working on
+_UNIT_STATS = threading.local()
+
+
+# CloudWatch Embedded Metric Format (EMF) telemetry. Every API call, region and step is timed into an
+# in-memory buffer, and flush_metrics() writes it as a few EMF log lines when a step finishes, so the
+# per-call cost is a dict update. On by default in Lambda; EMIT_METRICS=true/false overrides that.
+# Account is on every line, but is only a dimension of StepDuration, so the number of custom
+# metrics doesn't grow with every API call in every new account.
+EMIT_METRICS = os.environ.get('EMIT_METRICS', str('AWS_LAMBDA_FUNCTION_NAME' in os.environ)).lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'AccountConfigurator')
+METRICS_STREAM = sys.stdout
+METRIC_DIMENSIONS = {
+    'api': [['Step', 'Region', 'Operation', 'Outcome'], ['Operation', 'Outcome']],
+    'region': [['Step', 'Region', 'Outcome'], ['Step', 'Outcome']],
+    'step': [['Account', 'Step'], ['Step']],
+    'invocation': [['Function']],
+}
+# EMF allows at most 100 values per metric in one log line
+EMF_MAX_VALUES = 100
+_METRICS = {}
+_METRICS_LOCK = threading.Lock()
+_METRIC_CONTEXT = threading.local()
+
+
+def unit_stats():
+    """A copy of the API calls and retries counted so far for the unit this thread is working on"""
+    counts = getattr(_UNIT_STATS, 'counts', None)
+    return(dict(counts) if counts else {'calls': 0, 'retries': 0})
+
+
+def bind_unit(func):
     """
-    Returns a boto3 client for the service "type" with credentials in the target account.
-    Optionally you can specify the region for the client and the session_name for the AssumeRole.
+    Wraps func to run on another thread as part of the unit this thread is working on: with the same
+    metric labels, counted towards the same API calls, and under the same region deadline.
     """
-    if targets_local_account(cross_account_role_arn):
-        # Target is the account this Lambda runs in (e.g. the org management account);
-        # use the Lambda's own role directly -- no AssumeRole.
-        return boto3.client(type, region_name=region)
-    client = boto3.client('sts')
-    try:
-        session = client.assume_role(RoleArn=cross_account_role_arn, RoleSessionName=os.environ['ROLE_SESSION_NAME'])
-        creds = session['Credentials']  # Save for later
-    except ClientError as e:
-        logger.critical(f"Failed to assume role {cross_account_role_arn}: {e.response['Error']['Code']}")
-        return(None)
-    client = boto3.client(type,
-        aws_access_key_id = creds['AccessKeyId'],
-        aws_secret_access_key = creds['SecretAccessKey'],
-        aws_session_token = creds['SessionToken'],
-        region_name = region)
+    labels = [getattr(_METRIC_CONTEXT, k, None) for k in ('account', 'step', 'region')]
+    counts = getattr(_UNIT_STATS, 'counts', None)
+    deadline = getattr(_REGION_DEADLINE, 'at', None)
+    invocation = getattr(_REGION_DEADLINE, 'invocation', False)
+
+    def bound(*args, **kwargs):
+        set_metric_context(*labels)
+        _UNIT_STATS.counts = counts
+        _REGION_DEADLINE.at = deadline
+        _REGION_DEADLINE.invocation = invocation
+        try:
+            return(func(*args, **kwargs))
+        finally:
+            _UNIT_STATS.counts = None
+            _REGION_DEADLINE.at = None
+            _REGION_DEADLINE.invocation = False
+    return(bound)
+
+
+def set_metric_context(account, step, region=None):
+    """Labels the metrics this thread records from now on with the account, step and region it's working on"""
+    _METRIC_CONTEXT.account = account
+    _METRIC_CONTEXT.step = step
+    _METRIC_CONTEXT.region = region
+
+
+def record_metrics(family, dimensions, **metrics):
+    """Buffers metrics (name=(value, unit)) under the family's dimension sets until the next flush_metrics()"""
+    if not EMIT_METRICS:
+        return
+    dimensions = {'Account': getattr(_METRIC_CONTEXT, 'account', None) or 'unknown',
+                  'Step': getattr(_METRIC_CONTEXT, 'step', None) or 'unknown', **dimensions}
+    key = (family, tuple(sorted(dimensions.items())))
+    with _METRICS_LOCK:
+        buffered = _METRICS.setdefault(key, {})
+        for name, (value, unit) in metrics.items():
+            buffered.setdefault(name, (unit, []))[1].append(round(value, 3))
+
+
+def flush_metrics():
+    """Writes the buffered metrics as EMF log lines, one per set of dimension values"""
+    with _METRICS_LOCK:
+        buffered = dict(_METRICS)
+        _METRICS.clear()
+    timestamp = int(time.time() * 1000)
+    for (family, dimensions), metrics in buffered.items():
+        longest = max(len(values) for unit, values in metrics.values())
+        for i in range(0, longest, EMF_MAX_VALUES):
+            chunk = {name: (unit, values[i:i + EMF_MAX_VALUES]) for name, (unit, values) in metrics.items() if values[i:i + EMF_MAX_VALUES]}
+            document = {"_aws": {"Timestamp": timestamp, "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": METRIC_DIMENSIONS[family],
+                "Metrics": [{"Name": name, "Unit": unit} for name, (unit, values) in chunk.items()]
+            }]}}
+            document.update(dimensions)
+            document.update({name: values for name, (unit, values) in chunk.items()})
+            METRICS_STREAM.write(json.dumps(document) + "\n")
+    METRICS_STREAM.flush()
+
+
+# Opt-in profiling of every handler invocation (PROFILE=true), to size each function's MemorySize with
+# scripts/memory-report.py. Each invocation writes one "invocation_profile" JSON line to METRICS_STREAM
+# with the process's peak RSS, the peak memory tracemalloc traced during the invocation, the
+# PROFILE_TOP_ALLOCATIONS source lines holding the most of it at the end, and its CPU and wall time.
+# tracemalloc slows every allocation down, which inflates the CPU time too; PROFILE_TOP_ALLOCATIONS=0
+# leaves it off, for profiles of just RSS and CPU.
+PROFILE = os.environ.get('PROFILE', 'false').lower() == 'true'
+PROFILE_TOP_ALLOCATIONS = int(os.environ.get('PROFILE_TOP_ALLOCATIONS', 10))
+_PROFILE_LOCK = threading.Lock()
+_PROFILE_STATE = {'active': False, 'invocations': 0}
+
+
+def profiled(handler):
+    """
+    Decorates a Lambda handler to profile its invocations when PROFILE is on. Only the outermost
+    handler is profiled, so the steps FastPathRunner calls in-process count towards its profile.
+    """
+    if not PROFILE:
+        return(handler)
+
+    def wrapper(event, context):
+        with _PROFILE_LOCK:
+            outermost = not _PROFILE_STATE['active']
+            _PROFILE_STATE['active'] = True
+        if not outermost:
+            return(handler(event, context))
+
+        import resource
+        import tracemalloc
+        if PROFILE_TOP_ALLOCATIONS:
+            tracemalloc.start()
+        cpu_start = time.process_time()
+        start = time.monotonic()
+        error = None
+        try:
+            return(handler(event, context))
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            wall_ms = (time.monotonic() - start) * 1000
+            cpu_ms = (time.process_time() - cpu_start) * 1000
+            traced_peak = None
+            top_allocations = []
+            if PROFILE_TOP_ALLOCATIONS:
+                traced_peak = round(tracemalloc.get_traced_memory()[1] / 1048576, 2)
+                snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+                tracemalloc.stop()
+                top_allocations = [{"where": f"{'/'.join(stat.traceback[0].filename.split(os.sep)[-2:])}:{stat.traceback[0].lineno}",
+                                    "kb": round(stat.size / 1024, 1), "count": stat.count}
+                                   for stat in snapshot.statistics('lineno')[:PROFILE_TOP_ALLOCATIONS]]
+            with _PROFILE_LOCK:
+                _PROFILE_STATE['active'] = False
+                _PROFILE_STATE['invocations'] += 1
+                cold_start = _PROFILE_STATE['invocations'] == 1
+            function = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', handler.__module__)
+            # ru_maxrss is in KB on Linux, and is the peak for the life of the process (the container)
+            peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            profile = {
+                "type": "invocation_profile",
+                "function": function,
+                "handler": handler.__module__,
+                "memory_size_mb": int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 0)) or None,
+                "cold_start": cold_start,
+                "error": error,
+                "peak_rss_mb": round(peak_rss_mb, 1),
+                "traced_peak_mb": traced_peak,
+                "cpu_ms": round(cpu_ms, 1),
+                "wall_ms": round(wall_ms, 1),
+                "top_allocations": top_allocations,
+            }
+            METRICS_STREAM.write(json.dumps(profile) + "\n")
+            record_metrics('invocation', {'Function': function}, PeakRSS=(peak_rss_mb, 'Megabytes'), CPUTime=(cpu_ms, 'Milliseconds'))
+            flush_metrics()
+
+    wrapper.__name__ = handler.__name__
+    wrapper.__doc__ = handler.__doc__
+    return(wrapper)
+
+
+def _check_region_deadline(event_name, **kwargs):
+    # before-call and before-send; a region past its budget makes no more calls, nor retry attempts
+    deadline = getattr(_REGION_DEADLINE, 'at', None)
+    if deadline is not None and time.monotonic() > deadline:
+        if getattr(_REGION_DEADLINE, 'invocation', False):
+            raise DeadlineReached(f"{getattr(_METRIC_CONTEXT, 'region', None)} stopped before {event_name.split('.', 1)[1]}: the invocation is close to its timeout")
+        raise RegionDeadlineExceeded(f"{getattr(_METRIC_CONTEXT, 'region', None)} went past its time budget before {event_name.split('.', 1)[1]}")
+
+
+def _start_api_timer(context=None, **kwargs):
+    # before-call; registered ahead of _rate_limit so the latency includes any rate limit wait
+    context['metrics_started'] = time.monotonic()
+
+
+def _record_api_call(event_name, context=None, http_response=None, parsed=None, exception=None, **kwargs):
+    # after-call.<service>.<Operation> with the final response (after retries), or after-call-error
+    counts = getattr(_UNIT_STATS, 'counts', None)
+    if counts is not None:
+        with _API_STATS_LOCK:
+            counts['calls'] += 1
+            counts['retries'] += context.get('retries', {}).get('attempt', 1) - 1
+    if not EMIT_METRICS or 'metrics_started' not in context:
+        return
+    if exception is not None:
+        outcome = type(exception).__name__
+    elif http_response.status_code >= 300:
+        outcome = parsed.get('Error', {}).get('Code', str(http_response.status_code))
+    else:
+        outcome = 'Success'
+    record_metrics('api', {'Region': context.get('client_region') or 'global', 'Operation': event_name.split('.', 1)[1], 'Outcome': outcome},
+                   ApiLatency=((time.monotonic() - context['metrics_started']) * 1000, 'Milliseconds'),
+                   ApiAttempts=(context.get('retries', {}).get('attempt', 1), 'Count'))
+
+
+def get_rate_limiter(service, operation, account=None, region=None):
+    """
+    Returns the TokenBucket for service.operation in account and region (None for the Lambda's own
+    account), or None when it isn't rate limited
+    """
+    for key in (f"{service}.{operation}", service):
+        if key in API_RATE_LIMITS:
+            with _RATE_LIMITERS_LOCK:
+                if (account, region, key) not in _RATE_LIMITERS:
+                    _RATE_LIMITERS[(account, region, key)] = TokenBucket(API_RATE_LIMITS[key])
+                return(_RATE_LIMITERS[(account, region, key)])
+    return(None)
+
+
+def _rate_limit(event_name, context=None, account=None, **kwargs):
+    # before-call.<service>.<Operation>; account is bound when the client is built
+    _, service, operation = event_name.split('.', 2)
+    limiter = get_rate_limiter(service, operation, account, context.get('client_region'))
+    waited = limiter.acquire() if limiter else 0.0
+    with _API_STATS_LOCK:
+        API_STATS['calls'] += 1
+        API_STATS['rate_limit_wait_seconds'] += waited
+
+
+def _count_throttles(event_name, response=None, **kwargs):
+    # needs-retry.<service>.<Operation>; returning None leaves the retry decision to botocore
+    if response is None:
+        return
+    code = response[1].get('Error', {}).get('Code')
+    if code in THROTTLE_CODES:
+        operation = event_name.split('.', 1)[1]
+        with _API_STATS_LOCK:
+            API_STATS['throttles'] += 1
+            API_STATS['throttles_by_operation'][operation] = API_STATS['throttles_by_operation'].get(operation, 0) + 1
+
+
+def get_session():
+    """Returns the process-wide boto3 session, importing boto3 the first time it's needed. Callers hold _CLIENT_LOCK."""
+    global _SESSION, _CLIENT_CONFIG
+    if _SESSION is None:
+        import boto3
+        from botocore.config import Config
+        _CLIENT_CONFIG = Config(retries={'mode': 'adaptive', 'total_max_attempts': API_MAX_ATTEMPTS},
+                                max_pool_connections=MAX_POOL_CONNECTIONS, tcp_keepalive=TCP_KEEPALIVE,
+                                connect_timeout=CONNECT_TIMEOUT_SECONDS, read_timeout=READ_TIMEOUT_SECONDS)
+        _SESSION = boto3.session.Session()
+        # STS clients with a region use that region's endpoint, in whichever partition it is (older botocore used the global one)
+        _SESSION._session.set_config_variable('sts_regional_endpoints', 'regional')
+        # Anything that still calls boto3.client() directly shares the same loaded models
+        boto3.DEFAULT_SESSION = _SESSION
+    return(_SESSION)
+
+
+def _new_client(type, region, account=None, **kwargs):
+    """
+    Build a boto3 client with the shared retry config, rate limiting and metrics hooked in.
+    account is the account its credentials are for, None for our own.
+    """
+    client = get_session().client(type, region_name=region, config=_CLIENT_CONFIG, **kwargs)
+    client.meta.events.register('before-call', _check_region_deadline)
+    client.meta.events.register('before-send', _check_region_deadline)
+    client.meta.events.register('before-call', _start_api_timer)
+    client.meta.events.register('before-call', functools.partial(_rate_limit, account=account))
+    client.meta.events.register('needs-retry', _count_throttles)
+    client.meta.events.register('after-call', _record_api_call)
+    client.meta.events.register('after-call-error', _record_api_call)
     return(client)
 
 
-def get_resource(type, cross_account_role_arn, region=None):
+def get_sts_client():
+    """
+    Returns an STS client for the Lambda's own credentials. When STS_REGION (or the Lambda's
+    AWS_REGION) is set we talk to that regional STS endpoint instead of the global one.
+    """
+    region = os.environ.get('STS_REGION', os.environ.get('AWS_REGION'))
+    with _CLIENT_LOCK:
+        return(_cached_client(('sts', region, None, None), lambda: _new_client('sts', region)))
+
+
+def _cached_client(key, build):
+    """Returns the cached client for key, or caches build(). Callers hold _CLIENT_LOCK."""
+    client = _CLIENT_CACHE.get(key)
+    if client is not None:
+        _CLIENT_CACHE.move_to_end(key)
+        return(client)
+    client = _CLIENT_CACHE[key] = build()
+    while len(_CLIENT_CACHE) > CLIENT_CACHE_SIZE:
+        _close_client(_CLIENT_CACHE.popitem(last=False)[1])
+    return(client)
+
+
+def _close_client(client):
+    # Closes the client's idle connections. A thread still using it just opens new ones.
+    try:
+        client.close()
+    except Exception as e:
+        logger.debug(f"Unable to close a {client.meta.service_model.service_name} client: {e}")
+
+
+def _drop_clients(match):
+    """Closes and forgets the cached clients whose (type, region, account, AccessKeyId) key match() is true for"""
+    with _CLIENT_LOCK:
+        for key in [key for key in _CLIENT_CACHE if match(key)]:
+            _close_client(_CLIENT_CACHE.pop(key))
+
+
+def release_account(account_id):
+    """
+    Forgets the clients, credentials and rate limiters of account_id, once we're done configuring it,
+    so a warm dispatcher or a backfill over thousands of accounts doesn't keep them all
+    """
+    _drop_clients(lambda key: key[2] == account_id)
+    with _CREDENTIAL_CACHE_LOCK:
+        for key in [key for key in _CREDENTIAL_LOCKS if key[0].split(':')[4] == account_id]:
+            _CREDENTIAL_CACHE.pop(key, None)
+            del _CREDENTIAL_LOCKS[key]
+    with _RATE_LIMITERS_LOCK:
+        for key in [key for key in _RATE_LIMITERS if key[0] == account_id]:
+            del _RATE_LIMITERS[key]
+
+
+# AssumeRole credentials, keyed by (role_arn, session_name). Shared by every client type and
+# region for the life of a warm container, and refreshed CREDENTIAL_REFRESH_SECONDS before expiry.
+CREDENTIAL_REFRESH_SECONDS = int(os.environ.get('CREDENTIAL_REFRESH_SECONDS', 300))
+_CREDENTIAL_CACHE = {}
+_CREDENTIAL_CACHE_LOCK = threading.Lock()
+# One lock per key, held across the AssumeRole so only one thread makes it, without holding up other roles
+_CREDENTIAL_LOCKS = {}
+CREDENTIAL_CACHE_STATS = {'hits': 0, 'misses': 0}
+
+
+def get_credentials(cross_account_role_arn, session_name=None):
+    """
+    Returns the AssumeRole Credentials dict for cross_account_role_arn. Cached credentials are
+    reused until they are within CREDENTIAL_REFRESH_SECONDS of expiring. Raises ClientError if
+    the AssumeRole fails.
+    """
+    if session_name is None:
+        session_name = os.environ['ROLE_SESSION_NAME']
+    key = (cross_account_role_arn, session_name)
+    with _CREDENTIAL_CACHE_LOCK:
+        lock = _CREDENTIAL_LOCKS.setdefault(key, threading.Lock())
+    with lock:
+        with _CREDENTIAL_CACHE_LOCK:
+            creds = _CREDENTIAL_CACHE.get(key)
+            if creds is not None and creds['Expiration'] - datetime.now(timezone.utc) > timedelta(seconds=CREDENTIAL_REFRESH_SECONDS):
+                CREDENTIAL_CACHE_STATS['hits'] += 1
+                return(creds)
+            CREDENTIAL_CACHE_STATS['misses'] += 1
+        session = get_sts_client().assume_role(RoleArn=cross_account_role_arn, RoleSessionName=session_name)
+        with _CREDENTIAL_CACHE_LOCK:
+            _CREDENTIAL_CACHE[key] = session['Credentials']
+        logger.debug(f"AssumeRole into {cross_account_role_arn} (credential cache: {CREDENTIAL_CACHE_STATS})")
+    if creds is not None:
+        # The clients built with the expiring credentials are no use any more
+        _drop_clients(lambda client_key: client_key[3] == creds['AccessKeyId'])
+    return(session['Credentials'])
+
+
+def get_local_client(type, region=None):
+    """Returns a cached boto3 client for the service "type" with the Lambda's own credentials"""
+    with _CLIENT_LOCK:
+        return(_cached_client((type, region, None, None), lambda: _new_client(type, region)))
+
+
+def get_client(type, cross_account_role_arn, region=None):
     """
     Returns a boto3 client for the service "type" with credentials in the target account.
     Optionally you can specify the region for the client and the session_name for the AssumeRole.
@@ -69,26 +498,22 @@ def get_resource(type, cross_account_role_arn, region=None):
     if targets_local_account(cross_account_role_arn):
         # Target is the account this Lambda runs in (e.g. the org management account);
         # use the Lambda's own role directly -- no AssumeRole.
-        return boto3.resource(type, region_name=region)
-    client = boto3.client('sts')
+        return(get_local_client(type, region))
     try:
-        session = client.assume_role(RoleArn=cross_account_role_arn, RoleSessionName=os.environ['ROLE_SESSION_NAME'])
-        creds = session['Credentials']  # Save for later
+        creds = get_credentials(cross_account_role_arn)
     except ClientError as e:
         logger.critical(f"Failed to assume role {cross_account_role_arn}: {e.response['Error']['Code']}")
         return(None)
-    resource = boto3.resource(type,
-        aws_access_key_id = creds['AccessKeyId'],
-        aws_secret_access_key = creds['SecretAccessKey'],
-        aws_session_token = creds['SessionToken'],
-        region_name = region)
-    return(resource)
+    account = cross_account_role_arn.split(':')[4]
+    with _CLIENT_LOCK:
+        return(_cached_client((type, region, account, creds['AccessKeyId']), lambda: _new_client(type, region, account=account,
+            aws_access_key_id = creds['AccessKeyId'],
+            aws_secret_access_key = creds['SecretAccessKey'],
+            aws_session_token = creds['SessionToken'])))
 
 
-def get_regions(cross_account_role_arn):
-    '''Return a list of regions with us-east-1 first. If --region was specified, return a list wth just that'''
-
-    # otherwise return all the regions, us-east-1 first
+def describe_regions(cross_account_role_arn):
+    '''Return the describe_regions() entries for the enabled regions, us-east-1 first'''
     ec2 = get_client('ec2', cross_account_role_arn, region="us-east-1")
     try:
         response = ec2.describe_regions()
@@ -98,14 +523,625 @@ def get_regions(cross_account_role_arn):
         else:
             raise
 
-    output = ['us-east-1']
-    for r in response['Regions']:
-        # return us-east-1 first, but dont return it twice
-        if r['RegionName'] == "us-east-1":
-            continue
-        output.append(r['RegionName'])
-    return(output)
+    # return us-east-1 first, but dont return it twice
+    return(sorted(response['Regions'], key=lambda r: r['RegionName'] != "us-east-1"))
+
+
+# How long a region list discovered by LoadConfigurationLambdaFunction is trusted by later steps
+REGIONS_MAX_AGE_SECONDS = int(os.environ.get('REGIONS_MAX_AGE_SECONDS', 3600))
+
+# Error codes that mean an SCP (or a permissions boundary) denies us the region outright
+REGION_DENIED_CODES = ('UnauthorizedOperation', 'AccessDenied', 'AccessDeniedException')
+
+# Regions the probe found denied, by role ARN, with when they were probed. Steps that have to
+# rediscover the regions reuse these instead of probing again.
+_DENIED_REGIONS = {}
+_DENIED_REGIONS_LOCK = threading.Lock()
+
+
+def probe_region(r, cross_account_role_arn):
+    '''One cheap read-only EC2 call in region r. Returns the ClientError if it's denied, otherwise None'''
+    try:
+        get_client('ec2', cross_account_role_arn, region=r).describe_availability_zones()
+    except ClientError as e:
+        if e.response['Error']['Code'] in REGION_DENIED_CODES:
+            logger.info(f"Region {r} is denied for {cross_account_role_arn}: {e.response['Error']['Code']}: {e.response['Error'].get('Message')}")
+            return(e)
+        # Anything else (e.g. a region still being enabled) is for the steps to handle
+        logger.warning(f"Probe of {r} failed with {e.response['Error']['Code']}: {e.response['Error'].get('Message')}; keeping it")
+    return(None)
+
+
+def denied_regions(cross_account_role_arn, regions):
+    '''
+    The regions in regions that an SCP denies, probed once and cached for REGIONS_MAX_AGE_SECONDS.
+    An SCP that denies every region would leave nothing to configure, so that's far more likely to be
+    the role lacking ec2:DescribeAvailabilityZones (or broken credentials), and raises the denial.
+    '''
+    with _DENIED_REGIONS_LOCK:
+        cached = _DENIED_REGIONS.get(cross_account_role_arn)
+    if cached and time.monotonic() - cached['probed'] < REGIONS_MAX_AGE_SECONDS and set(regions) <= cached['regions']:
+        return([r for r in regions if r in cached['denied']])
+
+    results, errors = map_regions(probe_region, regions, cross_account_role_arn)
+    for r, e in errors.items():
+        logger.warning(f"Probe of {r} failed: {e}; keeping it")
+    denied = [r for r in regions if results.get(r)]
+    if denied and len(denied) == len(regions):
+        logger.critical(f"Every region probed was denied for {cross_account_role_arn}; check the role can call ec2:DescribeAvailabilityZones")
+        raise results[denied[0]]
+    with _DENIED_REGIONS_LOCK:
+        _DENIED_REGIONS[cross_account_role_arn] = {'probed': time.monotonic(), 'regions': set(regions), 'denied': set(denied)}
+    return(denied)
+
+
+def eligible_regions(cross_account_role_arn, regions, region_filter=None):
+    '''
+    Apply the config's region_filter section to regions: keep only allow_regions (when it isn't
+    empty), drop deny_regions, and with probe_denied_regions drop the regions an SCP denies.
+    Returns (eligible, excluded), excluded being region -> why it was left out.
+    '''
+    region_filter = region_filter or {}
+    excluded = {}
+    for r in regions:
+        if region_filter.get('allow_regions') and r not in region_filter['allow_regions']:
+            excluded[r] = "not_allowed"
+        elif r in region_filter.get('deny_regions', []):
+            excluded[r] = "denied_by_config"
+    remaining = [r for r in regions if r not in excluded]
+    if region_filter.get('probe_denied_regions') and remaining:
+        for r in denied_regions(cross_account_role_arn, remaining):
+            excluded[r] = "denied_by_scp"
+    if excluded:
+        logger.info(f"Skipping regions {excluded}")
+    return([r for r in regions if r not in excluded], excluded)
+
+
+def discover_regions(cross_account_role_arn, region_filter=None):
+    '''Return the eligible regions, with opt-in status, what was excluded and a timestamp, to carry in the event'''
+    regions = describe_regions(cross_account_role_arn)
+    names, excluded = eligible_regions(cross_account_role_arn, [r['RegionName'] for r in regions], region_filter)
+    return({
+        "region_names": names,
+        "opt_in_status": {r['RegionName']: r.get('OptInStatus', 'opt-in-not-required') for r in regions if r['RegionName'] in names},
+        "excluded": excluded,
+        "filter": region_filter,
+        "discovered_at": datetime.now(timezone.utc).isoformat()
+    })
+
+
+def event_regions(event):
+    '''The regions discovered for this execution: the ones a step had to discover itself, else LoadConfiguration's'''
+    return((event.get('progress') or {}).get('regions') or event.get('regions') or {})
+
+
+def get_event_regions(event):
+    '''
+    Return the regions discovered earlier in this execution (event_regions), discovering them again
+    when they are missing or older than REGIONS_MAX_AGE_SECONDS. What's discovered here is kept in
+    event['progress']['regions'], the part of the event every state hands on, so only the first step
+    to need them pays for it. A single-region payload (event['region'], from the ParallelStateMachine's
+    Map) is just that region.
+    '''
+    if 'region' in event:
+        return([event['region']])
+    # When the account wasn't ready to discover its regions, event['regions'] only carries the filter
+    discovered = event_regions(event)
+    if discovered.get('region_names'):
+        age = datetime.now(timezone.utc) - datetime.fromisoformat(discovered['discovered_at'])
+        if age < timedelta(seconds=REGIONS_MAX_AGE_SECONDS):
+            return(discovered['region_names'])
+        logger.info(f"Region list from {discovered['discovered_at']} is stale, re-querying")
+    discovered = discover_regions(event['cross_account_role_arn'], discovered.get('filter'))
+    event.setdefault('progress', new_progress())['regions'] = discovered
+    return(discovered['region_names'])
+
+
+# Number of regions a handler works on at once
+REGION_CONCURRENCY = int(os.environ.get('REGION_CONCURRENCY', 8))
+
+# Time budget for one region of a step. A region still working past it stops at its next API call
+# (or retry attempt) and is deferred to a retry of the step, so one slow or degraded region can't hold
+# up the rest of the account. 0 turns it off.
+REGION_DEADLINE_SECONDS = float(os.environ.get('REGION_DEADLINE_SECONDS', 120))
+_REGION_DEADLINE = threading.local()
+# Passes of a step a region can go past its budget on before the step fails
+REGION_MAX_ATTEMPTS = int(os.environ.get('REGION_MAX_ATTEMPTS', 5))
+
+# HTTP connections kept per client. The STS and local-account clients are shared by every region
+# thread, and a region can fan out again (e.g. VPC teardown), so the pool is sized from the region
+# concurrency instead of botocore's default of 10, which closes and reopens connections under load.
+# TCP keep-alive stops idle pooled connections being dropped between calls and warm invocations.
+MAX_POOL_CONNECTIONS = int(os.environ.get('MAX_POOL_CONNECTIONS', max(10, 2 * REGION_CONCURRENCY)))
+TCP_KEEPALIVE = os.environ.get('TCP_KEEPALIVE', 'true').lower() == 'true'
+
+
+def map_regions(func, regions, *args, max_workers=None):
+    """
+    Runs func(region, *args) for every region on a bounded thread pool.
+    Returns (results, errors): dicts keyed by region, in the same order as regions.
+    """
+    if max_workers is None:
+        max_workers = REGION_CONCURRENCY
+    results = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(regions) or 1))) as executor:
+        futures = {r: executor.submit(func, r, *args) for r in regions}
+        for r in regions:
+            try:
+                results[r] = futures[r].result()
+            except Exception as e:
+                if not isinstance(e, DeadlineReached):
+                    logger.error(f"Error processing region {r}: {e}")
+                errors[r] = e
+    return(results, errors)
+
+
+def raise_region_errors(errors):
+    """Re-raise a RetryAfterDelay from any region first, otherwise the first error in region order"""
+    for e in errors.values():
+        if isinstance(e, RetryAfterDelay):
+            raise e
+    for e in errors.values():
+        raise e
+
+
+# Status recorded per step and region in event['progress']['results']
+COMPLIANT = "already_compliant"
+CHANGED = "changed"
+DRIFT = "drift"                      # not compliant, but left alone because of audit_only
+ENFORCED = "enforced_by_policy"      # a Declarative Policy owns the setting
+SKIPPED = "skipped"
+BLOCKED = "blocked"                  # not compliant, and something in the account stopped us changing it
+APPLIED = "already_applied"          # the ledger says it was applied with the same config, so it wasn't checked again
+# The statuses that mean the account is as the config wants it, and so are all the ledger records
+DESIRED_STATES = (COMPLIANT, CHANGED, ENFORCED)
+
+# The global_config section each step reads. The state machines hand each step only its own section.
+STEP_CONFIG = {
+    'ConfigurePasswordPolicyFunction': 'account_password_policy',
+    'EnableS3BlockPublicAccess': 'enable_account_s3_block_public_access',
+    'DeleteDefaultVPCs': 'default_vpc',
+}
+STEP_CONFIG.update({s['step']: s['config_key'] for s in regional_settings.REGIONAL_SETTINGS})
+
+
+def new_progress():
+    """
+    The compact, structured state the steps update as they run:
+      results: step -> region (or "global") -> {"status": ..., "ms": ...}
+      completed_regions: step -> regions finished so far
+      retry: set when a step has regions that aren't ready yet
+      regions: the regions a step had to discover itself (see get_event_regions), or None
+    """
+    return({"results": {}, "completed_regions": {}, "retry": None, "regions": None})
+
+
+def audit_only(event):
+    """True when this execution should only read settings and report drift, never change them"""
+    return(bool(event.get('audit_only', False)))
+
+
+def record_result(event, step, status, region="global", ms=None, calls=None, retries=None, attempt=1):
+    """Records a unit's status and duration, with the API calls and retries it took and which pass of the step it was done on"""
+    progress = event.setdefault('progress', new_progress())
+    result = {"status": status, "ms": ms}
+    if calls is not None:
+        result.update(calls=calls, retries=retries)
+    if attempt > 1:
+        result['attempt'] = attempt
+    progress['results'].setdefault(step, {})[region] = result
+
+
+# Only the first EVENT_LOG_MAX_CHARS of an event are logged
+EVENT_LOG_MAX_CHARS = int(os.environ.get('EVENT_LOG_MAX_CHARS', 2048))
+
+
+def log_event(event):
+    """Log the received event, capped at EVENT_LOG_MAX_CHARS so big payloads don't cost us in logging"""
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    text = json.dumps(event, sort_keys=True, default=str)
+    if len(text) > EVENT_LOG_MAX_CHARS:
+        text = f"{text[:EVENT_LOG_MAX_CHARS]}... ({len(text)} chars)"
+    logger.info(f"Received event: {text}")
+
+
+# How the messages rendered at the end of the pipeline name each step and status
+STEP_NAMES = {
+    'ConfigurePasswordPolicyFunction': "Password Policy",
+    'EnableS3BlockPublicAccess': "Account Wide Block Public Access for S3",
+    'DeleteDefaultVPCs': "Default VPC deletion",
+}
+STEP_NAMES.update({s['step']: s['title'] for s in regional_settings.REGIONAL_SETTINGS})
+STATUS_TEXT = {
+    CHANGED: "applied",
+    COMPLIANT: "already compliant",
+    DRIFT: "differs from the config (audit only)",
+    ENFORCED: "skipped: enforced by a Declarative Policy",
+    SKIPPED: "skipped",
+    BLOCKED: "blocked: still in use",
+    APPLIED: "already applied with this config",
+}
+
+EXCLUDED_TEXT = {
+    "not_allowed": "not in region_filter.allow_regions",
+    "denied_by_config": "in region_filter.deny_regions",
+    "denied_by_scp": "denied by an SCP",
+}
+
+
+def merge_results(*results):
+    """Merge step -> region -> result dicts (or lists of them, as a Map state returns) into one"""
+    merged = {}
+    for r in results:
+        for part in (r if isinstance(r, list) else [r]):
+            for step, regions in (part or {}).items():
+                merged.setdefault(step, {}).update(regions)
+    return(merged)
+
+
+def render_messages(event):
+    """Turn event['progress']['results'] into the human-readable messages list, once, at the end"""
+    messages = []
+    for step, regions in event['progress']['results'].items():
+        for region, result in regions.items():
+            where = f"in {event['new_aws_account_id']}" if region == "global" else f"in {region} in {event['new_aws_account_id']}"
+            messages.append(f"{STEP_NAMES.get(step, step)} {STATUS_TEXT.get(result['status'], result['status'])} {where}")
+    for step, regions in event['progress']['results'].items():
+        ms = {r: result['ms'] for r, result in regions.items() if r != "global" and result['ms'] is not None and result['status'] != APPLIED}
+        if ms:
+            times = region_times(ms)
+            messages.append(f"{STEP_NAMES.get(step, step)} took p50 {times['p50_ms']} ms, p95 {times['p95_ms']} ms, max {times['max_ms']} ms "
+                            f"({times['slowest']}) over {times['regions']} regions in {event['new_aws_account_id']}")
+    for region, reason in (event_regions(event).get('excluded') or {}).items():
+        messages.append(f"Skipped {region} in {event['new_aws_account_id']}: {EXCLUDED_TEXT.get(reason, reason)}")
+    return(messages)
+
+
+# History of every run for scripts/run-history.py: a JSON Lines record for each unit and one for the
+# run. RUN_HISTORY is s3 (an object per run under RUN_HISTORY_PREFIX in RUN_HISTORY_BUCKET), local
+# (appended to the RUN_HISTORY_PATH file) or empty for none.
+RUN_HISTORY = os.environ.get('RUN_HISTORY', '').lower()
+RUN_HISTORY_PATH = os.environ.get('RUN_HISTORY_PATH', 'run-history.jsonl')
+RUN_HISTORY_BUCKET = os.environ.get('RUN_HISTORY_BUCKET', os.environ.get('BUCKET'))
+RUN_HISTORY_PREFIX = os.environ.get('RUN_HISTORY_PREFIX', 'run-history/')
+_RUN_HISTORY = None
+_RUN_HISTORY_LOCK = threading.Lock()
+
+
+def get_run_history():
+    """Returns the run history store RUN_HISTORY picks, or None when there's no run history"""
+    global _RUN_HISTORY
+    with _RUN_HISTORY_LOCK:
+        if _RUN_HISTORY is None and RUN_HISTORY == 's3':
+            _RUN_HISTORY = run_history.S3RunHistory(get_local_client('s3'), RUN_HISTORY_BUCKET, RUN_HISTORY_PREFIX)
+        elif _RUN_HISTORY is None and RUN_HISTORY == 'local':
+            _RUN_HISTORY = run_history.LocalRunHistory(RUN_HISTORY_PATH)
+    return(_RUN_HISTORY)
+
+
+def record_run_history(event):
+    """Appends the finished run's records to the run history, if there is one. A failure only logs a warning"""
+    store = get_run_history()
+    if store is None:
+        return
+    try:
+        store.append(run_history.run_records(event))
+    except Exception as e:
+        logger.warning(f"Unable to record the run of {event['new_aws_account_id']} in the run history: {e}")
+
+
+# Backoff for regions that aren't ready yet: RETRY_BASE_SECONDS doubling per attempt, capped at RETRY_MAX_SECONDS
+RETRY_BASE_SECONDS = int(os.environ.get('RETRY_BASE_SECONDS', 15))
+RETRY_MAX_SECONDS = int(os.environ.get('RETRY_MAX_SECONDS', 300))
+
+
+def backoff_seconds(attempt):
+    """How long to wait before the next try after attempt tries of something that wasn't ready"""
+    return(min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempt - 1)))
+
+
+def is_retryable(e):
+    """True for errors that mean the account or region isn't ready yet"""
+    if isinstance(e, RetryAfterDelay):
+        return(True)
+    return(isinstance(e, ClientError) and e.response['Error']['Code'] == "OptInRequired")
+
+
+def is_straggler(e):
+    """True for errors that mean the region was too slow: past its budget, or its endpoint timing out"""
+    return(isinstance(e, (RegionDeadlineExceeded, ConnectTimeoutError, ReadTimeoutError, EndpointConnectionError)))
+
+
+def percentile(values, p):
+    """The nearest-rank p-th percentile of values"""
+    values = sorted(values)
+    return(values[min(len(values) - 1, max(0, int(-(-p * len(values) // 100)) - 1))])
+
+
+def region_times(ms_by_region):
+    """p50, p95 and max of a step's region durations (region -> ms), and the slowest region"""
+    slowest = max(ms_by_region, key=ms_by_region.get)
+    values = list(ms_by_region.values())
+    return({"regions": len(values), "p50_ms": percentile(values, 50), "p95_ms": percentile(values, 95),
+            "max_ms": ms_by_region[slowest], "slowest": slowest})
+
+
+# Once an invocation has less than this left, the regional steps stop starting new regions (and
+# FastPathRunner new steps) and hand back a continuation, so the state machine invokes them again for
+# the rest instead of Lambda killing them mid-loop and losing the regions they had finished.
+DEADLINE_MARGIN_SECONDS = int(os.environ.get('DEADLINE_MARGIN_SECONDS', 60))
+
+
+def deadline_reached(context):
+    """True when the Lambda invocation behind context has less than DEADLINE_MARGIN_SECONDS left"""
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return(False)
+    return(context.get_remaining_time_in_millis() < DEADLINE_MARGIN_SECONDS * 1000)
+
+
+def invocation_deadline(context):
+    """The time.monotonic() at which the invocation behind context is down to DEADLINE_MARGIN_SECONDS, or None"""
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return(None)
+    return(time.monotonic() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN_SECONDS)
+
+
+def continuation(step, pending_regions, progress):
+    """
+    The progress['retry'] marker that has the state machine re-invoke step straight away for
+    pending_regions. It keeps the backoff attempt and straggler passes of a retry of the same step.
+    """
+    retry = progress.get('retry')
+    same_step = retry and retry['step'] == step
+    return({
+        "step": step,
+        "reason": "deadline",
+        "attempt": retry['attempt'] if same_step else 0,
+        "straggler_passes": retry.get('straggler_passes', 0) if same_step else 0,
+        "pending_regions": pending_regions,
+        "wait_seconds": 0
+    })
+
+
+# Ledger of the units (a step in one region, or "global") already applied to each account, so re-runs
+# and backfills skip whatever was already done with the same config. LEDGER_BACKEND is dynamodb (the
+# LEDGER_TABLE table), sqlite (a local LEDGER_PATH file) or empty for no ledger. A unit is trusted for
+# LEDGER_MAX_AGE_SECONDS, after which the step checks the account again and so catches drift.
+LEDGER_BACKEND = os.environ.get('LEDGER_BACKEND', '').lower()
+LEDGER_TABLE = os.environ.get('LEDGER_TABLE')
+LEDGER_PATH = os.environ.get('LEDGER_PATH', 'ledger.sqlite')
+LEDGER_MAX_AGE_SECONDS = int(os.environ.get('LEDGER_MAX_AGE_SECONDS', 7 * 86400))
+_LEDGER = None
+_LEDGER_LOCK = threading.Lock()
+
+
+def get_ledger():
+    """Returns the ledger store LEDGER_BACKEND picks, or None when there's no ledger"""
+    global _LEDGER
+    with _LEDGER_LOCK:
+        if _LEDGER is None and LEDGER_BACKEND == 'dynamodb':
+            _LEDGER = ledger.DynamoDBLedger(get_local_client('dynamodb'), LEDGER_TABLE)
+        elif _LEDGER is None and LEDGER_BACKEND == 'sqlite':
+            _LEDGER = ledger.SQLiteLedger(LEDGER_PATH)
+    return(_LEDGER)
+
+
+def ledger_lookup(step, event):
+    """
+    Returns (ledger, config hash, {region: entry}) for the units of step the ledger says were applied to
+    the account with the step's current config. The ledger comes back as None when there isn't one, the
+    run is audit_only (which is there to find drift), the event sets ignore_ledger, or the lookup fails.
+    """
+    store = get_ledger()
+    if store is None or audit_only(event) or event.get('ignore_ledger'):
+        return(None, None, {})
+    digest = ledger.config_hash(event['global_config'].get(STEP_CONFIG[step]) if step in STEP_CONFIG else event['global_config'])
+    try:
+        entries = store.lookup(event['new_aws_account_id'], step)
+    except Exception as e:
+        logger.warning(f"Ledger lookup of {step} in {event['new_aws_account_id']} failed, so every unit runs: {e}")
+        return(None, None, {})
+    return(store, digest, {r: entry for r, entry in entries.items() if entry['config_hash'] == digest})
+
+
+def ledger_record(store, digest, step, event, units):
+    """
+    Records units (region -> status) as applied with the config digest, when ledger_lookup returned a ledger.
+    Only units that reached the desired state are recorded; skipped and blocked ones are checked again next time.
+    """
+    units = {r: status for r, status in units.items() if status in DESIRED_STATES}
+    if store is None or not units:
+        return
+    try:
+        store.record(event['new_aws_account_id'], step, units, digest, time.time() + LEDGER_MAX_AGE_SECONDS)
+    except Exception as e:
+        logger.warning(f"Unable to record {len(units)} {step} units for {event['new_aws_account_id']} in the ledger: {e}")
+
+
+def _timed(region, step, func, event, budget=None, stop_at=None):
+    set_metric_context(event['new_aws_account_id'], step, region)
+    start = time.monotonic()
+    # The thread may be a fresh pool worker, or one a previous unit left behind
+    _REGION_DEADLINE.at = start + budget if budget else None
+    _REGION_DEADLINE.invocation = False
+    # The invocation running out cuts the budget short, and defers the region rather than making it a straggler
+    if stop_at is not None and (_REGION_DEADLINE.at is None or stop_at < _REGION_DEADLINE.at):
+        _REGION_DEADLINE.at = stop_at
+        _REGION_DEADLINE.invocation = True
+    _UNIT_STATS.counts = {'calls': 0, 'retries': 0}
+    outcome = 'error'
+    try:
+        status = func(region, event)
+        # A pass that applies several settings returns a status for each of them
+        outcome = status if isinstance(status, str) else 'completed'
+    except Exception as e:
+        if is_retryable(e):
+            outcome = 'not_ready'
+        elif is_straggler(e):
+            outcome = 'straggler'
+        elif isinstance(e, DeadlineReached):
+            outcome = 'deferred'
+        raise
+    finally:
+        _REGION_DEADLINE.at = None
+        _REGION_DEADLINE.invocation = False
+        counts, _UNIT_STATS.counts = _UNIT_STATS.counts, None
+        ms = (time.monotonic() - start) * 1000
+        if region != "global":
+            record_metrics('region', {'Region': region, 'Outcome': outcome}, RegionDuration=(ms, 'Milliseconds'))
+    return(status, int(ms), counts)
+
+
+def run_global_step(step, event, func):
+    """
+    Runs func(event) for an account-wide step and records its status and duration under "global",
+    unless the ledger says the step was already applied to the account with the same config.
+    """
+    set_metric_context(event['new_aws_account_id'], step)
+    store, digest, applied = ledger_lookup(step, event)
+    if "global" in applied:
+        logger.info(f"{step} was applied to {event['new_aws_account_id']} with this config at {datetime.fromtimestamp(applied['global']['applied_at'], timezone.utc).isoformat()}, skipping")
+        flush_metrics()
+        record_result(event, step, APPLIED, ms=0)
+        return(event)
+    try:
+        status, ms, counts = _timed("global", step, lambda region, event: func(event), event)
+        record_metrics('step', {}, StepDuration=(ms, 'Milliseconds'))
+        ledger_record(store, digest, step, event, {"global": status})
+    finally:
+        flush_metrics()
+    record_result(event, step, status, ms=ms, **counts)
+    return(event)
+
+
+def run_regional_step(step, event, func, settings=None, context=None):
+    """
+    Runs func(region, event) for every region that step hasn't already completed, and that the ledger
+    doesn't say was applied with the same config. func returns the region's status, which goes with its
+    duration and API calls in event['progress']['results'][step][region].
+
+    With settings (a list of step names), one pass over the regions applies several steps at once:
+    func(region, event, steps) applies the steps still to do in the region, and returns
+    {step: (status, ms, unit_stats() used)}. Each of them is recorded, and looked up in the ledger, under its own name,
+    and step just names the pass for checkpoints, retries and metrics.
+
+    Completed regions are checkpointed in event['progress']['completed_regions'][step]. If some regions
+    aren't ready yet, event['progress']['retry'] says which regions are pending and how long the state
+    machine should wait (exponential backoff) before re-running the step, which then only resumes those regions.
+    Regions that go past REGION_DEADLINE_SECONDS, or whose endpoint times out, are retried the same way,
+    with the budget doubling on every pass that had stragglers so a region that's just slow still finishes,
+    until REGION_MAX_ATTEMPTS passes have had stragglers (progress['retry']['straggler_passes']) and the step fails.
+    Passes that only waited on regions that weren't ready don't count towards either.
+    With the Lambda context, regions aren't started once the invocation nears its timeout, and stop
+    making calls when it gets there, however much of their own budget is left. The retry is then a
+    continuation (reason "deadline") that has the state machine re-run the step with no wait.
+    """
+    progress = event.setdefault('progress', new_progress())
+    regions = get_event_regions(event)
+    completed = progress['completed_regions'].setdefault(step, [])
+    pending = [r for r in regions if r not in completed]
+    if len(pending) < len(regions):
+        logger.info(f"{step} resuming {len(pending)} of {len(regions)} regions in {event['new_aws_account_id']}")
+
+    set_metric_context(event['new_aws_account_id'], step)
+    start = time.monotonic()
+    names = settings or [step]
+    lookups = {name: ledger_lookup(name, event) for name in names}
+    todo = {r: [name for name in names if r not in lookups[name][2]] for r in pending}
+    skipped = [(name, r) for r in pending for name in names if name not in todo[r]]
+    if skipped:
+        logger.info(f"{step} skipping {len(skipped)} units already applied with this config in {event['new_aws_account_id']}")
+        for name, r in skipped:
+            record_result(event, name, APPLIED, region=r, ms=0)
+        completed.extend(r for r in pending if not todo[r])
+        pending = [r for r in pending if todo[r]]
+    if settings:
+        call = lambda region, event: func(region, event, todo[region])
+    else:
+        call = func
+
+    # How long each region that was started took, stragglers included
+    durations = {}
+    retry = progress.get('retry')
+    if retry and retry['step'] != step:
+        retry = None
+    # Only the passes that had stragglers grow the budget and count towards REGION_MAX_ATTEMPTS,
+    # not the ones spent waiting on regions that weren't ready
+    straggler_passes = retry.get('straggler_passes', 0) if retry else 0
+    budget = REGION_DEADLINE_SECONDS * 2 ** straggler_passes
+    stop_at = invocation_deadline(context)
+
+    def start_region(region, step, call, event):
+        if deadline_reached(context):
+            raise DeadlineReached(f"{step} deferred {region}: the invocation is close to its timeout")
+        started = time.monotonic()
+        try:
+            return(_timed(region, step, call, event, budget, stop_at))
+        finally:
+            durations[region] = int((time.monotonic() - started) * 1000)
+
+    try:
+        results, errors = map_regions(start_region, pending, step, call, event)
+        record_metrics('step', {}, StepDuration=((time.monotonic() - start) * 1000, 'Milliseconds'))
+        if durations:
+            times = region_times(durations)
+            record_metrics('step', {}, RegionTimeP50=(times['p50_ms'], 'Milliseconds'), RegionTimeP95=(times['p95_ms'], 'Milliseconds'),
+                           RegionTimeMax=(times['max_ms'], 'Milliseconds'))
+            logger.info(f"{step} region times in {event['new_aws_account_id']}: p50 {times['p50_ms']} ms, p95 {times['p95_ms']} ms, "
+                        f"max {times['max_ms']} ms ({times['slowest']}) over {times['regions']} regions")
+        # region -> {step: (status, ms, counts)}, whichever way func reported it
+        units = {r: status if settings else {step: (status, ms, counts)} for r, (status, ms, counts) in results.items()}
+        for name, (store, digest, applied) in lookups.items():
+            ledger_record(store, digest, name, event, {r: units[r][name][0] for r in units if name in units[r]})
+    finally:
+        flush_metrics()
+    attempt = retry['attempt'] + 1 if retry else 1
+    for r in units:
+        completed.append(r)
+        for name, (status, ms, counts) in units[r].items():
+            record_result(event, name, status, region=r, ms=ms, attempt=attempt, **counts)
+
+    deferred = [r for r, e in errors.items() if isinstance(e, DeadlineReached)]
+    stragglers = [r for r, e in errors.items() if is_straggler(e)]
+    if stragglers:
+        straggler_passes += 1
+        if straggler_passes >= REGION_MAX_ATTEMPTS:
+            logger.error(f"{step} gave up on {stragglers} in {event['new_aws_account_id']}: too slow on {straggler_passes} passes")
+            stragglers = []
+    raise_region_errors({r: e for r, e in errors.items() if not is_retryable(e) and r not in deferred and r not in stragglers})
+
+    if len(errors) > len(deferred):
+        progress['retry'] = {
+            "step": step,
+            "reason": "not_ready" if len(errors) > len(deferred) + len(stragglers) else "straggler",
+            "attempt": attempt,
+            "straggler_passes": straggler_passes,
+            "pending_regions": list(errors),
+            "wait_seconds": backoff_seconds(attempt)
+        }
+        if stragglers:
+            logger.warning(f"{step} deferred slow regions {stragglers} in {event['new_aws_account_id']} (budget {budget:g}s)")
+        logger.warning(f"{step} has {len(errors) - len(deferred)} regions not ready or too slow in {event['new_aws_account_id']}, retrying in {progress['retry']['wait_seconds']}s")
+    elif deferred:
+        progress['retry'] = continuation(step, deferred, progress)
+        logger.warning(f"{step} ran short of time with {len(deferred)} regions to go in {event['new_aws_account_id']}, continuing in a new invocation")
+    else:
+        progress['retry'] = None
+    return(event)
+
 
 class RetryAfterDelay(Exception):
     """raised when the OptInRequired Occurs"""
+    pass
+
+
+class DeadlineReached(Exception):
+    """raised in place of starting a region when the invocation is close to its timeout"""
+    pass
+
+
+class RegionDeadlineExceeded(Exception):
+    """raised in place of an API call when the region has used up REGION_DEADLINE_SECONDS"""
     pass
\ No newline at end of file
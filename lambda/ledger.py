@@ -0,0 +1,124 @@
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Stores for the ledger of configuration units already applied to an account. A unit is one step in
+# one region ("global" for the account-wide steps), recorded with a hash of the config section the
+# step applied. common.get_ledger() picks the store, and run_global_step / run_regional_step consult it.
+#
+# Both stores have the same two methods:
+#   lookup(account_id, step) -> {region: {"config_hash": ..., "status": ..., "applied_at": ...}}
+#       for the units of step that haven't expired
+#   record(account_id, step, units, config_hash, expires_at)
+#       for units, a dict of region -> status, with expires_at in epoch seconds
+
+import json
+import threading
+import time
+
+import logging
+logger = logging.getLogger()
+
+
+def config_hash(section):
+    '''A short, stable hash of a step's global_config section'''
+    import hashlib
+    return(hashlib.sha256(json.dumps(section, sort_keys=True, default=str).encode()).hexdigest()[:16])
+
+
+class DynamoDBLedger(object):
+    '''
+    The ledger in a DynamoDB table (LedgerTable in the template): partition key AccountId, sort key
+    Unit ("<step>#<region>"), and a TTL on ExpiresAt so DynamoDB removes expired units.
+    '''
+
+    # BatchWriteItem takes at most 25 items, and may hand some back as UnprocessedItems
+    BATCH_SIZE = 25
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+
+    def lookup(self, account_id, step):
+        entries = {}
+        now = int(time.time())
+        kwargs = {
+            'TableName': self.table,
+            'KeyConditionExpression': "AccountId = :account AND begins_with(#unit, :step)",
+            'ExpressionAttributeNames': {'#unit': 'Unit'},
+            'ExpressionAttributeValues': {':account': {'S': account_id}, ':step': {'S': f"{step}#"}},
+            # A step re-run right after it recorded its units should see them
+            'ConsistentRead': True,
+        }
+        while True:
+            response = self.client.query(**kwargs)
+            for item in response['Items']:
+                # Expired items linger until DynamoDB's TTL sweep gets to them
+                if int(item['ExpiresAt']['N']) <= now:
+                    continue
+                entries[item['Unit']['S'].split('#', 1)[1]] = {
+                    "config_hash": item['ConfigHash']['S'],
+                    "status": item['Status']['S'],
+                    "applied_at": int(item['AppliedAt']['N']),
+                }
+            if 'LastEvaluatedKey' not in response:
+                return(entries)
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def record(self, account_id, step, units, config_hash, expires_at):
+        now = str(int(time.time()))
+        requests = [{'PutRequest': {'Item': {
+            'AccountId': {'S': account_id},
+            'Unit': {'S': f"{step}#{region}"},
+            'ConfigHash': {'S': config_hash},
+            'Status': {'S': status},
+            'AppliedAt': {'N': now},
+            'ExpiresAt': {'N': str(int(expires_at))},
+        }}} for region, status in units.items()]
+        for i in range(0, len(requests), self.BATCH_SIZE):
+            batch = {self.table: requests[i:i + self.BATCH_SIZE]}
+            for attempt in range(self.MAX_ATTEMPTS):
+                batch = self.client.batch_write_item(RequestItems=batch).get('UnprocessedItems')
+                if not batch:
+                    break
+                time.sleep(0.1 * 2 ** attempt)
+            else:
+                logger.warning(f"Ledger: {len(batch[self.table])} {step} units for {account_id} weren't recorded")
+
+
+class SQLiteLedger(object):
+    '''The ledger in a local SQLite file, for Backfill and the benchmark outside AWS'''
+
+    def __init__(self, path):
+        import sqlite3
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS ledger (account_id TEXT, step TEXT, region TEXT, config_hash TEXT, "
+                            "status TEXT, applied_at INTEGER, expires_at INTEGER, PRIMARY KEY (account_id, step, region))")
+
+    def lookup(self, account_id, step):
+        with self.lock:
+            rows = self.db.execute("SELECT region, config_hash, status, applied_at FROM ledger "
+                                   "WHERE account_id = ? AND step = ? AND expires_at > ?",
+                                   (account_id, step, int(time.time()))).fetchall()
+        return({region: {"config_hash": digest, "status": status, "applied_at": applied_at}
+                for region, digest, status, applied_at in rows})
+
+    def record(self, account_id, step, units, config_hash, expires_at):
+        now = int(time.time())
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO ledger VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                [(account_id, step, region, config_hash, status, now, int(expires_at))
+                                 for region, status in units.items()])
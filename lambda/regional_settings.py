@@ -0,0 +1,82 @@
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Registry of the regional settings EnableRegionalSettings applies. Each entry is one account-level
+# setting that's read and (if it differs from the config) written with a single call in every region:
+#
+#   step              name its results, ledger entries and messages go under
+#   title             how the messages and logs name it
+#   config_key        the global_config section that enables and configures it
+#   service           boto3 client it's read and applied with
+#   read              operation that returns the current setting, and
+#   current           a function turning that response into the same keys as desired
+#   desired           a function of the config section returning the wanted setting
+#   apply             operation that writes the setting, called with
+#   apply_args        a function of the desired setting returning the call's arguments (default: desired)
+#   tolerated_errors  error codes from apply that mean the setting is enforced some other way (by a
+#                     Declarative Policy), recorded as enforced_by_policy instead of failing
+#
+# A new regional control is a new entry here, plus its section in account-factory-config.yaml and
+# in the global_config the state machines hand EnableRegionalSettings (tests/test_template.py).
+
+# A Declarative Policy that already enforces a setting makes AWS deny the call that writes it
+DECLARATIVE_POLICY_ERRORS = ('OperationNotPermitted', 'DeclarativePolicyViolation')
+
+# ModifyInstanceMetadataDefaults parameters, and what we send when the config doesn't say
+IMDS_DEFAULTS = {
+    'HttpTokens': 'no-preference',
+    'HttpPutResponseHopLimit': 1,
+    'HttpEndpoint': 'no-preference',
+    'InstanceMetadataTags': 'no-preference',
+}
+
+REGIONAL_SETTINGS = [
+    {
+        'step': 'EnableEBSBlockPublicAccess',
+        'title': "EBS Block Public access",
+        'config_key': 'enable_ebs_block_public_access',
+        'service': 'ec2',
+        'read': 'get_snapshot_block_public_access_state',
+        'current': lambda response: {'State': response['State']},
+        'desired': lambda config: {'State': 'block-all-sharing'},
+        'apply': 'enable_snapshot_block_public_access',
+        'tolerated_errors': DECLARATIVE_POLICY_ERRORS,
+    },
+    {
+        'step': 'EnableEBSEncryption',
+        'title': "EBS Default Encryption",
+        'config_key': 'enable_ebs_default_encryption',
+        'service': 'ec2',
+        'read': 'get_ebs_encryption_by_default',
+        'current': lambda response: {'EbsEncryptionByDefault': response['EbsEncryptionByDefault']},
+        'desired': lambda config: {'EbsEncryptionByDefault': True},
+        'apply': 'enable_ebs_encryption_by_default',
+        'apply_args': lambda desired: {},
+        'tolerated_errors': (),
+    },
+    {
+        'step': 'EnableIMDSv2',
+        'title': "IMDSv2 defaults",
+        'config_key': 'require_imdsv2',
+        'service': 'ec2',
+        'read': 'get_instance_metadata_defaults',
+        # GetInstanceMetadataDefaults leaves out any setting that is "no-preference"
+        'current': lambda response: {k: response.get('AccountLevel', {}).get(k, 'no-preference') for k in IMDS_DEFAULTS},
+        'desired': lambda config: {k: config.get(k, default) for k, default in IMDS_DEFAULTS.items()},
+        'apply': 'modify_instance_metadata_defaults',
+        'tolerated_errors': DECLARATIVE_POLICY_ERRORS,
+    },
+]
+
+SETTINGS_BY_STEP = {s['step']: s for s in REGIONAL_SETTINGS}
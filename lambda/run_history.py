@@ -0,0 +1,91 @@
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Stores for the history of finished runs, which scripts/run-history.py aggregates. common.get_run_history()
+# picks the store, and SummarizeResults appends every run to it. A run is stored as JSON Lines:
+#
+#   {"type": "unit", ...}  one per step and region ("global" for the account-wide steps), with its
+#                          outcome, ms, api_calls, retries (API calls botocore retried) and attempt
+#                          (the pass of the step it was done on)
+#   {"type": "run", ...}   one per run, with its duration_ms from LoadConfigurationLambdaFunction to
+#                          the end, state machine waits included, and its unit, api_calls and
+#                          retries totals
+#
+# Every record carries the run_id, account, config_version, audit_only and recorded_at.
+
+from datetime import datetime, timezone
+import json
+import threading
+
+
+def run_records(event, now=None):
+    '''The unit records and the run record for the finished run in event'''
+    now = now or datetime.now(timezone.utc)
+    shared = {
+        "run_id": event.get('run_id'),
+        "account": event['new_aws_account_id'],
+        "config_version": event.get('config_version'),
+        "audit_only": bool(event.get('audit_only')),
+        "recorded_at": now.isoformat(),
+    }
+    records = []
+    for step, regions in event['progress']['results'].items():
+        for region, result in regions.items():
+            records.append({"type": "unit", **shared, "step": step, "region": region, "outcome": result['status'],
+                            "ms": result.get('ms'), "api_calls": result.get('calls'), "retries": result.get('retries'),
+                            "attempt": result.get('attempt', 1)})
+    outcomes = {}
+    for r in records:
+        outcomes[r['outcome']] = outcomes.get(r['outcome'], 0) + 1
+    started_at = event.get('started_at')
+    records.append({"type": "run", **shared, "started_at": started_at,
+                    "duration_ms": int((now - datetime.fromisoformat(started_at)).total_seconds() * 1000) if started_at else None,
+                    "units": len(records), "outcomes": outcomes,
+                    "api_calls": sum(r['api_calls'] or 0 for r in records),
+                    "retries": sum(r['retries'] or 0 for r in records)})
+    return(records)
+
+
+def dumps(records):
+    return("".join(json.dumps(r, sort_keys=True, default=str) + "\n" for r in records))
+
+
+class S3RunHistory(object):
+    '''
+    The run history in S3. S3 objects can't be appended to, so every run is its own JSON Lines object,
+    <prefix>dt=<YYYY-MM-DD>/<account>-<run_id>.jsonl, and the date lets a query list only the days it reads.
+    '''
+
+    def __init__(self, client, bucket, prefix):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def append(self, records):
+        run = records[-1]
+        # SummarizeResults re-run for the same run on the same day rewrites the object rather than adding another
+        key = f"{self.prefix}dt={run['recorded_at'][:10]}/{run['account']}-{run['run_id']}.jsonl"
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=dumps(records).encode(), ContentType='application/x-ndjson')
+
+
+class LocalRunHistory(object):
+    '''The run history appended to a local JSON Lines file, for Backfill and the benchmark outside AWS'''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self, records):
+        with self.lock, open(self.path, 'a') as f:
+            f.write(dumps(records))
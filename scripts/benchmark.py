@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark the handlers offline, against a simulated AWS organization instead of live accounts.
+#
+# FakeAWS replaces botocore's HTTP send (Endpoint._do_get_response) with an in-process stub, so
+# the real client code still runs: request signing, the adaptive retry mode, and the rate limiting
+# and throttle counting hooks from common. The stub simulates a new account with N regions, each
+# with a default VPC and nothing configured, adds per-call latency, and can throttle calls or
+# answer OptInRequired for regions that aren't enabled yet, or UnauthorizedOperation for regions an
+# SCP denies, or be slow to answer in degraded regions.
+#
+# Every handler is driven from sample-event.json, first one at a time the way NewAccountStateMachine
+# runs them (re-running a step while it asks for a retry, without actually waiting), then end to end
+# through FastPathRunner. By default each handler starts with cold caches, as it would in its own
+# Lambda container. Module import time isn't included; make import-budget covers that.
+#
+# Usage: scripts/benchmark.py [--regions N] [--latency-ms MS] [--throttle-rate R] [--json out.json] [--compare baseline.json]
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda')
+ACCOUNT_ID = '123456789012'
+LOCAL_ACCOUNT_ID = '000000000000'
+
+# Errors the stub answers with: (HTTP status, service error code)
+THROTTLED = (400, 'Throttling')
+OPT_IN_REQUIRED = (401, 'OptInRequired')
+SCP_DENIED = (403, 'UnauthorizedOperation')
+
+
+class FakeHTTPResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = b''
+        self.raw = io.BytesIO(b'')
+
+
+class FakeAWS(object):
+    """
+    In-process stand-in for the AWS APIs the handlers call. Each operation is a method named after
+    the API operation that takes (account, region, params) and returns the parsed response, or raises
+    FakeError. Operations it doesn't know about succeed with an empty response. Every account the
+    handlers assume a role into gets its own state, so a burst of new accounts can be simulated.
+    """
+
+    def __init__(self, regions, config_body, latency_ms=20, jitter_ms=10, latency_overrides=None,
+                 throttle_rate=0.0, opt_in_regions=0, opt_in_calls=1, scp_denied_regions=0, slow_regions=0,
+                 slow_region_ms=0, slow_region_calls=0, seed=0):
+        self.regions = regions
+        self.config_body = config_body
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.latency_overrides = latency_overrides or {}
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        # In every account, the last opt_in_regions regions answer OptInRequired to their first opt_in_calls calls
+        self.opt_in_regions = regions[len(regions) - opt_in_regions:] if opt_in_regions else []
+        self.opt_in_calls = opt_in_calls
+        # The scp_denied_regions regions before those deny every EC2 call, as a region-deny SCP would
+        rest = regions[:len(regions) - opt_in_regions]
+        self.scp_denied_regions = rest[len(rest) - scp_denied_regions:] if scp_denied_regions else []
+        # The slow_regions regions after us-east-1 take slow_region_ms longer to answer their first slow_region_calls calls
+        self.slow_regions = regions[1:1 + slow_regions]
+        self.slow_region_ms = slow_region_ms
+        self.slow_region_calls = slow_region_calls
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.errors = {}
+        self.accounts = {}
+        self.access_keys = {}
+
+    def account(self, access_key):
+        """The state of the account the access key belongs to, set up as a new account on first use"""
+        account_id = self.access_keys.get(access_key, LOCAL_ACCOUNT_ID)
+        with self.lock:
+            if account_id not in self.accounts:
+                self.accounts[account_id] = {
+                    'account_id': account_id,
+                    'regions': {r: {
+                        'ebs_encryption': False,
+                        'snapshot_block_public_access': 'unblocked',
+                        'imds_defaults': {},
+                        'default_vpc': f"vpc-{i:08x}",
+                    } for i, r in enumerate(self.regions)},
+                    'password_policy': None,
+                    'public_access_block': None,
+                    'opt_in_remaining': {r: self.opt_in_calls for r in self.opt_in_regions},
+                    'slow_remaining': {r: self.slow_region_calls for r in self.slow_regions},
+                }
+            return(self.accounts[account_id])
+
+    def _record(self, counts, key):
+        with self.lock:
+            counts[key] = counts.get(key, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return({'calls': dict(self.calls), 'errors': dict(self.errors)})
+
+    def _delay(self, service, operation, region=None, account=None):
+        ms = self.latency_overrides.get(f"{service}.{operation}", self.latency_overrides.get(service, self.latency_ms))
+        if account is not None and service != 'sts':
+            with self.lock:
+                if account['slow_remaining'].get(region):
+                    account['slow_remaining'][region] -= 1
+                    ms += self.slow_region_ms
+        time.sleep(max(0, ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000)
+
+    def _injected_error(self, service, region, account):
+        if self.random.random() < self.throttle_rate:
+            return(THROTTLED)
+        if service == 'ec2' and region in self.scp_denied_regions:
+            return(SCP_DENIED)
+        if service != 'sts':
+            with self.lock:
+                if account['opt_in_remaining'].get(region):
+                    account['opt_in_remaining'][region] -= 1
+                    return(OPT_IN_REQUIRED)
+        return(None)
+
+    def respond(self, service, operation, region, params, access_key=None):
+        """Returns (FakeHTTPResponse, parsed response) for one API call signed with access_key"""
+        self._record(self.calls, f"{service}.{operation}")
+        account = self.account(access_key)
+        self._delay(service, operation, region, account)
+        error = self._injected_error(service, region, account)
+        if error is None:
+            try:
+                return(FakeHTTPResponse(200), getattr(self, operation, lambda a, r, p: {})(account, region, params))
+            except FakeError as e:
+                error = (e.status, e.code)
+        self._record(self.errors, f"{service}.{operation}.{error[1]}")
+        return(FakeHTTPResponse(error[0]), {'Error': {'Code': error[1], 'Message': 'Simulated by benchmark.py'},
+                                            'ResponseMetadata': {'HTTPStatusCode': error[0]}})
+
+    # STS
+    def GetCallerIdentity(self, account, region, params):
+        return({'Account': LOCAL_ACCOUNT_ID, 'Arn': f"arn:aws:iam::{LOCAL_ACCOUNT_ID}:role/benchmark", 'UserId': 'AROABENCHMARK'})
+
+    def AssumeRole(self, account, region, params):
+        from datetime import datetime, timedelta, timezone
+        access_key = f"ASIA{self.random.randrange(16 ** 12):012X}"
+        # arn:aws:iam::<account_id>:role/<name>
+        self.access_keys[access_key] = params['RoleArn'].split(':')[4]
+        return({'Credentials': {'AccessKeyId': access_key, 'SecretAccessKey': 'benchmark',
+                                'SessionToken': 'benchmark', 'Expiration': datetime.now(timezone.utc) + timedelta(hours=1)}})
+
+    # S3 (the config file) -- keys ending in .json get the pre-compiled form make push-config publishes
+    def GetObject(self, account, region, params):
+        from botocore.response import StreamingBody
+        body = self.config_body[os.path.splitext(params['Key'])[1] or '.yaml']
+        return({'Body': StreamingBody(io.BytesIO(body), len(body)), 'ETag': f'"{hash(body):x}"'})
+
+    # EC2 account settings
+    def DescribeRegions(self, account, region, params):
+        return({'Regions': [{'RegionName': r, 'Endpoint': f"ec2.{r}.amazonaws.com", 'OptInStatus': 'opt-in-not-required'} for r in self.regions]})
+
+    def GetEbsEncryptionByDefault(self, account, region, params):
+        return({'EbsEncryptionByDefault': account['regions'][region]['ebs_encryption']})
+
+    def EnableEbsEncryptionByDefault(self, account, region, params):
+        account['regions'][region]['ebs_encryption'] = True
+        return({'EbsEncryptionByDefault': True})
+
+    def GetSnapshotBlockPublicAccessState(self, account, region, params):
+        return({'State': account['regions'][region]['snapshot_block_public_access']})
+
+    def EnableSnapshotBlockPublicAccess(self, account, region, params):
+        account['regions'][region]['snapshot_block_public_access'] = params['State']
+        return({'State': params['State']})
+
+    def GetInstanceMetadataDefaults(self, account, region, params):
+        return({'AccountLevel': dict(account['regions'][region]['imds_defaults'])})
+
+    def ModifyInstanceMetadataDefaults(self, account, region, params):
+        account['regions'][region]['imds_defaults'].update({k: v for k, v in params.items() if v != 'no-preference'})
+        return({'Return': True})
+
+    # EC2 default VPC: one per region, with a subnet per AZ, an internet gateway, and the main
+    # route table, default network ACL and default security group that the teardown leaves alone.
+    def DescribeVpcs(self, account, region, params):
+        vpc_id = account['regions'][region]['default_vpc']
+        return({'Vpcs': [{'VpcId': vpc_id, 'IsDefault': True}] if vpc_id else []})
+
+    def DescribeSubnets(self, account, region, params):
+        vpc_id = account['regions'][region]['default_vpc']
+        return({'Subnets': [{'SubnetId': f"subnet-{vpc_id[4:]}{az}", 'VpcId': vpc_id} for az in 'abc'] if vpc_id else []})
+
+    def DescribeInternetGateways(self, account, region, params):
+        vpc_id = account['regions'][region]['default_vpc']
+        return({'InternetGateways': [{'InternetGatewayId': f"igw-{vpc_id[4:]}", 'Attachments': [{'VpcId': vpc_id, 'State': 'available'}]}] if vpc_id else []})
+
+    def DescribeRouteTables(self, account, region, params):
+        vpc_id = account['regions'][region]['default_vpc']
+        return({'RouteTables': [{'RouteTableId': f"rtb-{vpc_id[4:]}", 'VpcId': vpc_id, 'Associations': [{'Main': True}]}] if vpc_id else []})
+
+    def DescribeSecurityGroups(self, account, region, params):
+        vpc_id = account['regions'][region]['default_vpc']
+        return({'SecurityGroups': [{'GroupId': f"sg-{vpc_id[4:]}", 'GroupName': 'default', 'VpcId': vpc_id}] if vpc_id else []})
+
+    def DescribeNetworkInterfaces(self, account, region, params):
+        return({'NetworkInterfaces': []})
+
+    def DescribeEgressOnlyInternetGateways(self, account, region, params):
+        return({'EgressOnlyInternetGateways': []})
+
+    def DescribeNetworkAcls(self, account, region, params):
+        return({'NetworkAcls': []})
+
+    def DescribeVpcPeeringConnections(self, account, region, params):
+        return({'VpcPeeringConnections': []})
+
+    def DescribeVpcEndpoints(self, account, region, params):
+        return({'VpcEndpoints': []})
+
+    def DescribeVpnGateways(self, account, region, params):
+        return({'VpnGateways': []})
+
+    def DeleteVpc(self, account, region, params):
+        account['regions'][region]['default_vpc'] = None
+        return({})
+
+    # IAM
+    def GetAccountPasswordPolicy(self, account, region, params):
+        if account['password_policy'] is None:
+            raise FakeError(404, 'NoSuchEntity')
+        return({'PasswordPolicy': dict(account['password_policy'])})
+
+    def UpdateAccountPasswordPolicy(self, account, region, params):
+        account['password_policy'] = dict(params)
+        return({})
+
+    # S3 Control
+    def GetPublicAccessBlock(self, account, region, params):
+        if account['public_access_block'] is None:
+            raise FakeError(404, 'NoSuchPublicAccessBlockConfiguration')
+        return({'PublicAccessBlockConfiguration': dict(account['public_access_block'])})
+
+    def PutPublicAccessBlock(self, account, region, params):
+        account['public_access_block'] = dict(params['PublicAccessBlockConfiguration'])
+        return({})
+
+
+class FakeError(Exception):
+    def __init__(self, status, code):
+        self.status = status
+        self.code = code
+
+
+def install(fake):
+    """Send every botocore request to fake instead of the network"""
+    from botocore.client import BaseClient
+    from botocore.endpoint import Endpoint
+    request = threading.local()
+
+    def _do_get_response(self, http_request, operation_model, context):
+        # botocore emits before-send here, so the region deadline is checked before every attempt.
+        # An error from a handler is returned like a failed send, for the retry handler to look at.
+        try:
+            self._event_emitter.emit(f"before-send.{operation_model.service_model.service_id.hyphenize()}.{operation_model.name}",
+                                     request=http_request)
+        except Exception as e:
+            return(None, e)
+        service = operation_model.service_model.endpoint_prefix
+        # Authorization: AWS4-HMAC-SHA256 Credential=<access key>/<date>/<region>/<service>/aws4_request, ...
+        authorization = http_request.headers.get('Authorization', b'')
+        authorization = authorization.decode() if isinstance(authorization, bytes) else authorization
+        access_key = authorization.split('Credential=', 1)[-1].split('/', 1)[0]
+        return(fake.respond(service, operation_model.name, context.get('client_region') or 'us-east-1', request.params, access_key), None)
+
+    if not hasattr(BaseClient, '_benchmark_make_api_call'):
+        BaseClient._benchmark_make_api_call = BaseClient._make_api_call
+
+    def _make_api_call(self, operation_name, api_params):
+        # The stub answers from the caller's kwargs rather than the serialized request
+        request.params = dict(api_params)
+        return(self._benchmark_make_api_call(operation_name, api_params))
+
+    BaseClient._make_api_call = _make_api_call
+    Endpoint._do_get_response = _do_get_response
+
+
+def reset_caches():
+    """Forget everything a warm Lambda container would have cached"""
+    import common
+    import LoadConfigurationLambdaFunction
+    common._CLIENT_CACHE.clear()
+    common._CREDENTIAL_CACHE.clear()
+    common._RATE_LIMITERS.clear()
+    common._LOCAL_ACCOUNT_ID = None
+    common._DENIED_REGIONS.clear()
+    LoadConfigurationLambdaFunction._CONFIG_CACHE.clear()
+    LoadConfigurationLambdaFunction._S3_CLIENT = None
+
+
+def run_handler(name, func, event, fake, max_invocations=20):
+    """
+    Invoke func(event) until it no longer asks for a retry, like the state machine would, and
+    return (event, the handler's stats)
+    """
+    import common
+    before = fake.stats()
+    api_before = dict(common.API_STATS)
+    invocations = 0
+    simulated_wait = 0
+    start = time.perf_counter()
+    while True:
+        invocations += 1
+        event = func(event, None)
+        retry = event.get('progress', {}).get('retry')
+        if not retry or invocations >= max_invocations:
+            break
+        simulated_wait += retry['wait_seconds']
+    wall = time.perf_counter() - start
+    after = fake.stats()
+    calls = {k: v - before['calls'].get(k, 0) for k, v in after['calls'].items() if v - before['calls'].get(k, 0)}
+    errors = {k: v - before['errors'].get(k, 0) for k, v in after['errors'].items() if v - before['errors'].get(k, 0)}
+    return(event, {
+        'handler': name,
+        'wall_seconds': round(wall, 3),
+        'invocations': invocations,
+        'simulated_wait_seconds': simulated_wait,
+        'api_calls': sum(calls.values()),
+        'sts_calls': sum(v for k, v in calls.items() if k.startswith('sts.')),
+        'throttles': common.API_STATS['throttles'] - api_before['throttles'],
+        'rate_limit_wait_seconds': round(common.API_STATS['rate_limit_wait_seconds'] - api_before['rate_limit_wait_seconds'], 3),
+        'calls': calls,
+        'errors': errors,
+    })
+
+
+def benchmark(args):
+    import common
+    import FastPathRunner
+    import LoadConfigurationLambdaFunction
+    import SummarizeResults
+
+    with open(args.config, 'rb') as f:
+        yaml_body = f.read()
+    json_body = json.dumps(LoadConfigurationLambdaFunction.compile_config(yaml_body)).encode()
+    with open(args.event) as f:
+        sample_event = json.loads(f.read().replace('CHANGEME', ACCOUNT_ID))
+
+    # With --emit-metrics, count the EMF log lines instead of printing them (--profile's lines go here too)
+    emf_lines = io.StringIO()
+    common.METRICS_STREAM = emf_lines
+
+    regions = all_regions()[:args.regions]
+    overrides = dict((k, float(v)) for k, v in (o.split('=', 1) for o in args.latency))
+
+    def new_fake():
+        fake = FakeAWS(regions, {'.yaml': yaml_body, '.json': json_body}, args.latency_ms, args.jitter_ms, overrides,
+                       args.throttle_rate, args.opt_in_regions, args.opt_in_calls, args.scp_denied_regions,
+                       args.slow_regions, args.slow_region_ms, args.slow_region_calls, args.seed)
+        install(fake)
+        return(fake)
+
+    results = []
+
+    # One handler per Lambda, in NewAccountStateMachine order
+    fake = new_fake()
+    event = sample_event
+    for name, func in ([('LoadConfigurationLambdaFunction', LoadConfigurationLambdaFunction.handler)]
+                       + [(step.__name__, step.handler) for step in FastPathRunner.PIPELINE]
+                       + [('SummarizeResults', SummarizeResults.handler)]):
+        if not args.warm:
+            reset_caches()
+        event, stats = run_handler(name, func, event, fake)
+        results.append(stats)
+
+    # Everything in one invocation
+    if args.ledger:
+        # Records every unit the run below applies, so the re-run can skip them
+        import ledger
+        common._LEDGER = ledger.SQLiteLedger(':memory:')
+    fake = new_fake()
+    reset_caches()
+    event, stats = run_handler('FastPathRunner', FastPathRunner.handler, dict(sample_event), fake)
+    results.append(stats)
+
+    # The same account again, in a new container, with nothing changed since
+    if args.ledger:
+        fake = new_fake()
+        reset_caches()
+        event, stats = run_handler('FastPathRunner (ledger re-run)', FastPathRunner.handler, dict(sample_event), fake)
+        results.append(stats)
+        common._LEDGER = None
+
+    # A burst of new accounts through the ingestion queue, drained by the dispatcher
+    if args.burst:
+        import IngestionDispatcher
+        IngestionDispatcher.DISPATCH_WORKERS = args.dispatch_workers
+        fake = new_fake()
+        reset_caches()
+        queue = IngestionDispatcher.LocalQueue()
+        for i in range(args.burst):
+            burst_event = json.loads(json.dumps(sample_event))
+            burst_event['detail']['serviceEventDetails']['createAccountStatus']['accountId'] = str(int(ACCOUNT_ID) + i + 1)
+            queue.send(burst_event)
+        drained = {}
+        burst_event, stats = run_handler(f"IngestionDispatcher ({args.burst} accounts)",
+                                         lambda e, c: drained.update(IngestionDispatcher.drain(queue, args.batch_size, args.dispatch_concurrency)) or e,
+                                         {}, fake)
+        stats['queue'] = drained
+        # Clients left in the cache once every account is done with
+        stats['cached_clients'] = len(common._CLIENT_CACHE)
+        results.append(stats)
+
+    if args.profile:
+        with open(args.profile, 'w') as f:
+            f.writelines(line + "\n" for line in emf_lines.getvalue().splitlines() if '"invocation_profile"' in line)
+
+    return({
+        'settings': {k: v for k, v in vars(args).items() if k not in ('json', 'compare')},
+        'regions': regions,
+        'emf_lines': sum(1 for line in emf_lines.getvalue().splitlines() if '"_aws"' in line),
+        'results': results,
+        'messages': event.get('messages', []),
+    })
+
+
+def all_regions():
+    """Real commercial region names, us-east-1 first, so endpoint resolution works as it would in AWS"""
+    import common
+    regions = common.get_session().get_available_regions('ec2')
+    return(sorted(regions, key=lambda r: (r != 'us-east-1', r)))
+
+
+def report(summary, baseline=None):
+    previous = {r['handler']: r for r in baseline['results']} if baseline else {}
+    print(f"{len(summary['regions'])} regions, {summary['settings']['latency_ms']}ms latency, "
+          f"throttle rate {summary['settings']['throttle_rate']}, {summary['settings']['opt_in_regions']} regions not yet enabled, "
+          f"{summary['settings'].get('scp_denied_regions', 0)} denied by SCP"
+          f"{', ' + str(summary['emf_lines']) + ' EMF lines' if summary['settings']['emit_metrics'] else ''}")
+    print(f"{'handler':35} {'wall s':>8} {'calls':>6} {'sts':>4} {'throttles':>9} {'runs':>4}{'   vs baseline' if baseline else ''}")
+    for r in summary['results']:
+        line = f"{r['handler']:35} {r['wall_seconds']:8.3f} {r['api_calls']:6} {r['sts_calls']:4} {r['throttles']:9} {r['invocations']:4}"
+        if r['handler'] in previous:
+            p = previous[r['handler']]
+            change = (r['wall_seconds'] - p['wall_seconds']) / p['wall_seconds'] * 100 if p['wall_seconds'] else 0
+            line += f"   {change:+6.1f}% wall, {r['api_calls'] - p['api_calls']:+d} calls"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the account configurator handlers against simulated AWS accounts")
+    parser.add_argument("--regions", type=int, default=17, help="Number of regions in the simulated account")
+    parser.add_argument("--latency-ms", type=float, default=20, help="Simulated latency of every API call")
+    parser.add_argument("--jitter-ms", type=float, default=5, help="Random +/- jitter added to the latency")
+    parser.add_argument("--latency", action='append', default=[], metavar="SERVICE[.Operation]=MS",
+                        help="Latency for one service or operation, e.g. sts.AssumeRole=150. May be repeated")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of calls answered with Throttling")
+    parser.add_argument("--opt-in-regions", type=int, default=0, help="Regions that answer OptInRequired at first")
+    parser.add_argument("--opt-in-calls", type=int, default=1, help="How many calls each of those regions answers OptInRequired to")
+    parser.add_argument("--scp-denied-regions", type=int, default=0, help="Regions where an SCP denies every EC2 call")
+    parser.add_argument("--slow-regions", type=int, default=0, help="Regions (after us-east-1) that are degraded at first")
+    parser.add_argument("--slow-region-ms", type=float, default=2000, help="Extra latency of each call to a degraded region")
+    parser.add_argument("--slow-region-calls", type=int, default=5, help="How many calls each degraded region is slow for")
+    parser.add_argument("--region-deadline", type=float, help="REGION_DEADLINE_SECONDS for the run")
+    parser.add_argument("--warm", action='store_true', help="Keep clients and credentials cached between handlers")
+    parser.add_argument("--burst", type=int, default=0, help="Also push this many new accounts through the ingestion queue")
+    parser.add_argument("--batch-size", type=int, default=10, help="Queue messages per dispatcher invocation")
+    parser.add_argument("--dispatch-concurrency", type=int, default=2, help="Dispatcher invocations at once")
+    parser.add_argument("--dispatch-workers", type=int, default=5, help="Accounts configured at once per dispatcher invocation")
+    parser.add_argument("--ledger", action='store_true', help="Also re-run FastPathRunner against a ledger of the first run")
+    parser.add_argument("--profile", metavar="FILE", help="Profile every handler invocation into FILE, for scripts/memory-report.py")
+    parser.add_argument("--emit-metrics", action='store_true', help="Record the EMF metrics too, to measure their overhead")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the simulated latency and throttling")
+    parser.add_argument("--config", default=os.path.join(LAMBDA_DIR, '..', 'account-factory-config.yaml'))
+    parser.add_argument("--event", default=os.path.join(LAMBDA_DIR, '..', 'sample-event.json'))
+    parser.add_argument("--json", help="Write the results to this file, to --compare against later")
+    parser.add_argument("--compare", help="A previous --json results file to compare against")
+    parser.add_argument("--log-level", default='WARNING')
+    args = parser.parse_args()
+
+    # Never let the benchmark reach real AWS: fixed fake credentials, and every request is answered by FakeAWS
+    for var in ('AWS_PROFILE', 'AWS_SESSION_TOKEN', 'AWS_STS_REGIONAL_ENDPOINTS'):
+        os.environ.pop(var, None)
+    os.environ.update({
+        'AWS_ACCESS_KEY_ID': 'AKIABENCHMARK', 'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'AWS_DEFAULT_REGION': 'us-east-1', 'AWS_REGION': 'us-east-1',
+        'BUCKET': 'benchmark-bucket', 'CONFIG_FILE': 'account-factory-config.yaml',
+        'ROLE_NAME': 'benchmark-role', 'ROLE_SESSION_NAME': 'account-factory', 'LOG_LEVEL': args.log_level,
+        'EMIT_METRICS': str(args.emit_metrics), 'PROFILE': str(bool(args.profile)),
+    })
+    if args.region_deadline is not None:
+        os.environ['REGION_DEADLINE_SECONDS'] = str(args.region_deadline)
+    sys.path.insert(0, LAMBDA_DIR)
+
+    summary = benchmark(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(summary, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Stage a slim code directory per Lambda: build/functions/<Handler>/ holds the handler module
+# plus only the lambda/ modules it imports (directly, or lazily inside a function). Third-party
+# packages come from the shared dependency layer that make deps builds.
+#
+# Usage: scripts/build-functions.py <template.yaml> <source dir> <output dir>
+
+import ast
+import os
+import re
+import shutil
+import sys
+
+
+def local_imports(source_dir, module):
+    '''Every module in source_dir that module imports, including itself'''
+    found = set()
+    pending = [module]
+    while pending:
+        name = pending.pop()
+        if name in found:
+            continue
+        found.add(name)
+        with open(os.path.join(source_dir, f"{name}.py")) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [a.name for a in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                names = [node.module]
+            else:
+                continue
+            pending += [n for n in names if os.path.exists(os.path.join(source_dir, f"{n}.py"))]
+    return(found)
+
+
+def main(template, source_dir, output_dir):
+    with open(template) as f:
+        # The template uses CloudFormation tags, so find the handlers with a regex instead of a YAML parser
+        handlers = sorted(set(re.findall(r'^\s+Handler: (\w+)\.handler\s*$', f.read(), re.MULTILINE)))
+
+    shutil.rmtree(output_dir, ignore_errors=True)
+    for handler in handlers:
+        modules = local_imports(source_dir, handler)
+        os.makedirs(os.path.join(output_dir, handler))
+        for name in sorted(modules):
+            shutil.copy2(os.path.join(source_dir, f"{name}.py"), os.path.join(output_dir, handler))
+        print(f"{handler}: {', '.join(sorted(modules))}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        print(f"Usage: {sys.argv[0]} <template.yaml> <source dir> <output dir>")
+        sys.exit(1)
+    main(*sys.argv[1:])
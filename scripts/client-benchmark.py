@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Micro-benchmark of what it costs to build the boto3 clients a step needs, one per service and
+# region, the three ways a handler could get them:
+#
+#   new-session   a new boto3 session per client, so every client loads and parses its service model
+#   shared        common's process-wide session, whose loader has already parsed the model after the
+#                 first client of each service
+#   cached        common.get_local_client() handing back a client it has already built
+#
+# Each mode runs in a fresh interpreter, so the first client of each mode pays the same cold cost
+# a new Lambda container does, and the memory it reports is the growth in peak RSS. No API calls are
+# made, so it runs offline.
+#
+# Usage: scripts/client-benchmark.py [--services ec2,sts] [--regions N] [--json out.json]
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda')
+MODES = ['new-session', 'shared', 'cached']
+
+# Clients are built with explicit (fake) keys, as get_client() does, so building one never goes
+# looking for credentials
+FAKE_KEYS = {'aws_access_key_id': 'AKIAEXAMPLE', 'aws_secret_access_key': 'example', 'aws_session_token': 'example'}
+
+
+def build_clients(mode, services, regions):
+    '''Build a client per service and region the given way; returns the ms each one took, in order'''
+    sys.path.insert(0, LAMBDA_DIR)
+    import common
+    import boto3
+
+    timings = []
+    for service in services:
+        for region in regions:
+            start = time.perf_counter()
+            if mode == 'new-session':
+                boto3.session.Session().client(service, region_name=region, config=common._CLIENT_CONFIG, **FAKE_KEYS)
+            elif mode == 'shared':
+                with common._CLIENT_LOCK:
+                    common._new_client(service, region, **FAKE_KEYS)
+            else:
+                common.get_local_client(service, region)
+            timings.append((time.perf_counter() - start) * 1000)
+    return(timings)
+
+
+def run_mode(mode, services, regions):
+    '''Run one mode in its own interpreter and return its measurements'''
+    env = dict(os.environ, AWS_ACCESS_KEY_ID='AKIAEXAMPLE', AWS_SECRET_ACCESS_KEY='example', AWS_DEFAULT_REGION='us-east-1')
+    result = subprocess.run([sys.executable, __file__, '--child', mode, '--services', ','.join(services),
+                             '--region-list', ','.join(regions)], env=env, capture_output=True, text=True, check=True)
+    return(json.loads(result.stdout))
+
+
+def child(mode, services, regions):
+    # Import boto3 and botocore up front, so the first client isn't charged for the imports
+    sys.path.insert(0, LAMBDA_DIR)
+    import common
+    common.get_session()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if mode == 'cached':
+        # Warm the cache, then time the clients a later step in the same container asks for
+        build_clients('cached', services, regions)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = build_clients(mode, services, regions)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'mode': mode, 'timings_ms': timings, 'rss_growth_kb': rss_after - rss_before,
+                      'max_pool_connections': common._CLIENT_CONFIG.max_pool_connections,
+                      'tcp_keepalive': common._CLIENT_CONFIG.tcp_keepalive}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time building boto3 clients with and without the shared session")
+    parser.add_argument("--services", default="ec2,sts,iam,s3control", help="Comma separated services to build clients for")
+    parser.add_argument("--regions", type=int, default=17, help="Number of regions to build a client in for each service")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--region-list", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    services = args.services.split(',')
+
+    if args.child:
+        child(args.child, services, args.region_list.split(','))
+        return(0)
+
+    sys.path.insert(0, LAMBDA_DIR)
+    import common
+    regions = common.get_session().get_available_regions('ec2')[:args.regions]
+
+    print(f"{len(services)} services x {len(regions)} regions = {len(services) * len(regions)} clients per mode")
+    print(f"{'mode':12} {'first ms':>9} {'per client ms':>14} {'total ms':>9} {'peak RSS +MB':>13}")
+    results = {}
+    for mode in MODES:
+        result = run_mode(mode, services, regions)
+        timings = result['timings_ms']
+        rest = timings[1:] or timings
+        results[mode] = {
+            'first_ms': round(timings[0], 4),
+            'per_client_ms': round(sum(rest) / len(rest), 4),
+            'total_ms': round(sum(timings), 2),
+            'rss_growth_mb': round(result['rss_growth_kb'] / 1024, 1),
+        }
+        print(f"{mode:12} {results[mode]['first_ms']:9.1f} {results[mode]['per_client_ms']:14.2f} {results[mode]['total_ms']:9.1f} {results[mode]['rss_growth_mb']:13.1f}")
+
+    saved = results['new-session']['total_ms'] - results['shared']['total_ms']
+    print(f"Shared session saves {saved / (len(services) * len(regions)):.1f} ms per client ({saved:.0f} ms in all); "
+          f"a cached client costs {results['cached']['per_client_ms'] * 1000:.1f} us")
+    print(f"Client config: max_pool_connections={result['max_pool_connections']} tcp_keepalive={result['tcp_keepalive']}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'services': services, 'regions': regions, 'results': results}, f, indent=2)
+    return(0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
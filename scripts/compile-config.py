@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Validate account-factory-config.yaml and write the resolved JSON form that
+# LoadConfigurationLambdaFunction prefers over parsing the YAML.
+#
+# Usage: scripts/compile-config.py <config.yaml> <config.json>
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+from LoadConfigurationLambdaFunction import compile_config
+
+if len(sys.argv) != 3:
+    print(f"USAGE: {sys.argv[0]} <config.yaml> <config.json>")
+    sys.exit(1)
+
+# The Lambda only uses the JSON while the YAML in the bucket is the one it was compiled from, so
+# publish both (make push-config)
+with open(sys.argv[1], "rb") as f:
+    try:
+        config = compile_config(f.read(), strict=True)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+with open(sys.argv[2], "w") as f:
+    json.dump(config, f, indent=2, sort_keys=True)
+print(f"Wrote {sys.argv[2]} (config_version {config['config_version']})")
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measure how long each handler takes to import (the part of a cold start we control) in a fresh
+# interpreter with python -X importtime, and fail if a handler goes over its budget or imports one
+# of the heavy modules that should only be loaded when a client is built or YAML is parsed.
+#
+# Usage: scripts/import-budget.py <source dir> [runs]
+
+import os
+import subprocess
+import sys
+
+HANDLERS = ['LoadConfigurationLambdaFunction', 'ConfigurePasswordPolicyFunction', 'EnableS3BlockPublicAccess',
+            'EnableRegionalSettings', 'DeleteDefaultVPCs', 'SummarizeResults', 'FastPathRunner', 'IngestionDispatcher']
+
+# Milliseconds of cumulative import time allowed per handler (best of the runs).
+# IMPORT_BUDGET_MS overrides the default for every handler, e.g. on a slow build host.
+DEFAULT_BUDGET_MS = float(os.environ.get('IMPORT_BUDGET_MS', 50))
+IMPORT_BUDGET_MS = {'FastPathRunner': DEFAULT_BUDGET_MS * 1.5}
+
+# Modules that must not be loaded just by importing a handler
+DEFERRED_MODULES = ['boto3', 'botocore.session', 'botocore.client', 'botocore.waiter', 'yaml']
+
+
+def measure(source_dir, handler):
+    '''Returns (cumulative ms, set of modules imported) for one fresh import of handler'''
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(source_dir))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {handler}"],
+                            cwd=source_dir, env=env, capture_output=True, text=True, check=True)
+    cumulative = None
+    modules = set()
+    # import time: self [us] | cumulative | imported package
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, total, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+        if name.strip() == handler:
+            cumulative = int(total) / 1000
+    return(cumulative, modules)
+
+
+def main(source_dir, runs=5):
+    failures = []
+    for handler in HANDLERS:
+        timings = []
+        for i in range(runs):
+            ms, modules = measure(source_dir, handler)
+            timings.append(ms)
+        budget = IMPORT_BUDGET_MS.get(handler, DEFAULT_BUDGET_MS)
+        deferred = [m for m in DEFERRED_MODULES if m in modules]
+        print(f"{handler:35} {min(timings):7.1f} ms (budget {budget:.0f} ms){'  imports ' + ', '.join(deferred) if deferred else ''}")
+        if min(timings) > budget:
+            failures.append(f"{handler} took {min(timings):.1f} ms to import, over its {budget:.0f} ms budget")
+        if deferred:
+            failures.append(f"{handler} imports {', '.join(deferred)} at load time")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print(f"Usage: {sys.argv[0]} <source dir> [runs]")
+        sys.exit(1)
+    sys.exit(main(sys.argv[1], *[int(a) for a in sys.argv[2:]]))
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Recommend a MemorySize for each function from the invocation profiles the handlers log with
+# PROFILE=true (see common.profiled). Profiles are read from the functions' CloudWatch log groups,
+# or from files of log lines (e.g. exported logs, or scripts/benchmark.py --profile).
+#
+# Lambda hands out CPU in proportion to memory, one vCPU at 1769 MB. A function needs enough memory
+# for its peak RSS plus headroom, and enough CPU that it isn't starved: the CPU it used divided by
+# its wall time is how many vCPUs it kept busy. The GIL keeps these handlers to about one vCPU, so
+# more than 1769 MB only ever buys memory. tracemalloc inflates CPU time, so when a function has
+# profiles taken with PROFILE_TOP_ALLOCATIONS=0 only those are used for its CPU.
+#
+# Usage: scripts/memory-report.py [--stack NAME | --log-group NAME ...] [--hours 24] [files ...]
+
+import argparse
+import json
+import math
+import sys
+import time
+
+MB_PER_VCPU = 1769
+MIN_MEMORY_MB = 128
+# Peak RSS is multiplied by this, for invocations bigger than the ones profiled
+MEMORY_HEADROOM = 1.5
+# The share of its CPU allowance a function should use at its p95
+TARGET_CPU_UTILIZATION = 0.7
+# Below this much CPU time per invocation, running on a fraction of a vCPU costs too little to size for
+MIN_CPU_MS = 100
+# Recommendations are rounded up to a multiple of this
+MEMORY_STEP_MB = 64
+
+
+def parse_profiles(lines):
+    '''The invocation profiles in lines of log output; anything else is skipped'''
+    for line in lines:
+        start = line.find('{')
+        if start < 0 or '"invocation_profile"' not in line:
+            continue
+        try:
+            profile = json.loads(line[start:])
+        except ValueError:
+            continue
+        if profile.get('type') == 'invocation_profile':
+            yield profile
+
+
+def fetch_profiles(log_groups, hours):
+    '''The invocation profiles logged to log_groups in the last hours'''
+    import boto3
+    logs = boto3.client('logs')
+    start = int((time.time() - hours * 3600) * 1000)
+    for log_group in log_groups:
+        paginator = logs.get_paginator('filter_log_events')
+        for page in paginator.paginate(logGroupName=log_group, startTime=start, filterPattern='{ $.type = "invocation_profile" }'):
+            yield from parse_profiles(e['message'] for e in page['events'])
+
+
+def stack_log_groups(stack):
+    '''The log groups of every function in the stack'''
+    import boto3
+    log_groups = []
+    paginator = boto3.client('cloudformation').get_paginator('list_stack_resources')
+    for page in paginator.paginate(StackName=stack):
+        for resource in page['StackResourceSummaries']:
+            if resource['ResourceType'] == 'AWS::Lambda::Function':
+                log_groups.append(f"/aws/lambda/{resource['PhysicalResourceId']}")
+    return(log_groups)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return(values[min(len(values) - 1, int(math.ceil(p / 100 * len(values))) - 1)])
+
+
+def recommend(profiles):
+    '''Summarize one function's profiles and recommend its MemorySize'''
+    rss = [p['peak_rss_mb'] for p in profiles]
+    untraced = [p for p in profiles if p.get('traced_peak_mb') is None]
+    # vCPUs kept busy: CPU time over wall time
+    cpu = [p['cpu_ms'] / p['wall_ms'] for p in (untraced or profiles) if p['wall_ms'] > 0]
+    cpu_ms = percentile([p['cpu_ms'] for p in (untraced or profiles)], 95)
+    memory_mb = max(rss) * MEMORY_HEADROOM
+    cpu_mb = 0
+    if cpu and cpu_ms >= MIN_CPU_MS:
+        cpu_mb = min(MB_PER_VCPU, percentile(cpu, 95) / TARGET_CPU_UTILIZATION * MB_PER_VCPU)
+    traced = [p['traced_peak_mb'] for p in profiles if p.get('traced_peak_mb') is not None]
+    recommended = max(MIN_MEMORY_MB, int(math.ceil(max(memory_mb, cpu_mb) / MEMORY_STEP_MB)) * MEMORY_STEP_MB)
+    configured = [p['memory_size_mb'] for p in profiles if p.get('memory_size_mb')]
+    return({
+        'invocations': len(profiles),
+        'cold_starts': sum(1 for p in profiles if p.get('cold_start')),
+        'configured_mb': max(configured) if configured else None,
+        'peak_rss_mb': max(rss),
+        'p50_rss_mb': percentile(rss, 50),
+        'traced_peak_mb': max(traced) if traced else None,
+        'p95_cpu_ms': cpu_ms,
+        'p95_wall_ms': percentile([p['wall_ms'] for p in profiles], 95),
+        'p95_vcpus': round(percentile(cpu, 95), 2) if cpu else None,
+        'recommended_mb': recommended,
+        'bound_by': 'memory' if memory_mb >= cpu_mb else 'cpu',
+    })
+
+
+def top_allocations(profiles, count):
+    '''The allocation sites holding the most memory at the end of any one invocation'''
+    largest = {}
+    for p in profiles:
+        for a in p.get('top_allocations', []):
+            largest[a['where']] = max(largest.get(a['where'], 0), a['kb'])
+    return(sorted(largest.items(), key=lambda a: -a[1])[:count])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recommend a Lambda MemorySize per function from PROFILE=true invocation profiles")
+    parser.add_argument("files", nargs="*", help="Files of log lines with invocation profiles ('-' for stdin)")
+    parser.add_argument("--stack", help="Read the profiles from the log groups of every function in this stack")
+    parser.add_argument("--log-group", action='append', default=[], help="Read the profiles from this log group. May be repeated")
+    parser.add_argument("--hours", type=float, default=24, help="How far back to read the log groups")
+    parser.add_argument("--allocations", type=int, default=3, help="Top allocation sites to show per function")
+    parser.add_argument("--json", help="Write the recommendations to this file")
+    args = parser.parse_args()
+
+    profiles = []
+    for name in args.files:
+        with (sys.stdin if name == '-' else open(name)) as f:
+            profiles += parse_profiles(f)
+    log_groups = args.log_group + (stack_log_groups(args.stack) if args.stack else [])
+    if log_groups:
+        profiles += fetch_profiles(log_groups, args.hours)
+    if not profiles:
+        print("No invocation profiles found. Deploy (or run) the functions with PROFILE=true to collect some.")
+        return(1)
+
+    by_function = {}
+    for p in profiles:
+        by_function.setdefault(p['function'], []).append(p)
+
+    report = {}
+    print(f"{'function':45} {'runs':>5} {'now MB':>7} {'peak RSS':>9} {'traced':>7} {'p95 cpu ms':>10} {'p95 vCPU':>8} {'recommend':>9}")
+    for function in sorted(by_function):
+        r = recommend(by_function[function])
+        r['top_allocations'] = top_allocations(by_function[function], args.allocations)
+        report[function] = r
+        print(f"{function:45} {r['invocations']:5} {r['configured_mb'] or '-':>7} {r['peak_rss_mb']:9.1f} {r['traced_peak_mb'] if r['traced_peak_mb'] is not None else '-':>7} "
+              f"{r['p95_cpu_ms']:10.1f} {r['p95_vcpus'] if r['p95_vcpus'] is not None else '-':>8} {r['recommended_mb']:6} MB ({r['bound_by']})")
+        for where, kb in r['top_allocations']:
+            print(f"    {kb:10.1f} KB  {where}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return(0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
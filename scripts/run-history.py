@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Aggregate the run history (see lambda/run_history.py) the pipeline records with RUN_HISTORY set:
+# end-to-end run times, per-unit latency percentiles, API calls and retries grouped by step, region
+# and/or config_version, and the groups whose p95 got worse.
+#
+# Regressions compare the last --window days with the --window days before them, or with
+# --compare config_version the latest config version with the one before it. Units the ledger
+# skipped (already_applied) take no time, so they're left out of the latencies.
+#
+# Usage: scripts/run-history.py [--s3 s3://bucket/run-history/ | files ...] [--days 30] [--by step,region]
+#                               [--compare period|config_version] [--window 7] [--threshold 0.2] [--json out.json]
+
+from datetime import datetime, timedelta, timezone
+import argparse
+import json
+import math
+import os
+import sys
+
+GROUP_KEYS = ['step', 'region', 'config_version', 'account', 'outcome']
+# Units that didn't do anything, and so say nothing about latency
+UNTIMED_OUTCOMES = ('already_applied',)
+
+
+def parse_records(lines):
+    '''The run history records in lines of JSON; blank and unparseable lines are skipped'''
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record.get('type') in ('unit', 'run'):
+            yield record
+
+
+def read_local(paths):
+    '''The records in files, or in the .jsonl files under directories'''
+    for path in paths:
+        if path == '-':
+            yield from parse_records(sys.stdin)
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for name in sorted(files):
+                    if name.endswith('.jsonl'):
+                        with open(os.path.join(root, name)) as f:
+                            yield from parse_records(f)
+        else:
+            with open(path) as f:
+                yield from parse_records(f)
+
+
+def read_s3(url, days):
+    '''The records under s3://bucket/prefix, listing only the dt= partitions of the last days'''
+    import boto3
+    from concurrent.futures import ThreadPoolExecutor
+    bucket, _, prefix = url[len('s3://'):].partition('/')
+    s3 = boto3.client('s3')
+    today = datetime.now(timezone.utc).date()
+    keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for d in range(int(math.ceil(days)) + 1):
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}dt={today - timedelta(days=d)}/"):
+            keys += [o['Key'] for o in page.get('Contents', [])]
+
+    def fetch(key):
+        return(list(parse_records(s3.get_object(Bucket=bucket, Key=key)['Body'].read().decode().splitlines())))
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for records in executor.map(fetch, keys):
+            yield from records
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return(values[min(len(values) - 1, int(math.ceil(p / 100 * len(values))) - 1)])
+
+
+def summarize(records, value='ms'):
+    '''Count, latency percentiles, mean API calls and retries, and outcomes of a group of records'''
+    timed = [r[value] for r in records if r.get(value) is not None and r.get('outcome') not in UNTIMED_OUTCOMES]
+    calls = [r['api_calls'] for r in records if r.get('api_calls') is not None]
+    outcomes = {}
+    for r in records:
+        if 'outcome' in r:
+            outcomes[r['outcome']] = outcomes.get(r['outcome'], 0) + 1
+    return({
+        'count': len(records),
+        'p50_ms': percentile(timed, 50) if timed else None,
+        'p95_ms': percentile(timed, 95) if timed else None,
+        'max_ms': max(timed) if timed else None,
+        'mean_api_calls': round(sum(calls) / len(calls), 1) if calls else None,
+        'retries': sum(r.get('retries') or 0 for r in records),
+        'outcomes': outcomes,
+    })
+
+
+def group(records, keys):
+    groups = {}
+    for r in records:
+        groups.setdefault(tuple(str(r.get(k)) for k in keys), []).append(r)
+    return(groups)
+
+
+def split_for_regressions(records, compare, window):
+    '''(baseline, current, labels): the records to compare, by period or by config version'''
+    if compare == 'config_version':
+        # Versions in the order they were first seen
+        first_seen = {}
+        for r in sorted(records, key=lambda r: r['recorded_at']):
+            first_seen.setdefault(r.get('config_version'), r['recorded_at'])
+        versions = sorted(first_seen, key=first_seen.get)
+        if len(versions) < 2:
+            return([], [], None)
+        return([r for r in records if r.get('config_version') == versions[-2]],
+               [r for r in records if r.get('config_version') == versions[-1]],
+               (f"config {versions[-2]}", f"config {versions[-1]}"))
+    now = datetime.now(timezone.utc)
+    current_start = (now - timedelta(days=window)).isoformat()
+    baseline_start = (now - timedelta(days=2 * window)).isoformat()
+    return([r for r in records if baseline_start <= r['recorded_at'] < current_start],
+           [r for r in records if r['recorded_at'] >= current_start],
+           (f"previous {window:g}d", f"last {window:g}d"))
+
+
+def regressions(baseline, current, keys, threshold, min_samples):
+    '''The groups whose p95 in current is more than threshold worse than in baseline'''
+    found = []
+    before = group(baseline, keys)
+    for key, records in group(current, keys).items():
+        if key not in before:
+            continue
+        old, new = summarize(before[key]), summarize(records)
+        if old['p95_ms'] is None or new['p95_ms'] is None or min(old['count'], new['count']) < min_samples:
+            continue
+        if new['p95_ms'] > old['p95_ms'] * (1 + threshold):
+            found.append({'group': dict(zip(keys, key)), 'baseline': old, 'current': new,
+                          'p95_change': round(new['p95_ms'] / max(old['p95_ms'], 1) - 1, 3)})
+    return(sorted(found, key=lambda f: -f['p95_change']))
+
+
+def fmt(ms):
+    return('-' if ms is None else f"{ms / 1000:.2f}s" if ms >= 10000 else f"{ms}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Percentiles and regressions from the account configurator's run history")
+    parser.add_argument("files", nargs="*", help="Run history files, or directories of them ('-' for stdin)")
+    parser.add_argument("--s3", help="Read the run history under this s3://bucket/prefix/")
+    parser.add_argument("--days", type=float, default=30, help="Only use runs recorded in the last this many days")
+    parser.add_argument("--by", default="step", help=f"Comma separated keys to group the units by, from {', '.join(GROUP_KEYS)}")
+    parser.add_argument("--compare", choices=['period', 'config_version'], default='period', help="What to look for regressions between")
+    parser.add_argument("--window", type=float, default=7, help="With --compare period, the days in each period")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Report groups whose p95 grew by more than this fraction")
+    parser.add_argument("--min-samples", type=int, default=5, help="Units a group needs on both sides to be compared")
+    parser.add_argument("--include-audit", action='store_true', help="Include audit_only runs")
+    parser.add_argument("--json", help="Write the report to this file")
+    args = parser.parse_args()
+    keys = args.by.split(',')
+    for key in keys:
+        if key not in GROUP_KEYS:
+            parser.error(f"--by {key} isn't one of {', '.join(GROUP_KEYS)}")
+
+    records = list(read_local(args.files)) + (list(read_s3(args.s3, args.days)) if args.s3 else [])
+    since = (datetime.now(timezone.utc) - timedelta(days=args.days)).isoformat()
+    records = [r for r in records if r['recorded_at'] >= since and (args.include_audit or not r.get('audit_only'))]
+    runs = [r for r in records if r['type'] == 'run']
+    units = [r for r in records if r['type'] == 'unit']
+    if not runs:
+        print("No runs found. Deploy with pRunHistory: Enabled (or set RUN_HISTORY) to record them.")
+        return(1)
+
+    report = {'runs': summarize(runs, 'duration_ms'), 'groups': {}, 'regressions': []}
+    report['runs'].update(mean_api_calls=round(sum(r['api_calls'] for r in runs) / len(runs), 1), retries=sum(r['retries'] for r in runs))
+    r = report['runs']
+    print(f"{r['count']} runs of {len(set(run['account'] for run in runs))} accounts in the last {args.days:g} days: end to end "
+          f"p50 {fmt(r['p50_ms'])}, p95 {fmt(r['p95_ms'])}, max {fmt(r['max_ms'])}; {r['mean_api_calls']} API calls and "
+          f"{r['retries'] / len(runs):.1f} retries per run")
+    print()
+
+    width = max([len(' / '.join(keys))] + [len(' / '.join(k)) for k in group(units, keys)])
+    print(f"{' / '.join(keys):{width}} {'units':>6} {'p50':>8} {'p95':>8} {'max':>8} {'calls':>6} {'retries':>7}  outcomes")
+    for key, records in sorted(group(units, keys).items()):
+        s = summarize(records)
+        report['groups'][' / '.join(key)] = s
+        print(f"{' / '.join(key):{width}} {s['count']:6} {fmt(s['p50_ms']):>8} {fmt(s['p95_ms']):>8} {fmt(s['max_ms']):>8} "
+              f"{s['mean_api_calls'] if s['mean_api_calls'] is not None else '-':>6} {s['retries']:7}  "
+              + ", ".join(f"{o} {n}" for o, n in sorted(s['outcomes'].items())))
+
+    baseline, current, labels = split_for_regressions(units, args.compare, args.window)
+    print()
+    if labels is None:
+        print("Only one config version in the history, nothing to compare")
+    else:
+        report['regressions'] = regressions(baseline, current, keys, args.threshold, args.min_samples)
+        print(f"p95 regressions of more than {args.threshold:.0%}, {labels[0]} -> {labels[1]}:")
+        for f in report['regressions']:
+            print(f"  {' / '.join(f['group'].values())}: p95 {fmt(f['baseline']['p95_ms'])} -> {fmt(f['current']['p95_ms'])} "
+                  f"({f['p95_change']:+.0%}), p50 {fmt(f['baseline']['p50_ms'])} -> {fmt(f['current']['p50_ms'])}")
+        if not report['regressions']:
+            print("  none")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return(0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
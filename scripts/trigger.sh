@@ -22,7 +22,8 @@ if [[ -z $ACCOUNT_ID ]] ; then
     exit 1
 fi
 
-RESOURCEID="NewAccountStateMachine"
+# Set RESOURCEID=FastPathStateMachine to trigger the single-invocation pipeline
+RESOURCEID=${RESOURCEID:-NewAccountStateMachine}
 
 if command -v jq &> /dev/null; then
     echo "jq is installed."
@@ -43,7 +44,9 @@ if [ -z $STATEMACHINE_ARN ] ; then
     exit 1
 fi
 
-cat sample-event.json | jq --arg account_id "$ACCOUNT_ID" '.detail.serviceEventDetails.createAccountStatus.accountId = $account_id' > $ACCOUNT_ID-event.json
+# Set AUDIT_ONLY=true to only report drift from the config, without changing anything
+cat sample-event.json | jq --arg account_id "$ACCOUNT_ID" --argjson audit_only "${AUDIT_ONLY:-false}" \
+    '.detail.serviceEventDetails.createAccountStatus.accountId = $account_id | .audit_only = $audit_only' > $ACCOUNT_ID-event.json
 
 echo aws stepfunctions start-execution --state-machine-arn ${STATEMACHINE_ARN} --name "make-trigger-${ACCOUNT_ID}-${DATE}" --input file://$ACCOUNT_ID-event.json
 aws stepfunctions start-execution --state-machine-arn ${STATEMACHINE_ARN} --name "make-trigger-${ACCOUNT_ID}-${DATE}" --input file://$ACCOUNT_ID-event.json
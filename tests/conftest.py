@@ -0,0 +1,54 @@
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The handlers import their shared modules as top level modules, the way Lambda loads them
+from datetime import datetime, timezone
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lambda'))
+# Nothing here talks to AWS, but botocore wants a region and credentials to build a client
+os.environ.update({'AWS_DEFAULT_REGION': 'us-east-1', 'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing'})
+for var in ('AWS_PROFILE', 'AWS_SESSION_TOKEN', 'LEDGER_BACKEND', 'RUN_HISTORY', 'EMIT_METRICS'):
+    os.environ.pop(var, None)
+
+import common  # noqa: E402
+
+
+class FakeContext(object):
+    """The part of the Lambda context the steps use: how long the invocation has left"""
+
+    def __init__(self, remaining_seconds):
+        self.deadline = datetime.now(timezone.utc).timestamp() + remaining_seconds
+
+    def get_remaining_time_in_millis(self):
+        return(int((self.deadline - datetime.now(timezone.utc).timestamp()) * 1000))
+
+
+@pytest.fixture
+def event():
+    """A new account's event, with its regions already discovered"""
+    return({
+        "new_aws_account_id": "123456789012",
+        "cross_account_role_arn": "arn:aws:iam::123456789012:role/AccountConfigurator",
+        "global_config": {},
+        "regions": {"region_names": ["us-east-1", "us-west-2", "eu-west-1"], "discovered_at": datetime.now(timezone.utc).isoformat()},
+    })
+
+
+@pytest.fixture
+def context():
+    return(FakeContext(900))
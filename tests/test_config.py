@@ -0,0 +1,98 @@
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import os
+
+from botocore.exceptions import ClientError
+import pytest
+
+import LoadConfigurationLambdaFunction as loader
+
+CONFIG_YAML = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'account-factory-config.yaml')
+
+
+class FakeS3(object):
+    """get_object over a dict of key -> body, answering conditional GETs the way S3 does"""
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.gets = []
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.gets.append(Key)
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        etag = f'"{hash(self.objects[Key]):x}"'
+        if IfNoneMatch == etag:
+            raise ClientError({'Error': {'Code': '304'}}, 'GetObject')
+        return({'Body': io.BytesIO(self.objects[Key]), 'ETag': etag})
+
+
+@pytest.fixture
+def yaml_body():
+    with open(CONFIG_YAML, 'rb') as f:
+        return(f.read())
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    fake = FakeS3({})
+    monkeypatch.setattr(loader, '_S3_CLIENT', fake)
+    monkeypatch.setattr(loader, '_CONFIG_CACHE', {})
+    monkeypatch.setattr(loader, 'CONFIG_CACHE_SECONDS', 0)
+    return(fake)
+
+
+def test_compiled_config_is_used_while_the_yaml_matches(s3, yaml_body):
+    s3.objects = {'config.yaml': yaml_body, 'config.json': json.dumps(loader.compile_config(yaml_body)).encode()}
+    config = loader.get_config('bucket', 'config.yaml')
+    assert config == loader.resolve_config(loader.parse_yaml(yaml_body))
+    assert 'compiled_from' not in config
+
+
+def test_edited_yaml_wins_over_a_stale_compiled_config(s3, yaml_body):
+    s3.objects = {'config.yaml': yaml_body, 'config.json': json.dumps(loader.compile_config(yaml_body)).encode()}
+    before = loader.get_config('bucket', 'config.yaml')
+    s3.objects['config.yaml'] = yaml_body.replace(b'MinimumPasswordLength: 24', b'MinimumPasswordLength: 20')
+    after = loader.get_config('bucket', 'config.yaml')
+    assert after['account_password_policy']['password_policy']['MinimumPasswordLength'] == 20
+    assert after['config_version'] != before['config_version']
+
+
+def test_compiled_config_without_its_source_falls_back_to_the_yaml(s3, yaml_body):
+    config = loader.resolve_config(loader.parse_yaml(yaml_body))
+    s3.objects = {'config.yaml': yaml_body, 'config.json': json.dumps(dict(config, account_password_policy=None)).encode()}
+    assert loader.get_config('bucket', 'config.yaml') == config
+
+
+def test_invalid_compiled_config_falls_back_to_the_yaml(s3, yaml_body):
+    compiled = loader.compile_config(yaml_body)
+    compiled['default_vpc']['preserve_vpc_regions'] = 'us-east-1'
+    s3.objects = {'config.yaml': yaml_body, 'config.json': json.dumps(compiled).encode()}
+    assert loader.get_config('bucket', 'config.yaml') == loader.resolve_config(loader.parse_yaml(yaml_body))
+
+
+def test_compiled_config_alone(s3, yaml_body):
+    s3.objects = {'config.json': json.dumps(loader.compile_config(yaml_body)).encode()}
+    assert loader.get_config('bucket', 'config.yaml') == loader.resolve_config(loader.parse_yaml(yaml_body))
+
+
+def test_unchanged_yaml_isnt_downloaded_again(s3, yaml_body):
+    s3.objects = {'config.yaml': yaml_body, 'config.json': json.dumps(loader.compile_config(yaml_body)).encode()}
+    loader.get_config('bucket', 'config.yaml')
+    loader.get_config('bucket', 'config.yaml')
+    # Both keys are revalidated, but only answered with 304s the second time
+    assert s3.gets == ['config.json', 'config.yaml'] * 2
@@ -0,0 +1,72 @@
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import boto3
+from botocore.stub import Stubber
+import pytest
+
+import DeleteDefaultVPCs
+
+VPC_ID = 'vpc-11111111'
+VGW_ID = 'vgw-22222222'
+VPN_ID = 'vpn-33333333'
+
+
+def inventory(**resources):
+    empty = {k: [] for k in ('internet_gateways', 'egress_only_internet_gateways', 'subnets', 'route_tables', 'network_acls',
+                             'vpc_peering_connections', 'vpc_endpoints', 'security_groups', 'virtual_private_gateways',
+                             'vpn_connections', 'network_interfaces')}
+    return(dict(empty, **resources))
+
+
+@pytest.fixture
+def ec2(monkeypatch):
+    # One call at a time, so the stubbed responses come in the order the tiers make the calls
+    monkeypatch.setattr(DeleteDefaultVPCs, 'TEARDOWN_CONCURRENCY', 1)
+    monkeypatch.setattr('botocore.waiter.time.sleep', lambda seconds: None)
+    client = boto3.client('ec2', region_name='us-east-1')
+    with Stubber(client) as stubber:
+        yield client, stubber
+        stubber.assert_no_pending_responses()
+
+
+def test_vpn_gateway_waits_for_its_connections(ec2):
+    client, stubber = ec2
+    stubber.add_response('detach_vpn_gateway', {}, {'VpcId': VPC_ID, 'VpnGatewayId': VGW_ID})
+    stubber.add_response('delete_vpn_connection', {}, {'VpnConnectionId': VPN_ID})
+    stubber.add_response('describe_vpn_gateways', {'VpnGateways': [{'VpnGatewayId': VGW_ID, 'VpcAttachments': [{'VpcId': VPC_ID, 'State': 'detached'}]}]},
+                         {'VpnGatewayIds': [VGW_ID]})
+    # Still deleting on the first look, so the gateway has to wait
+    stubber.add_response('describe_vpn_connections', {'VpnConnections': [{'VpnConnectionId': VPN_ID, 'State': 'deleting'}]},
+                         {'VpnConnectionIds': [VPN_ID]})
+    stubber.add_response('describe_vpn_connections', {'VpnConnections': [{'VpnConnectionId': VPN_ID, 'State': 'deleted'}]},
+                         {'VpnConnectionIds': [VPN_ID]})
+    stubber.add_response('delete_vpn_gateway', {}, {'VpnGatewayId': VGW_ID})
+    stubber.add_response('delete_vpc', {}, {'VpcId': VPC_ID})
+    resources = inventory(virtual_private_gateways=[{'VpnGatewayId': VGW_ID}], vpn_connections=[{'VpnConnectionId': VPN_ID}])
+    assert DeleteDefaultVPCs.delete_vpc(client, VPC_ID, resources, 'us-east-1')
+
+
+def test_vpn_connection_already_gone(ec2):
+    client, stubber = ec2
+    stubber.add_response('delete_vpn_connection', {}, {'VpnConnectionId': VPN_ID})
+    stubber.add_client_error('describe_vpn_connections', 'InvalidVpnConnectionID.NotFound', expected_params={'VpnConnectionIds': [VPN_ID]})
+    stubber.add_response('delete_vpc', {}, {'VpcId': VPC_ID})
+    assert DeleteDefaultVPCs.delete_vpc(client, VPC_ID, inventory(vpn_connections=[{'VpnConnectionId': VPN_ID}]), 'us-east-1')
+
+
+def test_dependency_violation_leaves_the_vpc(ec2):
+    client, stubber = ec2
+    stubber.add_client_error('delete_vpc', 'DependencyViolation', expected_params={'VpcId': VPC_ID})
+    assert not DeleteDefaultVPCs.delete_vpc(client, VPC_ID, inventory(), 'us-east-1')
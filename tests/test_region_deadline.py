@@ -0,0 +1,137 @@
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+import pytest
+
+import common
+from conftest import FakeContext
+
+
+def in_thread(func, *args):
+    """func(*args) on a new thread, whose _REGION_DEADLINE has never been set"""
+    result = {}
+
+    def run():
+        try:
+            result['value'] = func(*args)
+        except Exception as e:
+            result['error'] = e
+    t = threading.Thread(target=run)
+    t.start()
+    t.join()
+    if 'error' in result:
+        raise result['error']
+    return(result['value'])
+
+
+def deadline_seen(region, event):
+    return((getattr(common._REGION_DEADLINE, 'at', None), getattr(common._REGION_DEADLINE, 'invocation', False)))
+
+
+def test_timed_without_budget_or_deadline(event):
+    (at, invocation), ms, counts = in_thread(common._timed, 'us-east-1', 'Step', deadline_seen, event, 0, None)
+    assert at is None and not invocation
+    assert counts == {'calls': 0, 'retries': 0}
+
+
+def test_timed_budget_off_with_invocation_deadline(event):
+    # REGION_DEADLINE_SECONDS=0 with a Lambda context: only the invocation deadline applies
+    stop_at = time.monotonic() + 30
+    (at, invocation), ms, counts = in_thread(common._timed, 'us-east-1', 'Step', deadline_seen, event, 0, stop_at)
+    assert at == stop_at and invocation
+
+
+def test_timed_budget_shorter_than_invocation(event):
+    (at, invocation), ms, counts = in_thread(common._timed, 'us-east-1', 'Step', deadline_seen, event, 10, time.monotonic() + 30)
+    assert at is not None and not invocation
+
+
+def test_timed_resets_the_thread(event):
+    common._REGION_DEADLINE.at = time.monotonic() - 1
+    common._REGION_DEADLINE.invocation = True
+    (at, invocation), ms, counts = common._timed('us-east-1', 'Step', deadline_seen, event, 0, None)
+    assert at is None and not invocation
+    assert common._REGION_DEADLINE.at is None and not common._REGION_DEADLINE.invocation
+
+
+def test_regional_step_with_budget_off(event, monkeypatch):
+    monkeypatch.setattr(common, 'REGION_DEADLINE_SECONDS', 0)
+    event = common.run_regional_step('Step', event, lambda region, event: common.CHANGED, context=FakeContext(900))
+    assert event['progress']['retry'] is None
+    assert {r: v['status'] for r, v in event['progress']['results']['Step'].items()} == dict.fromkeys(event['regions']['region_names'], common.CHANGED)
+
+
+def test_budget_off_still_defers_at_the_invocation_deadline(event, monkeypatch):
+    monkeypatch.setattr(common, 'REGION_DEADLINE_SECONDS', 0)
+    monkeypatch.setattr(common, 'DEADLINE_MARGIN_SECONDS', 60)
+
+    def slow(region, event):
+        time.sleep(0.2)
+        common._check_region_deadline('before-call.ec2.DescribeVpcs')
+        return(common.CHANGED)
+
+    # 60.1s left: every region starts, then runs into the invocation deadline before its call
+    event = common.run_regional_step('Step', event, slow, context=FakeContext(60.1))
+    retry = event['progress']['retry']
+    assert retry['reason'] == 'deadline' and retry['wait_seconds'] == 0
+    assert sorted(retry['pending_regions']) == sorted(event['regions']['region_names'])
+
+
+def straggle_in(slow_regions):
+    """A step whose slow_regions go past their budget, and whose other regions are done"""
+    def func(region, event):
+        if region in slow_regions:
+            raise common.RegionDeadlineExceeded(f"{region} went past its time budget")
+        return(common.CHANGED)
+    return(func)
+
+
+def test_not_ready_passes_dont_use_up_the_straggler_cap(event, monkeypatch):
+    monkeypatch.setattr(common, 'REGION_MAX_ATTEMPTS', 2)
+
+    def not_ready(region, event):
+        if region == 'eu-west-1':
+            raise common.RetryAfterDelay("eu-west-1 isn't ready")
+        return(common.CHANGED)
+
+    for attempt in range(1, 4):
+        event = common.run_regional_step('Step', event, not_ready)
+        assert event['progress']['retry']['attempt'] == attempt
+        assert event['progress']['retry']['straggler_passes'] == 0
+    # Three passes in, a straggler still gets REGION_MAX_ATTEMPTS passes of its own
+    event = common.run_regional_step('Step', event, straggle_in(['eu-west-1']))
+    retry = event['progress']['retry']
+    assert retry['reason'] == 'straggler' and retry['straggler_passes'] == 1 and retry['attempt'] == 4
+    with pytest.raises(common.RegionDeadlineExceeded):
+        common.run_regional_step('Step', event, straggle_in(['eu-west-1']))
+
+
+def test_budget_doubles_only_on_straggler_passes(event, monkeypatch):
+    monkeypatch.setattr(common, 'REGION_DEADLINE_SECONDS', 10)
+    budgets = []
+
+    def record_budget(region, step, func, event, budget=None, stop_at=None):
+        budgets.append(budget)
+        raise common.RetryAfterDelay("not ready")
+    monkeypatch.setattr(common, '_timed', record_budget)
+    event['progress'] = common.new_progress()
+    event['progress']['retry'] = {"step": "Step", "reason": "not_ready", "attempt": 3, "straggler_passes": 1,
+                                  "pending_regions": ['us-east-1'], "wait_seconds": 60}
+    event['progress']['completed_regions']['Step'] = ['us-west-2', 'eu-west-1']
+    event = common.run_regional_step('Step', event, None)
+    assert budgets == [20]
+    assert event['progress']['retry']['attempt'] == 4 and event['progress']['retry']['straggler_passes'] == 1
@@ -0,0 +1,72 @@
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import common
+import LoadConfigurationLambdaFunction as loader
+
+
+def not_enabled(cross_account_role_arn, region_filter=None):
+    raise common.RetryAfterDelay("Account Not Fully Enabled")
+
+
+def discovered(cross_account_role_arn, region_filter=None):
+    return({"region_names": ["us-east-1"], "opt_in_status": {"us-east-1": "opt-in-not-required"}, "excluded": {},
+            "filter": region_filter, "discovered_at": "2024-01-01T00:00:00+00:00"})
+
+
+@pytest.fixture
+def new_event(monkeypatch):
+    monkeypatch.setenv('ROLE_NAME', 'AccountConfigurator')
+    monkeypatch.setattr(loader, 'targets_local_account', lambda arn: True)
+    monkeypatch.setattr(loader, 'discover_regions', not_enabled)
+    return(loader.build_event('123456789012', {'region_filter': None}))
+
+
+def test_undiscovered_regions_back_off_then_fail(new_event, monkeypatch):
+    monkeypatch.setattr(loader, 'REGION_MAX_ATTEMPTS', 4)
+    assert new_event['regions']['retry'] == {"attempt": 1, "wait_seconds": common.RETRY_BASE_SECONDS}
+    event = loader.handler(new_event, None)
+    assert event['regions']['retry'] == {"attempt": 2, "wait_seconds": 2 * common.RETRY_BASE_SECONDS}
+    event = loader.handler(event, None)
+    assert event['regions']['retry']['attempt'] == 3
+    with pytest.raises(common.RetryAfterDelay):
+        loader.handler(event, None)
+
+
+def test_regions_discovered_on_a_later_try(new_event, monkeypatch):
+    monkeypatch.setattr(loader, 'discover_regions', discovered)
+    event = loader.handler(new_event, None)
+    assert event['regions']['region_names'] == ["us-east-1"]
+    assert 'retry' not in event['regions']
+
+
+def test_regions_discovered_by_a_step_are_reused(monkeypatch):
+    calls = []
+
+    def discover(cross_account_role_arn, region_filter=None):
+        calls.append(region_filter)
+        return(dict(discovered(cross_account_role_arn, region_filter), discovered_at=common.datetime.now(common.timezone.utc).isoformat(),
+                    excluded={"eu-west-1": "denied_by_config"}))
+    monkeypatch.setattr(common, 'discover_regions', discover)
+    event = {"new_aws_account_id": "123456789012", "cross_account_role_arn": "arn:aws:iam::123456789012:role/AccountConfigurator",
+             "global_config": {}, "regions": {"filter": {"deny_regions": ["eu-west-1"]}}, "progress": common.new_progress()}
+    for step in ('EnableRegionalSettings', 'DeleteDefaultVPCs'):
+        event = common.run_regional_step(step, event, lambda region, event: common.CHANGED)
+        # What a state hands on to the next one
+        event['progress'] = {k: event['progress'][k] for k in ('results', 'completed_regions', 'retry', 'regions')}
+    assert calls == [{"deny_regions": ["eu-west-1"]}]
+    assert list(event['progress']['results']['DeleteDefaultVPCs']) == ["us-east-1"]
+    assert "Skipped eu-west-1 in 123456789012: in region_filter.deny_regions" in common.render_messages(event)
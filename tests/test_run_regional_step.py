@@ -0,0 +1,203 @@
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError, EndpointConnectionError
+import pytest
+
+import common
+from conftest import FakeContext
+
+DESCRIBE_VPCS_OK = b'<DescribeVpcsResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/"><vpcSet/></DescribeVpcsResponse>'
+INTERNAL_ERROR = b'<Response><Errors><Error><Code>InternalError</Code><Message>try again</Message></Error></Errors></Response>'
+
+
+class Raw(object):
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+class Step(object):
+    """A regional step whose regions behave as told, counting the regions it was run in"""
+
+    def __init__(self, not_ready=(), slow=(), fail=()):
+        self.not_ready, self.slow, self.fail = set(not_ready), set(slow), set(fail)
+        self.ran = []
+        self.lock = threading.Lock()
+
+    def __call__(self, region, event):
+        with self.lock:
+            self.ran.append(region)
+        if region in self.not_ready:
+            raise common.RetryAfterDelay(f"{region} isn't ready")
+        if region in self.slow:
+            raise EndpointConnectionError(endpoint_url=f"https://ec2.{region}.amazonaws.com")
+        if region in self.fail:
+            raise ClientError({'Error': {'Code': 'UnauthorizedOperation', 'Message': 'no'}}, 'DescribeVpcs')
+        return(common.CHANGED)
+
+
+def statuses(event, step='Step'):
+    return({r: result['status'] for r, result in event['progress']['results'].get(step, {}).items()})
+
+
+@pytest.fixture
+def regions(event):
+    return(event['regions']['region_names'])
+
+
+@pytest.fixture
+def ec2():
+    """A real EC2 client from common, with its hooks, whose requests go to the answer() the test sets"""
+    client = common._new_client('ec2', 'us-east-1', aws_access_key_id='testing', aws_secret_access_key='testing')
+    sent = []
+
+    def send(request, **kwargs):
+        sent.append(time.monotonic())
+        return(client.answer())
+    # Registered after common's hooks, so its deadline check runs on each attempt before this answers
+    client.meta.events.register('before-send.ec2', send)
+    client.sent = sent
+    yield client
+    client.close()
+
+
+def test_all_regions_complete(event, regions):
+    step = Step()
+    event = common.run_regional_step('Step', event, step)
+    assert statuses(event) == dict.fromkeys(regions, common.CHANGED)
+    assert event['progress']['completed_regions']['Step'] == regions
+    assert event['progress']['retry'] is None
+
+
+def test_not_ready_regions_back_off_and_resume(event, regions):
+    step = Step(not_ready=['eu-west-1'])
+    waits = []
+    for attempt in range(1, 4):
+        event = common.run_regional_step('Step', event, step)
+        retry = event['progress']['retry']
+        assert retry['reason'] == 'not_ready' and retry['pending_regions'] == ['eu-west-1'] and retry['attempt'] == attempt
+        waits.append(retry['wait_seconds'])
+    assert waits == [common.backoff_seconds(1), common.backoff_seconds(2), common.backoff_seconds(3)]
+    assert waits == sorted(waits) and waits[0] == common.RETRY_BASE_SECONDS
+
+    step.not_ready.clear()
+    event = common.run_regional_step('Step', event, step)
+    assert event['progress']['retry'] is None
+    assert statuses(event) == dict.fromkeys(regions, common.CHANGED)
+    assert event['progress']['results']['Step']['eu-west-1']['attempt'] == 4
+    # The completed regions ran once; only the pending one was retried
+    assert sorted(step.ran) == sorted(regions + ['eu-west-1'] * 3)
+
+
+def test_backoff_is_capped(monkeypatch):
+    assert common.backoff_seconds(50) == common.RETRY_MAX_SECONDS
+
+
+def test_stragglers_get_a_bigger_budget_then_fail_the_step(event, regions, monkeypatch):
+    monkeypatch.setattr(common, 'REGION_MAX_ATTEMPTS', 3)
+    monkeypatch.setattr(common, 'REGION_DEADLINE_SECONDS', 10)
+    budgets = []
+    timed = common._timed
+
+    def record_budget(region, step, func, event, budget=None, stop_at=None):
+        budgets.append(budget)
+        return(timed(region, step, func, event, budget, stop_at))
+    monkeypatch.setattr(common, '_timed', record_budget)
+
+    step = Step(slow=['us-west-2'])
+    event = common.run_regional_step('Step', event, step)
+    retry = event['progress']['retry']
+    assert retry['reason'] == 'straggler' and retry['pending_regions'] == ['us-west-2'] and retry['straggler_passes'] == 1
+    assert set(statuses(event)) == set(regions) - {'us-west-2'}
+    event = common.run_regional_step('Step', event, step)
+    assert event['progress']['retry']['straggler_passes'] == 2
+    with pytest.raises(EndpointConnectionError):
+        common.run_regional_step('Step', event, step)
+    assert budgets == [10] * len(regions) + [20, 40]
+
+
+def test_not_ready_wins_over_a_straggler_for_the_reason(event):
+    event = common.run_regional_step('Step', event, Step(not_ready=['eu-west-1'], slow=['us-west-2']))
+    retry = event['progress']['retry']
+    assert retry['reason'] == 'not_ready' and sorted(retry['pending_regions']) == ['eu-west-1', 'us-west-2']
+    assert retry['straggler_passes'] == 1
+
+
+def test_other_errors_fail_the_step(event):
+    with pytest.raises(ClientError):
+        common.run_regional_step('Step', event, Step(fail=['us-west-2'], not_ready=['eu-west-1']))
+
+
+def test_regions_arent_started_near_the_invocation_deadline(event, regions, monkeypatch):
+    monkeypatch.setattr(common, 'DEADLINE_MARGIN_SECONDS', 60)
+    step = Step()
+    event = common.run_regional_step('Step', event, step, context=FakeContext(30))
+    retry = event['progress']['retry']
+    assert step.ran == []
+    assert retry['reason'] == 'deadline' and retry['wait_seconds'] == 0 and sorted(retry['pending_regions']) == sorted(regions)
+
+    event = common.run_regional_step('Step', event, step, context=FakeContext(900))
+    assert event['progress']['retry'] is None and statuses(event) == dict.fromkeys(regions, common.CHANGED)
+
+
+def test_continuation_keeps_the_backoff_attempt(event, monkeypatch):
+    monkeypatch.setattr(common, 'DEADLINE_MARGIN_SECONDS', 60)
+    step = Step(not_ready=['eu-west-1'])
+    event = common.run_regional_step('Step', event, step)
+    event = common.run_regional_step('Step', event, step, context=FakeContext(30))
+    assert event['progress']['retry']['reason'] == 'deadline' and event['progress']['retry']['attempt'] == 1
+    event = common.run_regional_step('Step', event, step, context=FakeContext(900))
+    assert event['progress']['retry']['attempt'] == 2 and event['progress']['retry']['wait_seconds'] == common.backoff_seconds(2)
+
+
+def test_budget_cuts_off_botocore_retries(event, ec2, monkeypatch):
+    # Every attempt fails and botocore keeps retrying; the region's budget stops it at the next attempt
+    monkeypatch.setattr(common, 'REGION_DEADLINE_SECONDS', 0.3)
+    ec2.answer = lambda: AWSResponse('https://ec2.us-east-1.amazonaws.com/', 500, {}, Raw(INTERNAL_ERROR))
+
+    def call(region, event):
+        ec2.describe_vpcs()
+        return(common.CHANGED)
+    event['regions']['region_names'] = ['us-east-1']
+    event = common.run_regional_step('Step', event, call)
+    retry = event['progress']['retry']
+    assert retry['reason'] == 'straggler' and retry['pending_regions'] == ['us-east-1']
+    assert 1 < len(ec2.sent) < common.API_MAX_ATTEMPTS
+
+
+def test_invocation_deadline_defers_a_region_mid_call(event, ec2, monkeypatch):
+    monkeypatch.setattr(common, 'DEADLINE_MARGIN_SECONDS', 60)
+
+    def slow_answer():
+        time.sleep(0.2)
+        return(AWSResponse('https://ec2.us-east-1.amazonaws.com/', 200, {}, Raw(DESCRIBE_VPCS_OK)))
+    ec2.answer = slow_answer
+
+    def call(region, event):
+        ec2.describe_vpcs()
+        ec2.describe_vpcs()
+        return(common.CHANGED)
+    event['regions']['region_names'] = ['us-east-1']
+    # Started with 0.1s to spare: the first call goes out, the second is stopped before it's sent
+    event = common.run_regional_step('Step', event, call, context=FakeContext(60.1))
+    retry = event['progress']['retry']
+    assert retry['reason'] == 'deadline' and retry['pending_regions'] == ['us-east-1'] and retry['wait_seconds'] == 0
+    assert len(ec2.sent) == 1
@@ -0,0 +1,74 @@
+# Copyright 2024 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The state machines hand each step only its own config sections, so they have to keep up with
+# the STEP_CONFIG sections and the regional_settings registry.
+
+import os
+
+import pytest
+import yaml
+
+import common
+import regional_settings
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cloudformation', 'AccountFactory-Template.yaml')
+
+
+class TemplateLoader(yaml.SafeLoader):
+    """Reads the CloudFormation short form intrinsics (!Ref, !GetAtt, ...) as None"""
+    pass
+
+
+TemplateLoader.add_multi_constructor('!', lambda loader, suffix, node: None)
+
+
+def states(machine):
+    """Every state in the machine, including the ones in Parallel branches and Map item processors"""
+    with open(TEMPLATE) as f:
+        template = yaml.load(f, Loader=TemplateLoader)
+    found = {}
+
+    def walk(states):
+        for name, state in states.items():
+            found.setdefault(name, []).append(state)
+            for branch in state.get('Branches', []):
+                walk(branch['States'])
+            if 'ItemProcessor' in state:
+                walk(state['ItemProcessor']['States'])
+    walk(template['Resources'][machine]['Properties']['Definition']['States'])
+    return(found)
+
+
+def config_sections(state):
+    return(set(k[:-2] for k in state['Parameters']['global_config']))
+
+
+@pytest.mark.parametrize('machine', ['NewAccountStateMachine', 'ParallelStateMachine'])
+def test_regional_settings_get_their_sections(machine):
+    for state in states(machine)['EnableRegionalSettings']:
+        assert config_sections(state) == set(s['config_key'] for s in regional_settings.REGIONAL_SETTINGS)
+
+
+@pytest.mark.parametrize('machine', ['NewAccountStateMachine', 'ParallelStateMachine'])
+@pytest.mark.parametrize('step', ['ConfigurePasswordPolicyFunction', 'EnableS3BlockPublicAccess', 'DeleteDefaultVPCs'])
+def test_steps_get_their_section(machine, step):
+    for state in states(machine)[step]:
+        assert config_sections(state) == {common.STEP_CONFIG[step]}
+
+
+def test_region_map_carries_the_regional_sections():
+    (config_map,) = states('ParallelStateMachine')['ConfigureRegions']
+    expected = set(s['config_key'] for s in regional_settings.REGIONAL_SETTINGS) | {common.STEP_CONFIG['DeleteDefaultVPCs']}
+    assert set(k[:-2] for k in config_map['ItemSelector']['global_config']) == expected